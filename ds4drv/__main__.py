@@ -1,25 +1,46 @@
 import sys
 import signal
+import socket
 
+from functools import partial
 from threading import Thread
 
 from .actions import ActionRegistry
-from .backends import BluetoothBackend, HidrawBackend
+from .actions.binding import action_pool
+from .backends import BluetoothBackend, HidrawBackend, ReplayBackend
 from .config import load_options
+from .control import ControlServer, error_response, run_command
 from .daemon import Daemon
 from .eventloop import EventLoop
 from .exceptions import BackendError
+from .latency import LatencyTracker, clock_ns
+from .metrics import ControllerMetrics, MetricsServer
+from .worker import WorkerSupervisor
 
 
 class DS4Controller(object):
-    def __init__(self, index, options, dynamic=False):
+    def __init__(self, index, options, dynamic=False, loop=None):
         self.index = index
         self.dynamic = dynamic
         self.logger = Daemon.logger.new_module("controller {0}".format(index))
 
         self.error = None
         self.device = None
-        self.loop = EventLoop()
+
+        if loop:
+            self.loop = loop.namespace("controller {0}".format(index))
+        else:
+            self.loop = loop = EventLoop()
+
+        self.metrics = ControllerMetrics(index, loop)
+        self.output_timer = self.loop.create_timer(0, self.write_output)
+
+        # Must be created before the actions, which only measure
+        # their report handlers when it exists.
+        if options.measure_latency:
+            self.latency = LatencyTracker()
+        else:
+            self.latency = None
 
         self.actions = [cls(self) for cls in ActionRegistry.actions]
         self.bindings = options.parent.bindings
@@ -75,6 +96,12 @@ class DS4Controller(object):
         self.logger.info("Connected to {0}", device.name)
 
         self.device = device
+        self.metrics.attach_device(device)
+        if self.latency:
+            device.parse_report = self.latency.wrap("parse",
+                                                    device.parse_report)
+
+        device.output.attach(self.output_timer)
         self.device.set_led(*self.options.led)
         self.fire_event("device-setup", device)
         self.loop.add_watcher(device.report_fd, self.read_report)
@@ -84,8 +111,10 @@ class DS4Controller(object):
         self.logger.info("Disconnected")
         self.fire_event("device-cleanup")
         self.loop.remove_watcher(self.device.report_fd)
+        self.device.output.detach()
         self.device.close()
         self.device = None
+        self.metrics.detach_device()
 
         if self.dynamic:
             self.loop.stop()
@@ -94,17 +123,78 @@ class DS4Controller(object):
         self.fire_event("load-options", options)
         self.options = options
 
+        self.output_timer.interval = options.output_interval / 1000.0
+
+    def write_output(self):
+        if self.device:
+            self.device.output.interval_passed()
+
     def read_report(self):
-        report = self.device.read_report()
+        if self.latency:
+            return self.read_report_measured()
 
-        if not report:
-            if report is False:
+        device = self.device
+        coalesce = self.options.coalesce_reports
+        fire_event = self.loop.fire_event
+        metrics = self.metrics
+
+        for report in device.read_reports(coalesce):
+            if not report:
+                self.cleanup_device()
                 return
 
-            self.cleanup_device()
-            return
+            metrics.reports += 1
+            fire_event("device-report", report)
+
+            # The device may have been cleaned up by a event handler
+            if self.device is not device:
+                return
+
+    def read_report_measured(self):
+        """Same as read_report, but records the time spent reading
+        each report and the total time until all handlers are done.
+
+        The read stage includes parsing the report.
+        """
+        start = clock_ns()
+        device = self.device
+        coalesce = self.options.coalesce_reports
+        fire_event = self.loop.fire_event
+        record_read = self.latency.histogram("read").record
+        record_total = self.latency.histogram("total").record
+
+        reports = device.read_reports(coalesce)
+        while True:
+            read_start = clock_ns()
+            try:
+                report = next(reports)
+            except StopIteration:
+                return
+
+            record_read(clock_ns() - read_start)
+
+            if not report:
+                self.cleanup_device()
+                return
+
+            self.metrics.reports += 1
+            fire_event("device-report", report)
+            record_total(clock_ns() - start)
+
+            # The device may have been cleaned up by a event handler
+            if self.device is not device:
+                return
+
+            start = clock_ns()
 
-        self.fire_event("device-report", report)
+    def control(self, request, reply):
+        """Runs a control command on the controller's loop and calls
+        reply with the response."""
+        cancel = partial(reply, error_response("Controller has exited"))
+        self.loop.call_soon(self.run_control, request, reply, cancel=cancel)
+
+    def run_control(self, request, reply):
+        reply(run_command(self, request))
 
     def run(self):
         self.loop.run()
@@ -122,25 +212,137 @@ class DS4Controller(object):
             self.logger.info(*args)
 
 
+class ControllerThread(Thread):
+    """Runs a controller on its own event loop in a thread.
+
+    The controller is only touched from the loop's thread, other
+    threads hand their calls to the loop.
+    """
+
+    def __init__(self, controller):
+        Thread.__init__(self, target=controller.run)
+        self.controller = controller
+
+    def setup_device(self, device):
+        self.controller.loop.call_and_wait(self.controller.setup_device,
+                                           device)
+
+    def shutdown(self):
+        self.controller.exit("Cleaning up...", error=False)
+        self.controller.loop.stop()
+
+    def stop(self):
+        self.controller.loop.call_and_wait(self.shutdown)
+        self.join()
+
+
 def create_controller_thread(index, controller_options, dynamic=False):
     controller = DS4Controller(index, controller_options, dynamic=dynamic)
 
-    thread = Thread(target=controller.run)
-    thread.controller = controller
+    thread = ControllerThread(controller)
     thread.start()
 
     return thread
 
 
+class SharedLoopThread(Thread):
+    """Runs the controllers on a single event loop in one thread."""
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.loop = EventLoop()
+
+    def run(self):
+        self.loop.run()
+
+    def stop(self):
+        self.loop.stop()
+        self.join()
+
+
+class SharedLoopController(object):
+    """Wraps a controller running on a shared loop.
+
+    Provides the same interface as ControllerThread.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def is_alive(self):
+        return self.controller.loop.running
+
+    def setup_device(self, device):
+        self.controller.loop.call_and_wait(self.controller.setup_device,
+                                           device)
+
+    def shutdown(self):
+        self.controller.exit("Cleaning up...", error=False)
+        self.controller.loop.stop()
+
+    def stop(self):
+        self.controller.loop.call_and_wait(self.shutdown)
+
+
+def create_shared_controller(shared_thread, index, controller_options,
+                             dynamic=False):
+    create = partial(DS4Controller, index, controller_options,
+                     dynamic=dynamic, loop=shared_thread.loop)
+
+    # The other controllers may already be running on the loop
+    if shared_thread.is_alive():
+        controller = shared_thread.loop.call_and_wait(create)
+    else:
+        controller = create()
+        shared_thread.start()
+
+    return SharedLoopController(controller)
+
+
+def create_controller_process(supervisor, index, controller_options,
+                              dynamic=False):
+    create = partial(DS4Controller, index, controller_options,
+                     dynamic=dynamic)
+
+    if not supervisor.is_alive():
+        supervisor.start()
+
+    return supervisor.create_process(index, create, dynamic=dynamic)
+
+
+def start_server(sigint_handler, name, cls, path, *args):
+    """Starts a server on the loop shared by the controllers, or on a
+    loop of its own if there is none."""
+    loop_thread = sigint_handler.loop_thread
+    if not loop_thread:
+        loop_thread = sigint_handler.loop_thread = SharedLoopThread()
+
+    try:
+        server = cls(loop_thread.loop, path, *args)
+    except socket.error as err:
+        Daemon.exit("Failed to create {0} socket {1}: {2}", name, path, err)
+
+    sigint_handler.servers.append(server)
+
+    if not loop_thread.is_alive():
+        loop_thread.start()
+
+
 class SigintHandler(object):
     def __init__(self, threads):
         self.threads = threads
+        self.loop_thread = None
+        self.servers = []
 
     def cleanup_controller_threads(self):
         for thread in self.threads:
-            thread.controller.exit("Cleaning up...", error=False)
-            thread.controller.loop.stop()
-            thread.join()
+            thread.stop()
+
+        if self.loop_thread and self.loop_thread.is_alive():
+            self.loop_thread.stop()
+
+        for server in self.servers:
+            server.close()
 
     def __call__(self, signum, frame):
         signal.signal(signum, signal.SIG_DFL)
@@ -160,7 +362,26 @@ def main():
     except ValueError as err:
         Daemon.exit("Failed to parse options: {0}", err)
 
-    if options.hidraw:
+    action_pool.configure(options.action_workers, options.action_queue_size)
+
+    if options.controller_mode == "shared":
+        sigint_handler.loop_thread = SharedLoopThread()
+        create_controller = partial(create_shared_controller,
+                                    sigint_handler.loop_thread)
+    elif options.controller_mode == "process":
+        if not WorkerSupervisor.supported:
+            Daemon.exit("Process mode requires Python 3.3 or later")
+
+        sigint_handler.loop_thread = WorkerSupervisor(Daemon.logger)
+        create_controller = partial(create_controller_process,
+                                    sigint_handler.loop_thread)
+    else:
+        create_controller = create_controller_thread
+
+    if options.replay:
+        backend = ReplayBackend(Daemon.logger, options.replay,
+                                realtime=not options.replay_fast)
+    elif options.hidraw:
         backend = HidrawBackend(Daemon.logger)
     else:
         backend = BluetoothBackend(Daemon.logger)
@@ -173,8 +394,22 @@ def main():
     if options.daemon:
         Daemon.fork(options.daemon_log, options.daemon_pid)
 
+    if options.async_log:
+        Daemon.logger.start_async()
+
+    if options.metrics_socket:
+        start_server(sigint_handler, "metrics", MetricsServer,
+                     options.metrics_socket,
+                     lambda: [thread.controller.metrics for thread in threads])
+
+    if options.control_socket:
+        start_server(sigint_handler, "control", ControlServer,
+                     options.control_socket,
+                     lambda: [thread.controller for thread in threads
+                              if thread.is_alive()])
+
     for index, controller_options in enumerate(options.controllers):
-        thread = create_controller_thread(index + 1, controller_options)
+        thread = create_controller(index + 1, controller_options)
         threads.append(thread)
 
     for device in backend.devices:
@@ -182,6 +417,7 @@ def main():
         for thread in threads:
             # Controller has received a fatal error, exit
             if thread.controller.error:
+                sigint_handler.cleanup_controller_threads()
                 sys.exit(1)
 
             if thread.controller.device:
@@ -199,12 +435,15 @@ def main():
         for thread in filter(lambda t: not t.controller.device, threads):
             break
         else:
-            thread = create_controller_thread(len(threads) + 1,
-                                              options.default_controller,
-                                              dynamic=True)
+            thread = create_controller(len(threads) + 1,
+                                       options.default_controller,
+                                       dynamic=True)
             threads.append(thread)
 
-        thread.controller.setup_device(device)
+        thread.setup_device(device)
+
+    # The backend has no more devices to offer
+    sigint_handler.cleanup_controller_threads()
 
 if __name__ == "__main__":
     main()
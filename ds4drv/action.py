@@ -57,7 +57,13 @@ class ReportAction(Action):
         super(ReportAction, self).__init__(controller)
 
         self._last_report = None
-        self.register_event("device-report", self._handle_report)
+
+        handler = self._handle_report
+        if controller.latency:
+            stage = "action:{0}".format(type(self).__name__)
+            handler = controller.latency.wrap(stage, handler)
+
+        self.register_event("device-report", handler)
 
     def create_timer(self, interval, callback):
         @wraps(callback)
@@ -5,5 +5,7 @@ from . import binding
 from . import btsignal
 from . import dump
 from . import input
+from . import latency
 from . import led
+from . import record
 from . import status
@@ -3,11 +3,18 @@ import re
 import shlex
 import subprocess
 
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 from itertools import chain
+from threading import Lock, Thread, Timer
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
 
 from ..action import ReportAction
-from ..config import buttoncombo
+from ..config import buttoncombo, controllopt
+from ..device import combo_mask
 
 ReportAction.add_option("--bindings", metavar="bindings",
                         help="Use custom action bindings specified in the "
@@ -18,18 +25,212 @@ ReportAction.add_option("--profile-toggle", metavar="button(s)",
                         help="A button combo that will trigger profile "
                              "cycling, e.g. 'R1+L1+PS'")
 
-ActionBinding = namedtuple("ActionBinding", "modifiers button callback args")
+ReportAction.add_option("--action-timeout", metavar="seconds", type=float,
+                        default=0,
+                        help="Kills commands started by 'exec' bindings "
+                             "that are still running after this many "
+                             "seconds. Default is 0, which disables the "
+                             "timeout")
+
+# Number of threads running pooled actions and the number of actions
+# that may be waiting for a free thread.
+ACTION_WORKERS = 4
+ACTION_QUEUE_SIZE = 16
+
+# Number of times a binding's pooled action may be running at once.
+ACTION_CONCURRENCY = 1
+
+ReportAction.add_option("--action-concurrency", metavar="count", type=int,
+                        default=ACTION_CONCURRENCY,
+                        help="Number of times the action of an 'exec' "
+                             "binding may be running or queued at once, "
+                             "further presses are ignored until one is "
+                             "done. Default is {0}".format(
+                             ACTION_CONCURRENCY))
+
+# The pool is shared by all controllers
+controllopt.add_argument("--action-workers", metavar="count", type=int,
+                         default=ACTION_WORKERS,
+                         help="Number of threads running the actions of "
+                              "'exec' bindings. Default is {0}".format(
+                              ACTION_WORKERS))
+controllopt.add_argument("--action-queue-size", metavar="count", type=int,
+                         default=ACTION_QUEUE_SIZE,
+                         help="Number of 'exec' binding actions that may be "
+                              "waiting for a free thread, further actions "
+                              "are ignored. Default is {0}".format(
+                              ACTION_QUEUE_SIZE))
+
+ActionBinding = namedtuple("ActionBinding",
+                           "modifiers button callback args "
+                           "mask button_mask bit")
+
+
+class ActionPool(object):
+    """A bounded pool of threads running binding actions.
+
+    Keeps actions that may block, like waiting for a command to finish,
+    from stalling report handling on the event loop thread.
+    """
+
+    def __init__(self, workers=ACTION_WORKERS, size=ACTION_QUEUE_SIZE):
+        self.workers = workers
+        self.queue = Queue(size)
+        self.lock = Lock()
+        self.running = defaultdict(int)
+        self.threads = []
+
+    def configure(self, workers, size):
+        """Changes the number of threads and the size of the queue."""
+        with self.lock:
+            self.workers = workers
+
+        with self.queue.mutex:
+            self.queue.maxsize = size
+
+    def submit(self, key, limit, func, *args):
+        """Queues a call of func.
+
+        Returns False if limit calls with the same key are already
+        queued or running, or if the queue is full.
+        """
+        with self.lock:
+            if self.running[key] >= limit:
+                return False
+
+            self.running[key] += 1
+
+            if len(self.threads) < self.workers:
+                thread = Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        try:
+            self.queue.put_nowait((key, func, args))
+        except Full:
+            self.done(key)
+            return False
+
+        return True
+
+    def done(self, key):
+        with self.lock:
+            self.running[key] -= 1
+            if not self.running[key]:
+                del self.running[key]
+
+    def work(self):
+        while True:
+            key, func, args = self.queue.get()
+            try:
+                func(*args)
+            finally:
+                self.done(key)
+
+
+action_pool = ActionPool()
+
+
+# Values of the variables that can be used in binding actions,
+# as functions of the controller and the report.
+ACTION_VARIABLES = {
+    "name": lambda controller, report: controller.device.name,
+    "profile": lambda controller, report: controller.current_profile,
+    "device_addr": lambda controller, report: controller.device.device_addr,
+    "report": lambda controller, report: report,
+}
+
+ACTION_VARIABLE_RE = re.compile(r"\$(?P<var>\w+)(\.(?P<attr>\w+))?")
+
+
+def _compile_variable(var, attr):
+    value = ACTION_VARIABLES.get(var, lambda controller, report: None)
+    if not attr:
+        return value
+
+    return lambda controller, report: getattr(value(controller, report),
+                                              attr, None)
+
+
+class ActionTemplate(object):
+    """A binding action parsed ahead of time.
+
+    The action is split into arguments once, arguments containing
+    variables are kept as a list of literal strings and functions
+    returning the value of a variable.
+    """
+
+    def __init__(self, action, actions, pooled_actions):
+        try:
+            argv = shlex.split(action)
+        except ValueError as err:
+            raise ValueError("Unable to parse: {0}".format(err))
+
+        if not argv:
+            raise ValueError("No action type")
+
+        self.action = action
+        self.func = actions.get(argv[0])
+        if not self.func:
+            raise ValueError("Invalid action type: {0}".format(argv[0]))
+
+        self.pooled = self.func in pooled_actions
+        self.args = tuple(map(self.compile_arg, argv[1:]))
+        self.static = all(isinstance(arg, str) for arg in self.args)
+
+    @staticmethod
+    def compile_arg(arg):
+        parts = []
+        pos = 0
+        for match in ACTION_VARIABLE_RE.finditer(arg):
+            if match.start() > pos:
+                parts.append(arg[pos:match.start()])
+
+            parts.append(_compile_variable(*match.group("var", "attr")))
+            pos = match.end()
+
+        if not parts:
+            return arg
+
+        if pos < len(arg):
+            parts.append(arg[pos:])
+
+        return parts
+
+    def render(self, controller, report):
+        """Returns the arguments with the variables replaced."""
+        if self.static:
+            return self.args
+
+        args = []
+        for arg in self.args:
+            if not isinstance(arg, str):
+                arg = "".join(isinstance(part, str) and part or
+                              str(part(controller, report))
+                              for part in arg)
+            args.append(arg)
+
+        return args
 
 
 class ReportActionBinding(ReportAction):
     """Listens for button presses and executes actions."""
 
     actions = {}
+    pooled_actions = set()
 
     @classmethod
-    def action(cls, name):
+    def action(cls, name, pooled=False):
+        """Registers a binding action.
+
+        Pooled actions are run on the action pool instead of the
+        controller's event loop, use it for actions that may block.
+        """
         def decorator(func):
             cls.actions[name] = func
+            if pooled:
+                cls.pooled_actions.add(func)
             return func
 
         return decorator
@@ -38,22 +239,35 @@ class ReportActionBinding(ReportAction):
         super(ReportActionBinding, self).__init__(controller)
 
         self.bindings = []
-        self.active = set()
+        self.active = 0
+        self.buttons = 0
+        self.check_all = True
+        self.templates = {}
 
     def add_binding(self, combo, callback, *args):
         modifiers, button = combo[:-1], combo[-1]
-        binding = ActionBinding(modifiers, button, callback, args)
+        binding = ActionBinding(modifiers, button, callback, args,
+                                combo_mask(combo), combo_mask((button,)),
+                                1 << len(self.bindings))
         self.bindings.append(binding)
 
     def load_options(self, options):
-        self.active = set()
+        self.active = 0
         self.bindings = []
+        self.buttons = 0
+        self.check_all = True
 
         bindings = (self.controller.bindings["global"].items(),
                     self.controller.bindings.get(options.bindings, {}).items())
 
         for binding, action in chain(*bindings):
-            self.add_binding(binding, self.handle_binding_action, action)
+            template = self.compile_action(action)
+            if template:
+                # Templates are shared by bindings with the same action,
+                # so the pool limit is kept per combo instead.
+                key = (self, combo_mask(binding), template)
+                self.add_binding(binding, self.handle_binding_action,
+                                 key, template)
 
         have_profiles = (self.controller.profiles and
                          len(self.controller.profiles) > 1)
@@ -61,59 +275,105 @@ class ReportActionBinding(ReportAction):
             self.add_binding(self.controller.default_profile.profile_toggle,
                              lambda r: self.controller.next_profile())
 
-    def handle_binding_action(self, report, action):
-        info = dict(name=self.controller.device.name,
-                    profile=self.controller.current_profile,
-                    device_addr=self.controller.device.device_addr,
-                    report=report)
-
-        def replace_var(match):
-            var, attr = match.group("var", "attr")
-            var = info.get(var)
-            if attr:
-                var = getattr(var, attr, None)
-            return str(var)
-
-        action = re.sub(r"\$(?P<var>\w+)(\.(?P<attr>\w+))?",
-                        replace_var, action)
-        action_split = shlex.split(action)
-        action_type = action_split[0]
-        action_args = action_split[1:]
-
-        func = self.actions.get(action_type)
-        if func:
-            try:
-                func(self.controller, *action_args)
-            except Exception as err:
-                self.logger.error("Failed to execute action: {0}", err)
+    def handle_binding_action(self, report, key, template):
+        args = template.render(self.controller, report)
+
+        if template.pooled:
+            limit = self.controller.options.action_concurrency
+            queued = action_pool.submit(key, limit,
+                                        self.run_action, template.func, args)
+            if not queued:
+                self.logger.warning("Ignoring action, it is already "
+                                    "running or too many actions are "
+                                    "queued: {0}", template.action)
         else:
-            self.logger.error("Invalid action type: {0}", action_type)
+            self.run_action(template.func, args)
+
+    def compile_action(self, action):
+        """Returns the template of an action, parsing it on first use."""
+        if action not in self.templates:
+            try:
+                self.templates[action] = ActionTemplate(action, self.actions,
+                                                        self.pooled_actions)
+            except ValueError as err:
+                self.logger.error("Invalid binding action '{0}': {1}",
+                                  action, err)
+                self.templates[action] = None
+
+        return self.templates[action]
+
+    def run_action(self, func, args):
+        try:
+            func(self.controller, *args)
+        except Exception as err:
+            self.logger.error("Failed to execute action: {0}", err)
 
     def handle_report(self, report):
-        for binding in self.bindings:
-            modifiers = True
-            for button in binding.modifiers:
-                modifiers = modifiers and getattr(report, button)
+        # Nothing can have been pressed or released if the buttons are
+        # the same as in the last report, unless the bindings were reset.
+        if not (report.buttons_changed or self.check_all):
+            return
 
-            active = getattr(report, binding.button)
-            released = not active
+        self.check_all = False
 
-            if modifiers and active and binding not in self.active:
-                self.active.add(binding)
-            elif released and binding in self.active:
-                self.active.remove(binding)
-                binding.callback(report, *binding.args)
+        # Combos are matched against the button word of the report, a
+        # binding can only be activated if one of its buttons was just
+        # pressed and only fire if its button was just released.
+        buttons = report.buttons
+        pressed = buttons & ~self.buttons
+        released = self.buttons & ~buttons
+        self.buttons = buttons
 
+        if not (pressed or released):
+            return
 
-@ReportActionBinding.action("exec")
+        for binding in self.bindings:
+            if self.active & binding.bit:
+                if released & binding.button_mask:
+                    self.active &= ~binding.bit
+                    self.controller.metrics.binding_invocations += 1
+                    binding.callback(report, *binding.args)
+            elif (pressed & binding.mask and
+                  (buttons & binding.mask) == binding.mask):
+                self.active |= binding.bit
+
+
+@ReportActionBinding.action("exec", pooled=True)
 def exec_(controller, cmd, *args):
-    """Executes a subprocess in the foreground, blocking until returned."""
+    """Executes a subprocess, waiting for it to return on the action pool."""
     controller.logger.info("Executing: {0} {1}", cmd, " ".join(args))
 
+    cmd = [cmd] + list(args)
     try:
-        subprocess.check_call([cmd] + list(args))
-    except (OSError, subprocess.CalledProcessError) as err:
+        process = subprocess.Popen(cmd)
+    except OSError as err:
+        controller.logger.error("Failed to execute process: {0}", err)
+        return
+
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        process.kill()
+
+    timeout = controller.options.action_timeout
+    if timeout:
+        timer = Timer(timeout, kill)
+        timer.start()
+
+    returncode = process.wait()
+
+    if timeout:
+        timer.cancel()
+
+    if timed_out:
+        controller.logger.error("Process timed out after {0} seconds: {1}",
+                                timeout, " ".join(cmd))
+    elif returncode:
+        err = subprocess.CalledProcessError(returncode, cmd)
         controller.logger.error("Failed to execute process: {0}", err)
+    else:
+        controller.logger.info("Process finished: {0}", " ".join(cmd))
 
 
 @ReportActionBinding.action("exec-background")
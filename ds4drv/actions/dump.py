@@ -1,4 +1,5 @@
 from ..action import ReportAction
+from ..device import DS4Report
 
 ReportAction.add_option("--dump-reports", action="store_true",
                         help="Prints controller input reports")
@@ -25,7 +26,7 @@ class ReportActionDump(ReportAction):
 
     def dump(self, report):
         dump = "Report dump\n"
-        for key in report.__slots__:
+        for key in DS4Report.__slots__:
             value = getattr(report, key)
             dump += "    {0}: {1}\n".format(key, value)
 
@@ -1,7 +1,7 @@
 from ..action import ReportAction
 from ..config import buttoncombo
 from ..exceptions import DeviceError
-from ..uinput import create_uinput_device
+from ..uinput import ForceFeedback, create_uinput_device
 
 ReportAction.add_option("--emulate-xboxdrv", action="store_true",
                          help="Emulates the same joystick layout as a "
@@ -40,12 +40,24 @@ class ReportActionInput(ReportAction):
         # allow for at least one fresh report to be received inbetween
         self.timer = self.create_timer(0.005, self.emit_mouse)
 
+        # Plays the effects games upload to the joystick on the motors
+        self.ff = ForceFeedback(self.controller.loop, self.rumble)
+        if self.controller.latency:
+            self.ff.read = self.controller.latency.wrap("ff", self.ff.read)
+
     def setup(self, device):
         self.timer.start()
 
+        if self.ff.motors != (0, 0):
+            device.rumble(*self.ff.motors)
+
     def disable(self):
         self.timer.stop()
 
+        # Effects still playing would otherwise be resumed on the next
+        # device. Uploads must still be answered, so it stays attached.
+        self.ff.stop()
+
         if self.joystick:
             self.joystick.emit_reset()
 
@@ -66,18 +78,21 @@ class ReportActionInput(ReportAction):
                 joystick_layout = "ds4"
 
             if not self.mouse and options.trackpad_mouse:
-                self.mouse = create_uinput_device("mouse")
+                self.mouse = self.create_device("mouse")
             elif self.mouse and not options.trackpad_mouse:
                 self.mouse.device.close()
                 self.mouse = None
 
             if self.joystick and self.joystick_layout != joystick_layout:
+                self.ff.detach()
                 self.joystick.device.close()
-                joystick = create_uinput_device(joystick_layout)
+                joystick = self.create_device(joystick_layout)
                 self.joystick = joystick
+                self.attach_ff(joystick)
             elif not self.joystick:
-                joystick = create_uinput_device(joystick_layout)
+                joystick = self.create_device(joystick_layout)
                 self.joystick = joystick
+                self.attach_ff(joystick)
                 if joystick.device.device:
                     self.logger.info("Created devices {0} (joystick) "
                                      "{1} (evdev) ", joystick.joystick_dev,
@@ -85,9 +100,7 @@ class ReportActionInput(ReportAction):
             else:
                 joystick = None
 
-            self.joystick.ignored_buttons = set()
-            for button in options.ignored_buttons:
-                self.joystick.ignored_buttons.add(button)
+            ignored_buttons = set(options.ignored_buttons)
 
             if joystick:
                 self.joystick_layout = joystick_layout
@@ -99,10 +112,32 @@ class ReportActionInput(ReportAction):
                     len(self.controller.default_profile.profile_toggle) == 1):
 
                     button = self.controller.default_profile.profile_toggle[0]
-                    self.joystick.ignored_buttons.add(button)
+                    ignored_buttons.add(button)
+
+            self.joystick.set_ignored_buttons(ignored_buttons)
         except DeviceError as err:
             self.controller.exit("Failed to create input device: {0}", err)
 
+    def create_device(self, layout):
+        device = create_uinput_device(layout)
+        device.metrics = self.controller.metrics
+
+        # Measure the writes to uinput
+        latency = self.controller.latency
+        if latency:
+            device.flush = latency.wrap("uinput", device.flush)
+
+        return device
+
+    def attach_ff(self, joystick):
+        if joystick.effects is not None:
+            self.ff.attach(joystick)
+
+    def rumble(self, small, big):
+        device = self.controller.device
+        if device:
+            device.rumble(small, big)
+
     def emit_mouse(self, report):
         if self.joystick:
             self.joystick.emit_mouse(report)
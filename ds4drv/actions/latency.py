@@ -0,0 +1,33 @@
+from ..action import Action
+
+# How often the latency summary is logged, in seconds.
+LATENCY_LOG_INTERVAL = 60
+
+
+class ActionLatency(Action):
+    """Logs a summary of the latencies measured with --measure-latency."""
+
+    def __init__(self, *args, **kwargs):
+        super(ActionLatency, self).__init__(*args, **kwargs)
+
+        self.timer = self.create_timer(LATENCY_LOG_INTERVAL, self.log_summary)
+
+    def setup(self, device):
+        if self.controller.latency:
+            self.timer.start()
+
+    def disable(self):
+        self.timer.stop()
+
+        if self.controller.latency:
+            self.log_summary()
+            self.controller.latency.reset()
+
+    def log_summary(self):
+        lines = self.controller.latency.format_summary()
+        if lines:
+            self.logger.info("Latency of the report processing:")
+            for line in lines:
+                self.logger.info("  {0}", line)
+
+        return True
@@ -0,0 +1,79 @@
+import os
+
+from ..action import ReportAction
+from ..recording import ReportRecorder, RecordingError
+
+ReportAction.add_option("--record-reports", metavar="filename",
+                        type=os.path.expanduser,
+                        help="Records every input report to a file in a "
+                             "compact binary format. '{controller}' in "
+                             "the filename is replaced by the controller "
+                             "number. Reports of later connections are "
+                             "appended to the same file")
+
+
+class ReportActionRecord(ReportAction):
+    """Records raw reports to a file."""
+
+    def __init__(self, *args, **kwargs):
+        super(ReportActionRecord, self).__init__(*args, **kwargs)
+
+        self.filename = None
+        self.recorder = None
+        self.timer = self.create_timer(1, self.flush)
+
+    def setup(self, device):
+        self.enable()
+
+    def enable(self):
+        device = self.controller.device
+        if self.recorder or not (device and self.filename):
+            return
+
+        filename = self.filename.replace("{controller}",
+                                         str(self.controller.index))
+        try:
+            self.recorder = ReportRecorder(filename, device.type)
+        except RecordingError as err:
+            self.logger.error("Unable to record reports: {0}", err)
+            return
+
+        self.logger.info("Recording reports to {0}", filename)
+        self.timer.start()
+
+    def disable(self):
+        self.timer.stop()
+
+        if self.recorder:
+            recorder = self.recorder
+            self.recorder = None
+
+            try:
+                recorder.close()
+            except RecordingError as err:
+                self.logger.error("Unable to write recording: {0}", err)
+            else:
+                self.logger.info("Recorded {0} reports", recorder.records)
+
+    def load_options(self, options):
+        if options.record_reports != self.filename:
+            self.disable()
+            self.filename = options.record_reports
+            self.enable()
+
+    def flush(self, report):
+        self.recorder.flush()
+
+        return True
+
+    def handle_report(self, report):
+        if self.recorder:
+            # Only reports parsed lazily keep the raw report around
+            buf = getattr(report, "buf", None)
+            if buf is None:
+                self.logger.error("Unable to record reports, the raw "
+                                  "report is not available")
+                self.disable()
+                return
+
+            self.recorder.record(buf)
@@ -1,4 +1,5 @@
 from ..action import ReportAction
+from ..eventloop import monotonic
 
 BATTERY_MAX          = 8
 BATTERY_MAX_CHARGING = 11
@@ -13,14 +14,32 @@ class ReportActionStatus(ReportAction):
 
     def setup(self, device):
         self.report = None
+        self.last_check = monotonic()
+        self.last_reports = self.controller.metrics.reports
         self.timer.start()
 
     def disable(self):
         self.timer.stop()
 
+    def update_metrics(self, report):
+        metrics = self.controller.metrics
+        now = monotonic()
+        reports = metrics.reports
+
+        metrics.report_rate = round((reports - self.last_reports) /
+                                    (now - self.last_check), 1)
+        self.last_check = now
+        self.last_reports = reports
+
+        max_value = report.plug_usb and BATTERY_MAX_CHARGING or BATTERY_MAX
+        metrics.battery = min(100, 100 * report.battery // max_value)
+        metrics.usb_connected = int(report.plug_usb)
+
     def check_status(self, report):
+        self.update_metrics(report)
+
         if not self.report:
-            self.report = report
+            self.report = report.snapshot()
             show_battery = True
         else:
             show_battery = False
@@ -57,6 +76,8 @@ class ReportActionStatus(ReportAction):
 
             self.logger.info("Audio: {0}", plug_audio)
 
-        self.report = report
+        # The report is only valid until the next one is read, so we
+        # need to keep a copy of it to compare against.
+        self.report = report.snapshot()
 
         return True
@@ -1,10 +1,22 @@
+import errno
+import os
 import socket
-import subprocess
+
+from select import EPOLLOUT
+from threading import Thread
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 from ..backend import Backend
+from ..eventloop import EventLoop
 from ..exceptions import BackendError, DeviceError
 from ..device import DS4Device
 from ..utils import zero_copy_slice
+from .hci import (HCI_DEVICE, HCIError, HCIScanner, open_hci_socket,
+                  read_local_address)
 
 
 L2CAP_PSM_HIDP_CTRL = 0x11
@@ -16,27 +28,34 @@ HIDP_DATA_RTYPE_OUTPUT  = 0x02
 REPORT_ID = 0x11
 REPORT_SIZE = 79
 
+# Seconds to wait for both channels of a device to connect
+CONNECT_TIMEOUT = 5
+
+
+def create_l2cap_socket():
+    return socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET,
+                         socket.BTPROTO_L2CAP)
+
 
 class BluetoothDS4Device(DS4Device):
     @classmethod
     def connect(cls, addr):
-        ctl_socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET,
-                                   socket.BTPROTO_L2CAP)
-
-        int_socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET,
-                                   socket.BTPROTO_L2CAP)
+        ctl_socket = create_l2cap_socket()
+        int_socket = create_l2cap_socket()
 
         try:
             ctl_socket.connect((addr, L2CAP_PSM_HIDP_CTRL))
             int_socket.connect((addr, L2CAP_PSM_HIDP_INTR))
             int_socket.setblocking(False)
         except socket.error as err:
-            DeviceError("Failed to connect: {0}".format(err))
+            ctl_socket.close()
+            int_socket.close()
+            raise DeviceError("Failed to connect: {0}".format(err))
 
         return cls(addr, ctl_socket, int_socket)
 
     def __init__(self, addr, ctl_sock, int_sock):
-        self.buf = bytearray(REPORT_SIZE)
+        self.create_report_buffers(REPORT_SIZE)
         self.ctl_sock = ctl_sock
         self.int_sock = int_sock
         self.report_fd = int_sock.fileno()
@@ -44,6 +63,22 @@ class BluetoothDS4Device(DS4Device):
         super(BluetoothDS4Device, self).__init__(addr.upper(), addr,
                                                  "bluetooth")
 
+    def export_fds(self):
+        return [self.ctl_sock.fileno(), self.int_sock.fileno()]
+
+    def import_fds(self, fds):
+        socks = []
+        for fd in fds:
+            socks.append(socket.fromfd(fd, socket.AF_BLUETOOTH,
+                                       socket.SOCK_SEQPACKET,
+                                       socket.BTPROTO_L2CAP))
+            os.close(fd)
+
+        self.ctl_sock, self.int_sock = socks
+        self.int_sock.setblocking(False)
+        self.report_fd = self.int_sock.fileno()
+        self.create_report_buffers(REPORT_SIZE)
+
     def read_report(self):
         try:
             ret = self.int_sock.recv_into(self.buf)
@@ -56,10 +91,12 @@ class BluetoothDS4Device(DS4Device):
 
         # Invalid report size or id, just ignore it
         if ret < REPORT_SIZE or self.buf[1] != REPORT_ID:
+            self.invalid_reports += 1
             return False
 
         # Cut off bluetooth data
         buf = zero_copy_slice(self.buf, 3)
+        self.rotate_report_buffers()
 
         return self.parse_report(buf)
 
@@ -80,66 +117,166 @@ class BluetoothDS4Device(DS4Device):
         self.ctl_sock.close()
 
 
+class DeviceConnector(object):
+    """Connects to the HID channels of a device without blocking.
+
+    The control channel is connected first and then the interrupt
+    channel, while the sockets are watched by a event loop. callback
+    is called with the address, the control and interrupt sockets and
+    None once both are connected, or with None for the sockets and a
+    DeviceError if connecting fails or takes longer than timeout.
+    """
+
+    def __init__(self, loop, addr, callback, timeout=CONNECT_TIMEOUT,
+                 create_socket=create_l2cap_socket):
+        self.loop = loop
+        self.addr = addr
+        self.callback = callback
+        self.create_socket = create_socket
+        self.socks = []
+        self.connecting = None
+        self.timer = loop.create_timer(timeout, self.timed_out)
+
+    def start(self):
+        self.timer.start()
+        self.connect_channel(L2CAP_PSM_HIDP_CTRL)
+
+    def connect_channel(self, psm):
+        try:
+            sock = self.create_socket()
+            self.socks.append(sock)
+            sock.setblocking(False)
+            err = sock.connect_ex((self.addr, psm))
+        except socket.error as err:
+            self.fail("Failed to connect: {0}", err)
+            return
+
+        if not err:
+            self.channel_connected()
+        elif err in (errno.EINPROGRESS, errno.EAGAIN):
+            self.connecting = sock
+            self.loop.add_watcher(sock, self.channel_ready, EPOLLOUT)
+        else:
+            self.fail("Failed to connect: {0}", os.strerror(err))
+
+    def channel_ready(self):
+        sock = self.connecting
+        self.loop.remove_watcher(sock)
+        self.connecting = None
+
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.fail("Failed to connect: {0}", os.strerror(err))
+        else:
+            self.channel_connected()
+
+    def channel_connected(self):
+        if len(self.socks) == 1:
+            self.connect_channel(L2CAP_PSM_HIDP_INTR)
+            return
+
+        self.timer.stop()
+
+        ctl_sock, int_sock = self.socks
+        ctl_sock.setblocking(True)
+        self.callback(self.addr, ctl_sock, int_sock, None)
+
+    def timed_out(self):
+        self.fail("Timed out after {0} seconds", self.timer.interval)
+
+    def fail(self, msg, *args):
+        self.timer.stop()
+
+        if self.connecting:
+            self.loop.remove_watcher(self.connecting)
+            self.connecting = None
+
+        for sock in self.socks:
+            sock.close()
+
+        self.socks = []
+        self.callback(self.addr, None, None, DeviceError(msg.format(*args)))
+
+
 class BluetoothBackend(Backend):
     __name__ = "bluetooth"
 
     def setup(self):
         """Check if the bluetooth controller is available."""
         try:
-            subprocess.check_output(["hcitool", "clock"],
-                                    stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            raise BackendError("'hcitool clock' returned error. Make sure "
-                               "your bluetooth device is powered up with "
-                               "'hciconfig hciX up'.")
-        except OSError:
-            raise BackendError("'hcitool' could not be found, make sure you "
-                               "have bluez-utils installed.")
-
-    def scan(self):
-        """Scan for bluetooth devices."""
+            self.sock = open_hci_socket(HCI_DEVICE)
+        except socket.error as err:
+            raise BackendError("Unable to open bluetooth device hci{0}: "
+                               "{1}".format(HCI_DEVICE, err))
+
         try:
-            res = subprocess.check_output(["hcitool", "scan", "--flush"],
-                                          stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-             raise BackendError("'hcitool scan' returned error. Make sure "
-                                "your bluetooth device is powered up with "
-                                "'hciconfig hciX up'.")
-
-        devices = []
-        res = res.splitlines()[1:]
-        for _, bdaddr, name in map(lambda l: l.split(b"\t"), res):
-            devices.append((bdaddr.decode("utf8"), name.decode("utf8")))
-
-        return devices
-
-    def find_device(self):
-        """Scan for bluetooth devices and return a DS4 device if found."""
-        for bdaddr, name in self.scan():
-            if name == "Wireless Controller":
-                self.logger.info("Found device {0}", bdaddr)
-                return BluetoothDS4Device.connect(bdaddr)
+            read_local_address(self.sock)
+        except (socket.error, HCIError) as err:
+            self.sock.close()
+            raise BackendError("Unable to use bluetooth device hci{0}: {1}. "
+                               "Make sure your bluetooth device is powered "
+                               "up with 'hciconfig hci{0} up'.".format(
+                               HCI_DEVICE, err))
+
+    def start_discovery(self, results):
+        """Runs discovery and connects to the found devices on a event
+        loop in a background thread.
+
+        Several devices may be connecting at the same time. Connection
+        results and errors are put in the results queue.
+        """
+        loop = EventLoop()
+        connectors = {}
+
+        def connected(addr, ctl_sock, int_sock, error):
+            connectors.pop(addr, None)
+            results.put((addr, ctl_sock, int_sock, error))
+
+        def found(addr, name, rssi):
+            if addr in connectors:
+                return
+
+            self.logger.info("Found device {0}", addr)
+            connector = DeviceConnector(loop, addr, connected)
+            connectors[addr] = connector
+            connector.start()
+
+        scanner = HCIScanner(loop, self.sock, found,
+                             lambda err: results.put(BackendError(err)))
+        loop.call_soon(scanner.start)
+
+        thread = Thread(target=loop.run)
+        thread.daemon = True
+        thread.start()
 
     @property
     def devices(self):
         """Wait for new DS4 devices to appear."""
-        log_msg = True
-        while True:
-            if log_msg:
-                self.logger.info("Scanning for devices")
+        results = Queue()
+        self.start_discovery(results)
 
-            try:
-                device = self.find_device()
-                if device:
-                    yield device
-                    log_msg = True
-                else:
-                    log_msg = False
-            except BackendError as err:
+        self.logger.info("Scanning for devices")
+        while True:
+            result = results.get()
+            if isinstance(result, BackendError):
                 self.logger.error("Error while scanning for devices: {0}",
-                                  err)
+                                  result)
                 return
+
+            addr, ctl_sock, int_sock, error = result
+            if error:
+                self.logger.error("Unable to connect to detected device "
+                                  "{0}: {1}", addr, error)
+                continue
+
+            try:
+                device = BluetoothDS4Device(addr, ctl_sock, int_sock)
             except DeviceError as err:
-                self.logger.error("Unable to connect to detected device: {0}",
-                                  err)
+                ctl_sock.close()
+                int_sock.close()
+                self.logger.error("Unable to connect to detected device "
+                                  "{0}: {1}", addr, err)
+                continue
 
+            yield device
+            self.logger.info("Scanning for devices")
@@ -0,0 +1,389 @@
+"""Bluetooth device discovery over a raw HCI socket.
+
+Inquiries are started by sending HCI commands to the adapter and the
+results arrive as HCI events on the same socket, so discovery can be
+driven by a event loop instead of waiting on a subprocess. Names of
+devices that do not include one in an extended inquiry result are
+looked up with remote name requests once each inquiry is complete.
+"""
+
+import errno
+import select
+import socket
+
+from collections import deque
+from struct import Struct
+
+
+AF_BLUETOOTH = getattr(socket, "AF_BLUETOOTH", 31)
+BTPROTO_HCI = getattr(socket, "BTPROTO_HCI", 1)
+SOL_HCI = getattr(socket, "SOL_HCI", 0)
+HCI_FILTER = getattr(socket, "HCI_FILTER", 2)
+
+HCI_DEVICE = 0
+
+HCI_COMMAND_PKT = 0x01
+HCI_EVENT_PKT = 0x04
+HCI_MAX_EVENT_SIZE = 260
+
+
+def hci_opcode(ogf, ocf):
+    return (ogf << 10) | ocf
+
+
+OP_INQUIRY = hci_opcode(0x01, 0x0001)
+OP_INQUIRY_CANCEL = hci_opcode(0x01, 0x0002)
+OP_REMOTE_NAME_REQUEST = hci_opcode(0x01, 0x0019)
+OP_WRITE_INQUIRY_MODE = hci_opcode(0x03, 0x0045)
+OP_READ_BD_ADDR = hci_opcode(0x04, 0x0009)
+
+EVT_INQUIRY_COMPLETE = 0x01
+EVT_INQUIRY_RESULT = 0x02
+EVT_REMOTE_NAME_REQUEST_COMPLETE = 0x07
+EVT_COMMAND_COMPLETE = 0x0E
+EVT_COMMAND_STATUS = 0x0F
+EVT_INQUIRY_RESULT_WITH_RSSI = 0x22
+EVT_EXTENDED_INQUIRY_RESULT = 0x2F
+
+HCI_EVENTS = (EVT_INQUIRY_COMPLETE, EVT_INQUIRY_RESULT,
+              EVT_REMOTE_NAME_REQUEST_COMPLETE, EVT_COMMAND_COMPLETE,
+              EVT_COMMAND_STATUS, EVT_INQUIRY_RESULT_WITH_RSSI,
+              EVT_EXTENDED_INQUIRY_RESULT)
+
+# General inquiry access code, finds all discoverable devices
+GIAC_LAP = (0x33, 0x8B, 0x9E)
+
+# Length of each inquiry in units of 1.28 seconds, the same as
+# 'hcitool scan' uses.
+INQUIRY_LENGTH = 8
+
+INQUIRY_MODE_EXTENDED = 0x02
+
+EIR_NAME_SHORT = 0x08
+EIR_NAME_COMPLETE = 0x09
+
+DS4_NAME = "Wireless Controller"
+
+COMMAND_HEADER = Struct("<BHB")
+EVENT_HEADER = Struct("<BBB")
+FILTER = Struct("<IIIH")
+COMMAND_COMPLETE = Struct("<BH")
+COMMAND_STATUS = Struct("<BBH")
+INQUIRY_RESULT = Struct("<6sBBB3sH")
+INQUIRY_RESULT_WITH_RSSI = Struct("<6sBB3sHb")
+EXTENDED_INQUIRY_RESULT = Struct("<B6sBB3sHb")
+REMOTE_NAME_REQUEST = Struct("<6sBBH")
+REMOTE_NAME_REQUEST_COMPLETE = Struct("<B6s")
+
+
+class HCIError(Exception):
+    """HCI related errors."""
+
+
+def format_address(data):
+    return ":".join("{0:02X}".format(c) for c in reversed(bytearray(data)))
+
+
+def parse_address(addr):
+    return bytes(bytearray(reversed([int(c, 16) for c in addr.split(":")])))
+
+
+def decode_name(data):
+    return bytes(data).split(b"\0", 1)[0].decode("utf8", "replace")
+
+
+def parse_eir_name(eir):
+    """Returns the device name in extended inquiry response data."""
+    name = None
+    offset = 0
+
+    while offset < len(eir):
+        length = eir[offset]
+        if not length or offset + length >= len(eir):
+            break
+
+        data_type = eir[offset + 1]
+        data = eir[offset + 2:offset + 1 + length]
+        if data_type == EIR_NAME_COMPLETE:
+            return decode_name(data)
+        elif data_type == EIR_NAME_SHORT:
+            name = decode_name(data)
+
+        offset += length + 1
+
+    return name
+
+
+def open_hci_socket(device=HCI_DEVICE):
+    """Opens a raw HCI socket receiving the events used for discovery."""
+    sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+
+    try:
+        sock.bind((device,))
+
+        event_mask = [0, 0]
+        for event in HCI_EVENTS:
+            event_mask[event >> 5] |= 1 << (event & 31)
+
+        sock.setsockopt(SOL_HCI, HCI_FILTER,
+                        FILTER.pack(1 << HCI_EVENT_PKT, event_mask[0],
+                                    event_mask[1], 0))
+    except socket.error:
+        sock.close()
+        raise
+
+    return sock
+
+
+def send_command(sock, opcode, params=b""):
+    sock.send(COMMAND_HEADER.pack(HCI_COMMAND_PKT, opcode, len(params)) +
+              bytes(params))
+
+
+def read_local_address(sock, timeout=1):
+    """Reads the address of the adapter, waiting for the response.
+
+    Used to check if the adapter is available and powered up.
+    """
+    send_command(sock, OP_READ_BD_ADDR)
+
+    while True:
+        ready, _, _ = select.select([sock], [], [], timeout)
+        if not ready:
+            raise HCIError("Timed out waiting for the adapter")
+
+        data = bytearray(sock.recv(HCI_MAX_EVENT_SIZE))
+        if len(data) < 10 or data[0] != HCI_EVENT_PKT:
+            continue
+
+        if data[1] != EVT_COMMAND_COMPLETE:
+            continue
+
+        ncmd, opcode = COMMAND_COMPLETE.unpack_from(data, 3)
+        if opcode != OP_READ_BD_ADDR:
+            continue
+
+        status = data[6]
+        if status:
+            raise HCIError("Reading the adapter address failed with "
+                           "status 0x{0:02x}".format(status))
+
+        return format_address(data[7:13])
+
+
+class HCIScanner(object):
+    """Finds devices with a name by running inquiries back to back.
+
+    The socket is watched by a event loop and callback is called with
+    the address, name and RSSI (None if unknown) of each device with a
+    matching name found by a inquiry. error_callback is called with a
+    message if discovery fails and has stopped.
+    """
+
+    def __init__(self, loop, sock, callback, error_callback,
+                 name=DS4_NAME, inquiry_length=INQUIRY_LENGTH):
+        self.loop = loop
+        self.sock = sock
+        self.callback = callback
+        self.error_callback = error_callback
+        self.name = name
+        self.inquiry_length = inquiry_length
+
+        self.names = {}
+        self.name_requests = deque()
+        self.requesting = None
+        self.inquiring = False
+        self.reported = set()
+        self.running = False
+
+        self.handlers = {
+            EVT_INQUIRY_COMPLETE: self.handle_inquiry_complete,
+            EVT_INQUIRY_RESULT: self.handle_inquiry_result,
+            EVT_INQUIRY_RESULT_WITH_RSSI: self.handle_inquiry_result_rssi,
+            EVT_EXTENDED_INQUIRY_RESULT: self.handle_extended_result,
+            EVT_REMOTE_NAME_REQUEST_COMPLETE: self.handle_remote_name,
+            EVT_COMMAND_STATUS: self.handle_command_status,
+        }
+
+    def start(self):
+        """Starts discovery, must be called from the loop's thread."""
+        self.sock.setblocking(False)
+        self.loop.add_watcher(self.sock, self.read_events)
+        self.running = True
+
+        # Extended results include the name, which saves a remote name
+        # request per device. Only privileged users may change the
+        # mode, so the names are requested if this fails.
+        try:
+            send_command(self.sock, OP_WRITE_INQUIRY_MODE,
+                         bytearray((INQUIRY_MODE_EXTENDED,)))
+        except socket.error as err:
+            if err.errno != errno.EPERM:
+                self.error("Unable to set inquiry mode: {0}", err)
+                return
+
+        self.start_inquiry()
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.running = False
+        self.loop.remove_watcher(self.sock)
+
+        if self.inquiring:
+            try:
+                send_command(self.sock, OP_INQUIRY_CANCEL)
+            except socket.error:
+                pass
+
+    def error(self, msg, *args):
+        self.stop()
+        self.error_callback(msg.format(*args))
+
+    def send(self, opcode, params=b""):
+        try:
+            send_command(self.sock, opcode, params)
+        except socket.error as err:
+            self.error("Unable to send command to the adapter: {0}", err)
+            return False
+
+        return True
+
+    def start_inquiry(self):
+        self.inquiring = True
+        self.reported.clear()
+        self.send(OP_INQUIRY, bytearray(GIAC_LAP + (self.inquiry_length, 0)))
+
+    def request_next_name(self):
+        """Requests the next queued name, or starts the next inquiry."""
+        if self.name_requests:
+            addr, page_scan_mode, clock_offset, rssi = \
+                self.name_requests.popleft()
+            self.requesting = (addr, rssi)
+
+            params = REMOTE_NAME_REQUEST.pack(parse_address(addr),
+                                              page_scan_mode, 0,
+                                              clock_offset | 0x8000)
+            self.send(OP_REMOTE_NAME_REQUEST, params)
+        elif self.running:
+            self.start_inquiry()
+
+    def read_events(self):
+        while self.running:
+            try:
+                data = self.sock.recv(HCI_MAX_EVENT_SIZE)
+            except socket.error as err:
+                if err.errno != errno.EAGAIN:
+                    self.error("Unable to read from the adapter: {0}", err)
+                return
+
+            if not data:
+                self.error("The adapter was closed")
+                return
+
+            self.handle_packet(bytearray(data))
+
+    def handle_packet(self, data):
+        if len(data) < EVENT_HEADER.size or data[0] != HCI_EVENT_PKT:
+            return
+
+        packet_type, event, length = EVENT_HEADER.unpack_from(data)
+        handler = self.handlers.get(event)
+        if handler:
+            handler(data[EVENT_HEADER.size:EVENT_HEADER.size + length])
+
+    def found(self, addr, page_scan_mode, clock_offset, rssi, name=None):
+        if name:
+            self.names[addr] = name
+        else:
+            name = self.names.get(addr)
+
+        if name is None:
+            queued = [request[0] for request in self.name_requests]
+            if addr not in queued:
+                self.name_requests.append((addr, page_scan_mode,
+                                           clock_offset, rssi))
+        elif name == self.name and addr not in self.reported:
+            self.reported.add(addr)
+            self.callback(addr, name, rssi)
+
+    def handle_inquiry_result(self, params):
+        for i in range(params[0] if params else 0):
+            offset = 1 + i * INQUIRY_RESULT.size
+            if offset + INQUIRY_RESULT.size > len(params):
+                break
+
+            (addr, page_scan_mode, period_mode, mode, device_class,
+             clock_offset) = INQUIRY_RESULT.unpack_from(params, offset)
+            self.found(format_address(addr), page_scan_mode, clock_offset,
+                       None)
+
+    def handle_inquiry_result_rssi(self, params):
+        for i in range(params[0] if params else 0):
+            offset = 1 + i * INQUIRY_RESULT_WITH_RSSI.size
+            if offset + INQUIRY_RESULT_WITH_RSSI.size > len(params):
+                break
+
+            (addr, page_scan_mode, period_mode, device_class, clock_offset,
+             rssi) = INQUIRY_RESULT_WITH_RSSI.unpack_from(params, offset)
+            self.found(format_address(addr), page_scan_mode, clock_offset,
+                       rssi)
+
+    def handle_extended_result(self, params):
+        if len(params) < EXTENDED_INQUIRY_RESULT.size:
+            return
+
+        (count, addr, page_scan_mode, reserved, device_class, clock_offset,
+         rssi) = EXTENDED_INQUIRY_RESULT.unpack_from(params)
+        name = parse_eir_name(params[EXTENDED_INQUIRY_RESULT.size:])
+        self.found(format_address(addr), page_scan_mode, clock_offset, rssi,
+                   name)
+
+    def handle_inquiry_complete(self, params):
+        if not self.inquiring:
+            return
+
+        self.inquiring = False
+        if params and params[0]:
+            self.error("Inquiry failed with status 0x{0:02x}", params[0])
+            return
+
+        if not self.requesting:
+            self.request_next_name()
+
+    def handle_remote_name(self, params):
+        if len(params) < REMOTE_NAME_REQUEST_COMPLETE.size:
+            return
+
+        status, addr = REMOTE_NAME_REQUEST_COMPLETE.unpack_from(params)
+        addr = format_address(addr)
+
+        if not self.requesting or self.requesting[0] != addr:
+            return
+
+        rssi = self.requesting[1]
+        self.requesting = None
+
+        # Devices that did not respond are asked again after the next
+        # inquiry, if they are still around.
+        if not status:
+            name = decode_name(params[REMOTE_NAME_REQUEST_COMPLETE.size:])
+            self.found(addr, 0, 0, rssi, name)
+
+        self.request_next_name()
+
+    def handle_command_status(self, params):
+        if len(params) < COMMAND_STATUS.size:
+            return
+
+        status, ncmd, opcode = COMMAND_STATUS.unpack_from(params)
+        if not status:
+            return
+
+        if opcode == OP_INQUIRY:
+            self.inquiring = False
+            self.error("Inquiry failed with status 0x{0:02x}", status)
+        elif opcode == OP_REMOTE_NAME_REQUEST and self.requesting:
+            self.requesting = None
+            self.request_next_name()
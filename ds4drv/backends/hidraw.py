@@ -1,16 +1,16 @@
+import errno
 import fcntl
-import itertools
 import os
 
 from io import FileIO
-from time import sleep
 
 from evdev import InputDevice
 from pyudev import Context, Monitor
 
 from ..backend import Backend
 from ..exceptions import DeviceError
-from ..device import DS4Device
+from ..device import DS4Device, buttons_changed
+from ..eventloop import monotonic
 from ..utils import zero_copy_slice
 
 
@@ -18,6 +18,13 @@ IOC_RW = 3221243904
 HIDIOCSFEATURE = lambda size: IOC_RW | (0x06 << 0) | (size << 16)
 HIDIOCGFEATURE = lambda size: IOC_RW | (0x07 << 0) | (size << 16)
 
+# A device that is not ready to be opened when it is added is tried
+# again after HOTPLUG_RETRY_DELAY, doubling the delay between each try
+# up to HOTPLUG_MAX_RETRY_DELAY, until HOTPLUG_TIMEOUT has passed.
+HOTPLUG_RETRY_DELAY = 0.005
+HOTPLUG_MAX_RETRY_DELAY = 0.25
+HOTPLUG_TIMEOUT = 5
+
 
 class HidrawDS4Device(DS4Device):
     def __init__(self, name, addr, type, hidraw_device, event_device):
@@ -29,10 +36,40 @@ class HidrawDS4Device(DS4Device):
         except (OSError, IOError) as err:
             raise DeviceError(err)
 
-        self.buf = bytearray(self.report_size)
+        self.create_report_buffers(self.report_size)
 
         super(HidrawDS4Device, self).__init__(name, addr, type)
 
+    def export_fds(self):
+        return [self.report_fd]
+
+    def import_fds(self, fds):
+        self.report_fd = fds[0]
+        self.fd = FileIO(self.report_fd, "rb+", closefd=False)
+        self.input_device = None
+        self.create_report_buffers(self.report_size)
+
+    def _read_into_buffer(self):
+        """Reads a report into the current buffer.
+
+        Returns the number of bytes read, None if no report is pending
+        or 0 on disconnection.
+        """
+        try:
+            return self.fd.readinto(self.buf)
+        except IOError as err:
+            if err.errno == errno.EAGAIN:
+                return None
+
+            return 0
+
+    def _report_data(self, buf):
+        if self.type == "bluetooth":
+            # Cut off bluetooth data
+            return zero_copy_slice(buf, 2)
+
+        return buf
+
     def read_report(self):
         try:
             ret = self.fd.readinto(self.buf)
@@ -45,16 +82,58 @@ class HidrawDS4Device(DS4Device):
 
         # Invalid report size or id, just ignore it
         if ret < self.report_size or self.buf[0] != self.valid_report_id:
+            self.invalid_reports += 1
             return False
 
-        if self.type == "bluetooth":
-            # Cut off bluetooth data
-            buf = zero_copy_slice(self.buf, 2)
-        else:
-            buf = self.buf
+        buf = self._report_data(self.buf)
+        self.rotate_report_buffers()
 
         return self.parse_report(buf)
 
+    def read_reports(self, coalesce=False):
+        """Reads reports until no more are pending.
+
+        If coalesce is True, a report that has been superseded by a newer
+        one is dropped, unless a button changed in it.
+        """
+        pending = None
+
+        while True:
+            ret = self._read_into_buffer()
+
+            # No more reports
+            if ret is None:
+                break
+
+            # Disconnection
+            if ret == 0:
+                yield None
+                return
+
+            # Invalid report size or id, just ignore it
+            if ret < self.report_size or self.buf[0] != self.valid_report_id:
+                self.invalid_reports += 1
+                continue
+
+            if pending is not None:
+                last_report = self.last_report_buf
+                pending_data = self._report_data(pending)
+                stale = (coalesce and last_report is not None and
+                         not buttons_changed(pending_data, last_report))
+
+                if stale:
+                    self.release_report_buffer(pending)
+                    self.coalesced_reports += 1
+                else:
+                    self.deliver_report_buffer(pending)
+                    yield self.parse_report(pending_data)
+
+            pending = self.hold_report_buffer()
+
+        if pending is not None:
+            self.deliver_report_buffer(pending)
+            yield self.parse_report(self._report_data(pending))
+
     def read_feature_report(self, report_id, size):
         op = HIDIOCGFEATURE(size + 1)
         buf = bytearray(size + 1)
@@ -72,8 +151,13 @@ class HidrawDS4Device(DS4Device):
             self.set_led(0, 0, 1)
 
             self.fd.close()
-            self.input_device.ungrab()
-        except IOError:
+
+            # Imported devices leave the grab to the exporting process
+            if self.input_device:
+                self.input_device.ungrab()
+
+            os.close(self.report_fd)
+        except (OSError, IOError):
             pass
 
 
@@ -110,70 +194,146 @@ HID_DEVICES = {
 }
 
 
+class PendingDevice(object):
+    """A hidraw device waiting to become ready to be opened."""
+
+    def __init__(self, hidraw_device, now):
+        self.hidraw_device = hidraw_device
+        self.deadline = now + HOTPLUG_TIMEOUT
+        self.next_try = now
+        self.delay = HOTPLUG_RETRY_DELAY
+
+    def retry(self, now):
+        """Schedules the next try, backing off exponentially."""
+        self.next_try = now + self.delay
+        self.delay = min(self.delay * 2, HOTPLUG_MAX_RETRY_DELAY)
+
+
 class HidrawBackend(Backend):
     __name__ = "hidraw"
 
     def setup(self):
         pass
 
-    def _get_future_devices(self, context):
-        """Return a generator yielding new devices."""
-        monitor = Monitor.from_netlink(context)
-        monitor.filter_by("hidraw")
-        monitor.start()
-
-        self._scanning_log_message()
-        for device in iter(monitor.poll, None):
-            if device.action == "add":
-                # Sometimes udev rules has not been applied at this point,
-                # causing permission denied error if we are running in user
-                # mode. With this sleep this will hopefully not happen.
-                sleep(1)
-
-                yield device
-                self._scanning_log_message()
-
     def _scanning_log_message(self):
         self.logger.info("Scanning for devices")
 
-    @property
-    def devices(self):
-        """Wait for new DS4 devices to appear."""
-        context = Context()
+    def _probe_device(self, hidraw_device):
+        """Checks if a hidraw device is a DS4 that can be opened.
 
-        existing_devices = context.list_devices(subsystem="hidraw")
-        future_devices = self._get_future_devices(context)
+        Returns the device class, HID device and event device, None if
+        it is not a DS4 or False if it is not ready yet.
+        """
+        hid_device = hidraw_device.parent
+        if not hid_device or hid_device.subsystem != "hid":
+            return
 
-        for hidraw_device in itertools.chain(existing_devices, future_devices):
-            hid_device = hidraw_device.parent
-            if hid_device.subsystem != "hid":
-                continue
+        cls = HID_DEVICES.get(hid_device.get("HID_NAME"))
+        if not cls:
+            return
 
-            cls = HID_DEVICES.get(hid_device.get("HID_NAME"))
-            if not cls:
-                continue
+        # The event device may be created after the hidraw device
+        for child in hid_device.parent.children:
+            event_device = child.get("DEVNAME", "")
+            if event_device.startswith("/dev/input/event"):
+                break
+        else:
+            return False
 
-            for child in hid_device.parent.children:
-                event_device = child.get("DEVNAME", "")
-                if event_device.startswith("/dev/input/event"):
-                    break
+        # Sometimes udev rules have not been applied yet, which would
+        # cause a permission denied error if we are running in user
+        # mode.
+        hidraw_node = hidraw_device.device_node
+        if not (hidraw_node and os.access(hidraw_node, os.R_OK | os.W_OK) and
+                os.access(event_device, os.R_OK)):
+            return False
+
+        return cls, hid_device, event_device
+
+    def _open_device(self, hidraw_device, cls, hid_device, event_device):
+        try:
+            device_addr = hid_device.get("HID_UNIQ", "").upper()
+            if device_addr:
+                device_name = "{0} {1}".format(device_addr,
+                                               hidraw_device.sys_name)
             else:
+                device_name = hidraw_device.sys_name
+
+            return cls(name=device_name,
+                       addr=device_addr,
+                       type=cls.__type__,
+                       hidraw_device=hidraw_device.device_node,
+                       event_device=event_device)
+
+        except DeviceError as err:
+            self.logger.error("Unable to open DS4 device: {0}", err)
+
+    def _open_pending_devices(self, pending):
+        """Opens the pending devices that are ready.
+
+        Devices that are not ready are tried again later, until they
+        time out.
+        """
+        now = monotonic()
+        for sys_path, entry in list(pending.items()):
+            if entry.next_try > now:
                 continue
 
+            probe = self._probe_device(entry.hidraw_device)
+            if probe is False:
+                if now < entry.deadline:
+                    entry.retry(now)
+                    continue
 
-            try:
-                device_addr = hid_device.get("HID_UNIQ", "").upper()
-                if device_addr:
-                    device_name = "{0} {1}".format(device_addr,
-                                                   hidraw_device.sys_name)
-                else:
-                    device_name = hidraw_device.sys_name
+                self.logger.warning("Timed out waiting for {0} to become "
+                                    "accessible", entry.hidraw_device.sys_name)
 
-                yield cls(name=device_name,
-                          addr=device_addr,
-                          type=cls.__type__,
-                          hidraw_device=hidraw_device.device_node,
-                          event_device=event_device)
+            del pending[sys_path]
+
+            if probe:
+                device = self._open_device(entry.hidraw_device, *probe)
+                if device:
+                    yield device
+
+    @property
+    def devices(self):
+        """Wait for new DS4 devices to appear.
+
+        Devices are opened as soon as they are ready, several devices
+        plugged in at the same time are waited for in parallel.
+        """
+        context = Context()
+
+        # Start monitoring before listing the existing devices, so no
+        # device added in between is missed.
+        monitor = Monitor.from_netlink(context)
+        monitor.filter_by("hidraw")
+        monitor.start()
+
+        now = monotonic()
+        pending = dict((device.sys_path, PendingDevice(device, now))
+                       for device in context.list_devices(subsystem="hidraw"))
+
+        self._scanning_log_message()
+        while True:
+            for device in self._open_pending_devices(pending):
+                yield device
+                self._scanning_log_message()
+
+            timeout = None
+            if pending:
+                next_try = min(entry.next_try for entry in pending.values())
+                timeout = max(next_try - monotonic(), 0)
+
+            hidraw_device = monitor.poll(timeout)
+            if not hidraw_device:
+                continue
 
-            except DeviceError as err:
-                self.logger.error("Unable to open DS4 device: {0}", err)
+            sys_path = hidraw_device.sys_path
+            if hidraw_device.action == "add":
+                pending[sys_path] = PendingDevice(hidraw_device, monotonic())
+            elif hidraw_device.action == "change" and sys_path in pending:
+                # Permissions may have changed, try again right away
+                pending[sys_path].next_try = monotonic()
+            elif hidraw_device.action == "remove":
+                pending.pop(sys_path, None)
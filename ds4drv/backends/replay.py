@@ -0,0 +1,138 @@
+import errno
+import os
+import socket
+import time
+
+from threading import Event, Thread
+
+from ..backend import Backend
+from ..device import DS4Device, REPORT_STRUCT
+from ..exceptions import BackendError
+from ..recording import RecordingError, read_recording
+from ..utils import zero_copy_slice
+
+# Large enough for any report, recorded reports are at most 78 bytes.
+REPORT_SIZE = 128
+
+
+class ReplayDS4Device(DS4Device):
+    """A device reading recorded reports from a socket."""
+
+    def __init__(self, name, type, sock):
+        self.sock = sock
+        self.report_fd = sock.fileno()
+        self.closed = Event()
+        self.create_report_buffers(REPORT_SIZE)
+
+        super(ReplayDS4Device, self).__init__(name, "", type)
+
+    def export_fds(self):
+        return [self.sock.fileno()]
+
+    def import_fds(self, fds):
+        self.sock = socket.fromfd(fds[0], socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.setblocking(False)
+        os.close(fds[0])
+
+        self.report_fd = self.sock.fileno()
+        self.closed = Event()
+        self.create_report_buffers(REPORT_SIZE)
+
+    def read_report(self):
+        try:
+            ret = self.sock.recv_into(self.buf)
+        except socket.error as err:
+            if err.errno == errno.EAGAIN:
+                return False
+            return
+
+        # End of the recording
+        if ret == 0:
+            return
+
+        # Invalid report size, just ignore it
+        if ret < REPORT_STRUCT.size:
+            self.invalid_reports += 1
+            return False
+
+        buf = zero_copy_slice(self.buf, 0, ret)
+        self.rotate_report_buffers()
+
+        return self.parse_report(buf)
+
+    def set_operational(self):
+        pass
+
+    def write_report(self, report_id, data):
+        pass
+
+    def close(self):
+        self.sock.close()
+        self.closed.set()
+
+
+class ReplayBackend(Backend):
+    """Replays reports recorded with --record-reports.
+
+    The reports are sent through a socket, so they pass through the
+    same event loop, actions and uinput devices as reports read from
+    a real device.
+    """
+
+    __name__ = "replay"
+
+    def __init__(self, manager, filename, realtime=True):
+        super(ReplayBackend, self).__init__(manager)
+
+        self.filename = filename
+        self.realtime = realtime
+
+    def setup(self):
+        try:
+            self.type, self.reports = read_recording(self.filename)
+        except RecordingError as err:
+            raise BackendError("Unable to read recording: {0}".format(err))
+
+    def feed(self, sock):
+        """Sends the reports to the device, then closes the socket."""
+        start = time.time()
+        first = self.reports and self.reports[0][0]
+
+        for timestamp, report in self.reports:
+            if self.realtime:
+                delay = (timestamp - first) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            try:
+                sock.send(report)
+            except socket.error:
+                break
+
+        sock.close()
+
+    @property
+    def devices(self):
+        """Yields a device replaying the recording.
+
+        Returns once the device has been closed, after the whole
+        recording has been replayed.
+        """
+        sock, device_sock = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_SEQPACKET)
+        device_sock.setblocking(False)
+
+        name = os.path.basename(self.filename)
+        device = ReplayDS4Device(name, self.type, device_sock)
+
+        self.logger.info("Replaying {0} reports from {1}",
+                         len(self.reports), self.filename)
+
+        thread = Thread(target=self.feed, args=(sock,))
+        thread.daemon = True
+        thread.start()
+
+        yield device
+
+        device.closed.wait()
+        self.logger.info("Replay finished")
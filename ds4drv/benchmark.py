@@ -0,0 +1,318 @@
+"""Benchmarks for the report processing pipeline.
+
+A stub uinput device is used, so neither hardware nor access to
+/dev/uinput is needed. Each stage of the pipeline is measured on its
+own, followed by the whole pipeline for a number of simulated
+controllers. Results are printed as JSON. Run with:
+
+    $ python -m ds4drv.benchmark
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import time
+
+from . import __version__, uinput
+from .__main__ import DS4Controller
+from .action import ReportAction
+from .actions import ActionRegistry
+from .actions.binding import ReportActionBinding
+from .config import parser as options_parser
+from .device import DS4Device
+from .eventloop import EventLoop
+from .utils import parse_button_combo
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    clock = time.time
+
+MAPPINGS = ("ds4", "xboxdrv", "xpad", "xpad_wireless", "mouse")
+CONTROLLERS = (1, 4, 16)
+
+# Bindings used by the simulated controllers, the actions are cheap
+# no-ops since the matching is what is being measured.
+BINDINGS = {
+    "PS+Cross": "load-profile default",
+    "PS+Circle": "load-profile default",
+    "PS+Square": "next-profile",
+    "PS+Triangle": "prev-profile",
+    "L1+R1+Options": "load-profile default",
+    "L2+R2+Share": "load-profile default",
+    "Up+Cross": "next-profile",
+    "Down+Circle": "prev-profile",
+}
+
+PERCENTILES = (50, 90, 99)
+
+
+class NullUInput(object):
+    """Stands in for evdev.UInput and writes all events to /dev/null."""
+
+    def __init__(self, *args, **kwargs):
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+        self.device = None
+
+    def write(self, etype, code, value):
+        pass
+
+    def syn(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def generate_reports(count, seed=0):
+    """Generates raw USB reports resembling a controller in use.
+
+    The sticks and motion sensors move a bit in every report, while
+    buttons are pressed and released now and then.
+    """
+    rand = random.Random(seed)
+    buf = bytearray(64)
+    buf[0] = 0x01
+    buf[1:5] = bytearray((128, 128, 128, 128))
+    buf[5] = 8
+    buf[30] = 0x08
+
+    reports = []
+    for i in range(count):
+        for offset in (1, 2, 3, 4):
+            buf[offset] = max(0, min(255, buf[offset] + rand.randint(-3, 3)))
+
+        for offset in range(13, 25):
+            buf[offset] = rand.getrandbits(8)
+
+        if rand.random() < 0.05:
+            buf[5] = (buf[5] & 0x0f) | (rand.getrandbits(4) << 4)
+            buf[6] = rand.getrandbits(8) & rand.getrandbits(8)
+
+        # Timestamp
+        buf[7] = (buf[7] + 4) & 0xff
+
+        reports.append(bytearray(buf))
+
+    return reports
+
+
+def percentile(samples, percent):
+    """Returns a percentile of a sorted list of samples."""
+    index = int(round((len(samples) - 1) * percent / 100.0))
+    return samples[index]
+
+
+def measure(func, items, repeat):
+    """Measures func called with each item.
+
+    The throughput is taken from the best of repeat runs, the latency
+    percentiles from a separate run timing each call.
+    """
+    best = None
+    for i in range(repeat):
+        start = clock()
+        for item in items:
+            func(item)
+        elapsed = clock() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    latencies = []
+    for item in items:
+        start = clock()
+        func(item)
+        latencies.append(clock() - start)
+
+    latencies.sort()
+    latency = dict(("p{0}".format(p), round(percentile(latencies, p) * 1e6, 3))
+                   for p in PERCENTILES)
+    latency["max"] = round(latencies[-1] * 1e6, 3)
+
+    return {
+        "reports_per_second": round(len(items) / best),
+        "us_per_report": round(best / len(items) * 1e6, 3),
+        "latency_us": latency,
+    }
+
+
+def create_options(mapping):
+    """Creates controller options using a mapping and BINDINGS."""
+    options = options_parser.parse_args(["--mapping", mapping,
+                                         "--next-controller"])
+    options.bindings = {
+        "global": dict((parse_button_combo(combo), action)
+                       for combo, action in BINDINGS.items())
+    }
+    options.profiles = {}
+
+    controller_options = options.controllers[0]
+    controller_options.parent = options
+
+    return controller_options
+
+
+def create_controllers(count, mapping):
+    """Creates controllers, each with its own device."""
+    options = create_options(mapping)
+    controllers = []
+    for index in range(count):
+        controller = DS4Controller(index + 1, options)
+        device = DS4Device("benchmark {0}".format(index + 1), "", "usb")
+
+        # There is no fd to watch, so only let the actions set up
+        controller.device = device
+        controller.fire_event("device-setup", device)
+
+        controllers.append((controller, device))
+
+    return controllers
+
+
+def close_controllers(controllers):
+    for controller, device in controllers:
+        controller.fire_event("device-cleanup")
+        controller.device = None
+        for action in controller.actions:
+            for attr in ("joystick", "mouse"):
+                dev = getattr(action, attr, None)
+                if dev:
+                    dev.device.close()
+
+
+def bench_parse(reports, repeat):
+    """Measures DS4Device.parse_report."""
+    device = DS4Device("benchmark", "", "usb")
+
+    return measure(device.parse_report, reports, repeat)
+
+
+def bench_fire_event(reports, repeat):
+    """Measures EventLoop.fire_event with a handler per report action."""
+    loop = EventLoop()
+    handlers = [cls for cls in ActionRegistry.actions
+                if issubclass(cls, ReportAction)]
+    for cls in handlers:
+        loop.register_event("device-report", lambda report: None)
+
+    device = DS4Device("benchmark", "", "usb")
+    views = [device.parse_report(buf) for buf in reports]
+
+    def run(report, fire_event=loop.fire_event):
+        fire_event("device-report", report)
+
+    result = measure(run, views, repeat)
+    result["handlers"] = len(handlers)
+
+    return result
+
+
+def bench_binding(reports, repeat):
+    """Measures ReportActionBinding.handle_report with BINDINGS."""
+    controller, device = create_controllers(1, "ds4")[0]
+    action = [a for a in controller.actions
+              if isinstance(a, ReportActionBinding)][0]
+
+    def run(buf):
+        action.handle_report(device.parse_report(buf))
+
+    result = measure(run, reports, repeat)
+    result["bindings"] = len(action.bindings)
+    close_controllers([(controller, device)])
+
+    return result
+
+
+def bench_emit(mapping, reports, repeat):
+    """Measures UInputDevice.emit for a mapping."""
+    device = DS4Device("benchmark", "", "usb")
+    joystick = uinput.create_uinput_device(mapping)
+
+    def run(buf):
+        joystick.emit(device.parse_report(buf))
+
+    result = measure(run, reports, repeat)
+    joystick.device.close()
+
+    return result
+
+
+def bench_pipeline(mapping, count, reports, repeat):
+    """Measures the whole pipeline for a number of controllers.
+
+    Every report is parsed and fired as a device-report event on each
+    controller in turn, as a shared event loop would.
+    """
+    controllers = create_controllers(count, mapping)
+    items = [(controller.loop.fire_event, device.parse_report, buf)
+             for buf in reports
+             for controller, device in controllers]
+
+    def run(item):
+        fire_event, parse_report, buf = item
+        fire_event("device-report", parse_report(buf))
+
+    result = measure(run, items, repeat)
+    close_controllers(controllers)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m ds4drv.benchmark")
+    parser.add_argument("--reports", type=int, default=2000,
+                        help="Number of reports to generate")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of runs, the best one is reported")
+    parser.add_argument("--mappings", default=",".join(MAPPINGS),
+                        help="Comma-separated list of mappings to measure")
+    parser.add_argument("--controllers",
+                        default=",".join(map(str, CONTROLLERS)),
+                        help="Comma-separated list of controller counts to "
+                             "measure the whole pipeline with")
+    parser.add_argument("--output", metavar="filename",
+                        help="Write the results to a file instead of stdout")
+    args = parser.parse_args()
+
+    mappings = [m.strip() for m in args.mappings.split(",") if m.strip()]
+    counts = [int(c) for c in args.controllers.split(",") if c.strip()]
+
+    uinput.UInput = NullUInput
+    reports = generate_reports(args.reports)
+
+    results = {
+        "info": {
+            "ds4drv": __version__,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "reports": args.reports,
+            "repeat": args.repeat,
+        },
+        "parse": bench_parse(reports, args.repeat),
+        "fire_event": bench_fire_event(reports, args.repeat),
+        "binding": bench_binding(reports, args.repeat),
+        "emit": {},
+        "pipeline": {},
+    }
+
+    for mapping in mappings:
+        results["emit"][mapping] = bench_emit(mapping, reports, args.repeat)
+        results["pipeline"][mapping] = {}
+
+        for count in counts:
+            result = bench_pipeline(mapping, count, reports, args.repeat)
+            results["pipeline"][mapping][str(count)] = result
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -57,14 +57,36 @@ backendopt.add_argument("--hidraw", action="store_true",
                              "USB and paired bluetooth devices. Note: "
                              "Bluetooth devices does currently not support "
                              "any LED functionality")
+backendopt.add_argument("--replay", metavar="filename",
+                        type=os.path.expanduser,
+                        help="Replays reports recorded with "
+                             "--record-reports instead of using a real "
+                             "device. ds4drv exits once the recording "
+                             "has been replayed")
+backendopt.add_argument("--replay-fast", action="store_true",
+                        help="Replays the reports as fast as possible "
+                             "instead of at their original timing")
 
 daemonopt = parser.add_argument_group("daemon options")
+daemonopt.add_argument("--async-log", action="store_true",
+                       help="Write log messages from a background thread "
+                            "in batches, instead of waiting for each "
+                            "message to be written")
 daemonopt.add_argument("--daemon", action="store_true",
                        help="Run in the background as a daemon")
 daemonopt.add_argument("--daemon-log", default=DAEMON_LOG_FILE, metavar="file",
                        help="Log file to create in daemon mode")
 daemonopt.add_argument("--daemon-pid", default=DAEMON_PID_FILE, metavar="file",
                        help="PID file to create in daemon mode")
+daemonopt.add_argument("--control-socket", metavar="file",
+                       type=os.path.expanduser,
+                       help="Accepts commands to list the controllers, "
+                            "switch profiles, set the LED color or rumble "
+                            "as line-delimited JSON on a UNIX socket")
+daemonopt.add_argument("--metrics-socket", metavar="file",
+                       type=os.path.expanduser,
+                       help="Serves metrics about the controllers in the "
+                            "Prometheus text format on a UNIX socket")
 
 controllopt = parser.add_argument_group("controller options")
 
@@ -156,6 +178,15 @@ class ControllerAction(argparse.Action):
 
 controllopt.add_argument("--next-controller", nargs=0, action=ControllerAction,
                          help="Creates another controller")
+controllopt.add_argument("--controller-mode", default="thread",
+                         choices=("thread", "shared", "process"),
+                         help="How to run the controllers. 'thread' runs "
+                              "each controller in its own thread, 'shared' "
+                              "runs all controllers on a single event loop "
+                              "in one thread and 'process' runs each "
+                              "controller in its own worker process, which "
+                              "is restarted if it crashes. Default is "
+                              "'thread'")
 
 def hexcolor(color):
     color = color.strip("#")
@@ -250,6 +281,21 @@ def add_controller_option(name, **options):
     ControllerAction.__options__.append(option_name)
 
 
+add_controller_option("--coalesce-reports", action="store_true",
+                      help="Drops reports that have been superseded by a "
+                           "newer report when several are queued up, "
+                           "reports containing button changes are always "
+                           "kept. Only supported in hidraw mode")
+add_controller_option("--measure-latency", action="store_true",
+                      help="Measures how long each stage of the report "
+                           "processing takes and logs a summary every "
+                           "minute and on disconnect")
+add_controller_option("--output-interval", metavar="ms", default=10.0,
+                      type=float,
+                      help="Minimum time between the output reports "
+                           "setting the LED and rumble, changes made in "
+                           "between are combined into a single report. "
+                           "Default is 10 ms")
 add_controller_option("--profiles", metavar="profiles",
                       type=stringlist,
                       help="Profiles to cycle through using the button "
@@ -0,0 +1,282 @@
+"""Controlling the controllers at runtime over a UNIX socket.
+
+Each request is a JSON object on a line of its own, with the name of
+the command and the number of the controller it applies to, e.g.:
+
+    {"command": "load-profile", "controller": 1, "profile": "kbd"}
+
+Each request is answered with a JSON object on a line of its own,
+with "ok" set to false and an "error" message if the command failed.
+A "id" given in the request is included in the response, since the
+responses are sent as soon as each command is done, which is not
+necessarily in the order the requests were made.
+
+Commands are run on the event loop of the controller, so they never
+race with the report processing and the server never waits for them.
+"""
+
+import json
+
+from .config import hexcolor
+from .server import Connection, UnixServer
+
+
+# Lines longer than this are not valid requests.
+MAX_REQUEST_SIZE = 4096
+
+COMMANDS = {}
+
+
+class ControlError(Exception):
+    """Invalid control commands."""
+
+
+def command(name):
+    """Adds a command that can be run on a controller.
+
+    The function is called with the controller and the request and
+    returns a dict with the response.
+    """
+    def decorator(func):
+        COMMANDS[name] = func
+        return func
+
+    return decorator
+
+
+def run_command(controller, request):
+    """Runs a command on a controller and returns the response.
+
+    Must be called from the controller's event loop.
+    """
+    func = COMMANDS.get(request.get("command"))
+    if not func:
+        return error_response("Unknown command: {0}",
+                              request.get("command"))
+
+    # Nothing may escape into the event loop running the command
+    try:
+        response = dict(func(controller, request))
+    except ControlError as err:
+        return error_response(err)
+    except Exception as err:
+        return error_response("Command failed: {0}", err)
+
+    response["ok"] = True
+    return response
+
+
+def error_response(msg, *args):
+    """Returns a response for a failed command.
+
+    msg is only formatted with args if there are any, since messages
+    often contain values from the request.
+    """
+    msg = str(msg)
+    if args:
+        msg = msg.format(*args)
+
+    return {"ok": False, "error": msg}
+
+
+def connected_device(controller):
+    device = controller.device
+    if not device:
+        raise ControlError("Controller {0} is not connected".format(
+                           controller.index))
+
+    return device
+
+
+def motor_value(request, name):
+    value = request.get(name, 0)
+    if not isinstance(value, int) or not 0 <= value <= 255:
+        raise ControlError("Invalid {0} value: {1}".format(name, value))
+
+    return value
+
+
+@command("status")
+def status(controller, request):
+    """Returns the state of the controller."""
+    device = controller.device
+    metrics = controller.metrics
+
+    response = {
+        "controller": controller.index,
+        "connected": device is not None,
+        "profile": controller.current_profile,
+        "profiles": sorted(controller.profile_options),
+    }
+
+    if device:
+        response.update(device=device.name, address=device.device_addr,
+                        type=device.type, battery=metrics.battery,
+                        usb=bool(metrics.usb_connected),
+                        report_rate=metrics.report_rate)
+
+    return response
+
+
+@command("load-profile")
+def load_profile(controller, request):
+    profile = request.get("profile")
+    if profile not in controller.profile_options:
+        raise ControlError("Unknown profile: {0}".format(profile))
+
+    controller.load_profile(profile)
+
+    return status(controller, request)
+
+
+@command("set-led")
+def set_led(controller, request):
+    """Sets the LED color, until the next profile change."""
+    device = connected_device(controller)
+
+    try:
+        color = hexcolor(str(request.get("color")))
+    except ValueError:
+        raise ControlError("Invalid color: {0}".format(request.get("color")))
+
+    device.set_led(*color)
+
+    return {"controller": controller.index}
+
+
+@command("rumble")
+def rumble(controller, request):
+    """Sets the intensity of the small and big rumble motors."""
+    device = connected_device(controller)
+    device.rumble(motor_value(request, "small"), motor_value(request, "big"))
+
+    return {"controller": controller.index}
+
+
+class ControlConnection(Connection):
+    def __init__(self, sock):
+        super(ControlConnection, self).__init__(sock)
+
+        # Number of requests waiting for a response and whether the
+        # client is done sending requests.
+        self.pending = 0
+        self.eof = False
+
+
+class ControlServer(UnixServer):
+    """Serves control requests on a UNIX socket.
+
+    controllers is called for each request and should return the
+    running controllers. A command is handed to the controller's
+    control method, which calls back with the response from any
+    thread.
+    """
+
+    connection_class = ControlConnection
+
+    def __init__(self, loop, path, controllers):
+        super(ControlServer, self).__init__(loop, path)
+        self.controllers = controllers
+
+    def handle_data(self, connection, data):
+        buffer = connection.buffer
+        buffer += data
+
+        while True:
+            index = buffer.find(b"\n")
+            if index < 0:
+                break
+
+            line = bytes(buffer[:index]).strip()
+            del buffer[:index + 1]
+
+            if line:
+                self.handle_request(connection, line)
+
+        if len(buffer) > MAX_REQUEST_SIZE:
+            del buffer[:]
+            self.send(connection, None, error_response("Request too long"))
+
+    def handle_eof(self, connection):
+        # Wait for the responses to any outstanding requests
+        connection.eof = True
+        if connection.pending:
+            self.loop.remove_watcher(connection.fd)
+        else:
+            self.close_connection(connection)
+
+    def handle_request(self, connection, line):
+        try:
+            request = json.loads(line.decode("utf8"))
+        except ValueError:
+            request = None
+
+        if not isinstance(request, dict):
+            self.send(connection, None, error_response("Invalid request"))
+            return
+
+        request_id = request.get("id")
+        controllers = self.controllers()
+
+        if request.get("command") == "list":
+            requests = [(controller, dict(request, command="status"))
+                        for controller in controllers]
+            self.run_commands(connection, request_id, requests,
+                              self.list_response)
+            return
+
+        for controller in controllers:
+            if controller.index == request.get("controller"):
+                break
+        else:
+            self.send(connection, request_id,
+                      error_response("Unknown controller: {0}",
+                                     request.get("controller")))
+            return
+
+        self.run_commands(connection, request_id, [(controller, request)],
+                          lambda responses: responses[0])
+
+    def list_response(self, responses):
+        return {"ok": True, "controllers": responses}
+
+    def run_commands(self, connection, request_id, requests, combine):
+        """Runs commands on controllers and sends a single response
+        once all of them are done."""
+        responses = [None] * len(requests)
+        remaining = [len(requests)]
+
+        def done(index, response):
+            responses[index] = response
+            remaining[0] -= 1
+
+            if not remaining[0]:
+                self.finish(connection, request_id, combine(responses))
+
+        def reply(index):
+            # Called from the controller's thread
+            return lambda response: self.loop.call_soon(done, index,
+                                                        response)
+
+        if not requests:
+            self.send(connection, request_id, combine(responses))
+            return
+
+        connection.pending += 1
+        for index, (controller, request) in enumerate(requests):
+            controller.control(request, reply(index))
+
+    def finish(self, connection, request_id, response):
+        connection.pending -= 1
+        self.send(connection, request_id, response)
+
+        if connection.eof and not connection.pending:
+            self.close_connection(connection)
+
+    def send(self, connection, request_id, response):
+        if request_id is not None:
+            response["id"] = request_id
+
+        line = json.dumps(response, sort_keys=True) + "\n"
+        if not connection.send(line.encode("utf8")):
+            self.close_connection(connection)
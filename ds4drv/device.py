@@ -1,6 +1,9 @@
+from collections import deque
 from struct import Struct
 from sys import version_info as sys_version
 
+from .output import OutputReportWriter
+
 
 class StructHack(Struct):
     """Python <2.7.4 doesn't support struct unpack from bytearray."""
@@ -11,9 +14,94 @@ class StructHack(Struct):
 
 
 if sys_version[:3] <= (2, 7, 4):
-    S16LE = StructHack("<h")
+    ReportStruct = StructHack
 else:
-    S16LE = Struct("<h")
+    ReportStruct = Struct
+
+S16LE = ReportStruct("<h")
+
+# Number of buffers used to read reports into, see
+# DS4Device.create_report_buffers.
+REPORT_BUFFERS = 4
+
+# Layout of the first 43 bytes of a input report, which contains all
+# the fields we decode. Bluetooth reports are expected to have their
+# extra header cut off before being parsed, so that both USB and
+# Bluetooth reports share the same offsets.
+REPORT_STRUCT = ReportStruct(
+    "<x"    # Report ID
+    "4B"    # Left and right analog sticks
+    "3B"    # Buttons, dpad and timestamp
+    "2B"    # L2 and R2 analog
+    "3x"
+    "6h"    # Acceleration and orientation
+    "5x"
+    "B"     # Battery and external inputs
+    "4x"
+    "4B"    # Trackpad touch 1
+    "4B"    # Trackpad touch 2
+)
+
+
+def _build_dpad_buttons_table():
+    """Maps buf[5] to the dpad directions and the face buttons."""
+    table = []
+    for value in range(256):
+        dpad = value % 16
+        table.append((
+            # DPad up, down, left, right
+            dpad in (0, 1, 7), dpad in (3, 4, 5),
+            dpad in (5, 6, 7), dpad in (1, 2, 3),
+
+            # Buttons cross, circle, square, triangle
+            (value & 32) != 0, (value & 64) != 0,
+            (value & 16) != 0, (value & 128) != 0
+        ))
+
+    return tuple(table)
+
+
+def _build_shoulder_buttons_table():
+    """Maps buf[6] to the shoulder, stick, share and options buttons."""
+    table = []
+    for value in range(256):
+        table.append((
+            # L1, L2 and L3 buttons
+            (value & 1) != 0, (value & 4) != 0, (value & 64) != 0,
+
+            # R1, R2,and R3 buttons
+            (value & 2) != 0, (value & 8) != 0, (value & 128) != 0,
+
+            # Share and option buttons
+            (value & 16) != 0, (value & 32) != 0
+        ))
+
+    return tuple(table)
+
+
+def _build_misc_buttons_table():
+    """Maps buf[7] to the trackpad and PS buttons and the timestamp."""
+    return tuple(((value & 2) != 0, (value & 1) != 0, value >> 2)
+                 for value in range(256))
+
+
+def _build_status_table():
+    """Maps buf[30] to the battery level and external inputs."""
+    return tuple((value % 16, (value & 16) != 0, (value & 32) != 0,
+                  (value & 64) != 0)
+                 for value in range(256))
+
+
+def _build_touch_table():
+    """Maps the first byte of a trackpad touch to its id and state."""
+    return tuple((value & 0x7f, (value >> 7) == 0) for value in range(256))
+
+
+DPAD_BUTTONS_TABLE = _build_dpad_buttons_table()
+SHOULDER_BUTTONS_TABLE = _build_shoulder_buttons_table()
+MISC_BUTTONS_TABLE = _build_misc_buttons_table()
+STATUS_TABLE = _build_status_table()
+TOUCH_TABLE = _build_touch_table()
 
 
 class DS4Report(object):
@@ -61,9 +149,448 @@ class DS4Report(object):
                  "plug_audio",
                  "plug_mic"]
 
-    def __init__(self, *args, **kwargs):
-        for i, value in enumerate(args):
-            setattr(self, self.__slots__[i], value)
+    def snapshot(self):
+        """Reports are already decoded, so they are safe to keep."""
+        return self
+
+
+def _build_report_init(fields):
+    """Generates a DS4Report.__init__ that assigns each slot directly.
+
+    This is a lot cheaper than looping over the slots with setattr,
+    which matters since a report is created for every HID report read.
+    """
+    source = "def __init__(self, {0}):\n".format(", ".join(fields))
+    for field in fields:
+        source += "    self.{0} = {0}\n".format(field)
+
+    namespace = {}
+    exec(source, namespace)
+
+    return namespace["__init__"]
+
+
+DS4Report.__init__ = _build_report_init(DS4Report.__slots__)
+
+
+# Bit masks used to flag which fields changed between two reports.
+REPORT_FIELD_MASKS = dict((field, 1 << index)
+                          for index, field in enumerate(DS4Report.__slots__))
+REPORT_ALL_FIELDS = (1 << len(DS4Report.__slots__)) - 1
+REPORT_BUTTON_FIELDS = sum(mask for field, mask in REPORT_FIELD_MASKS.items()
+                           if field.startswith(("button_", "dpad_")))
+
+# A decoded report does not know about the report before it,
+# so consider everything to have changed.
+DS4Report.changed = REPORT_ALL_FIELDS
+DS4Report.buttons_changed = True
+DS4Report.buttons = property(
+    lambda self: sum(mask for field, mask in BUTTON_MASKS.items()
+                     if getattr(self, field)),
+    doc="The state of all buttons as a word, see BUTTON_MASKS."
+)
+
+# The bits in the raw report each field is decoded from, as
+# (field, offset, bits) entries.
+REPORT_FIELD_BITS = [
+    ("left_analog_x", 1, 0xff),
+    ("left_analog_y", 2, 0xff),
+    ("right_analog_x", 3, 0xff),
+    ("right_analog_y", 4, 0xff),
+    ("l2_analog", 8, 0xff),
+    ("r2_analog", 9, 0xff),
+    ("dpad_up", 5, 0x0f),
+    ("dpad_down", 5, 0x0f),
+    ("dpad_left", 5, 0x0f),
+    ("dpad_right", 5, 0x0f),
+    ("button_cross", 5, 32),
+    ("button_circle", 5, 64),
+    ("button_square", 5, 16),
+    ("button_triangle", 5, 128),
+    ("button_l1", 6, 1),
+    ("button_l2", 6, 4),
+    ("button_l3", 6, 64),
+    ("button_r1", 6, 2),
+    ("button_r2", 6, 8),
+    ("button_r3", 6, 128),
+    ("button_share", 6, 16),
+    ("button_options", 6, 32),
+    ("button_trackpad", 7, 2),
+    ("button_ps", 7, 1),
+    ("timestamp", 7, 0xfc),
+    ("battery", 30, 0x0f),
+    ("plug_usb", 30, 16),
+    ("plug_audio", 30, 32),
+    ("plug_mic", 30, 64),
+]
+
+for field, offset in (("motion_y", 13), ("motion_x", 15), ("motion_z", 17),
+                      ("orientation_roll", 19), ("orientation_yaw", 21),
+                      ("orientation_pitch", 23)):
+    REPORT_FIELD_BITS += [(field, offset, 0xff), (field, offset + 1, 0xff)]
+
+for touch, offset in (("trackpad_touch0", 35), ("trackpad_touch1", 39)):
+    REPORT_FIELD_BITS += [
+        (touch + "_id", offset, 0x7f),
+        (touch + "_active", offset, 0x80),
+        (touch + "_x", offset + 1, 0xff),
+        (touch + "_x", offset + 2, 0x0f),
+        (touch + "_y", offset + 2, 0xf0),
+        (touch + "_y", offset + 3, 0xff),
+    ]
+
+
+def _build_delta_tables():
+    """Maps each report byte to a table of changed fields.
+
+    The tables are indexed by the XOR of a byte in two reports, which
+    gives the mask of fields affected by the bits that differ.
+    """
+    offsets = {}
+    for field, offset, bits in REPORT_FIELD_BITS:
+        offsets.setdefault(offset, []).append((bits,
+                                               REPORT_FIELD_MASKS[field]))
+
+    tables = []
+    for offset, fields in sorted(offsets.items()):
+        table = []
+        for diff in range(256):
+            mask = 0
+            for bits, field_mask in fields:
+                if diff & bits:
+                    mask |= field_mask
+
+            table.append(mask)
+
+        tables.append((offset, tuple(table)))
+
+    return tuple(tables)
+
+
+REPORT_DELTA_TABLES = _build_delta_tables()
+
+
+def report_delta(buf, prev, size=REPORT_STRUCT.size,
+                 tables=REPORT_DELTA_TABLES):
+    """Returns a mask of the fields that differ between two raw reports."""
+    if buf[:size] == prev[:size]:
+        return 0
+
+    changed = 0
+    for offset, table in tables:
+        diff = buf[offset] ^ prev[offset]
+        if diff:
+            changed |= table[diff]
+
+    return changed
+
+
+def buttons_changed(buf, prev):
+    """Checks if any button or the dpad differs between two raw reports."""
+    # Only the lower two bits of the third button byte are buttons,
+    # the rest is a timestamp that changes with every report.
+    return buf[5:7] != prev[5:7] or ((buf[7] ^ prev[7]) & 3) != 0
+
+
+# Bits of the buttons and the dpad in a button word, see report_buttons.
+# Face buttons and the third button byte keep their bits from the raw
+# report, the dpad is decoded from its hat value into the low nibble.
+BUTTON_MASKS = {
+    "dpad_up": 1,
+    "dpad_down": 2,
+    "dpad_left": 4,
+    "dpad_right": 8,
+    "button_square": 16,
+    "button_cross": 32,
+    "button_circle": 64,
+    "button_triangle": 128,
+    "button_l1": 1 << 8,
+    "button_r1": 2 << 8,
+    "button_l2": 4 << 8,
+    "button_r2": 8 << 8,
+    "button_share": 16 << 8,
+    "button_options": 32 << 8,
+    "button_l3": 64 << 8,
+    "button_r3": 128 << 8,
+    "button_ps": 1 << 16,
+    "button_trackpad": 2 << 16,
+}
+
+
+def _build_dpad_bits_table():
+    """Maps buf[5] to the dpad and face button bits of a button word."""
+    table = []
+    for value, buttons in enumerate(DPAD_BUTTONS_TABLE):
+        bits = value & 0xf0
+        for pressed, field in zip(buttons[:4], ("dpad_up", "dpad_down",
+                                                "dpad_left", "dpad_right")):
+            if pressed:
+                bits |= BUTTON_MASKS[field]
+
+        table.append(bits)
+
+    return tuple(table)
+
+
+DPAD_BITS_TABLE = _build_dpad_bits_table()
+
+
+def report_buttons(buf, dpad_bits=DPAD_BITS_TABLE):
+    """Returns the state of all buttons in a raw report as a word.
+
+    Check the bits of the word with BUTTON_MASKS.
+    """
+    return dpad_bits[buf[5]] | buf[6] << 8 | (buf[7] & 3) << 16
+
+
+def combo_mask(buttons):
+    """Returns the button word mask of a sequence of buttons."""
+    mask = 0
+    for button in buttons:
+        mask |= BUTTON_MASKS[button]
+
+    return mask
+
+
+def decode_report(buf, unpack_from=REPORT_STRUCT.unpack_from,
+                  dpad_buttons=DPAD_BUTTONS_TABLE,
+                  shoulder_buttons=SHOULDER_BUTTONS_TABLE,
+                  misc_buttons=MISC_BUTTONS_TABLE, status=STATUS_TABLE,
+                  touch=TOUCH_TABLE):
+    """Decodes a buffer containing a HID report into a DS4Report.
+
+    The whole report is unpacked with a single precompiled struct and the
+    bit fields are resolved with lookup tables, the tables are bound as
+    default arguments to avoid global lookups on every call.
+    """
+    (left_x, left_y, right_x, right_y, buttons1, buttons2, buttons3,
+     l2, r2, motion_y, motion_x, motion_z, roll, yaw, pitch, status_byte,
+     t0_id, t0_0, t0_1, t0_2, t1_id, t1_0, t1_1, t1_2) = unpack_from(buf)
+
+    dpad = dpad_buttons[buttons1]
+    shoulder = shoulder_buttons[buttons2]
+    misc = misc_buttons[buttons3]
+    state = status[status_byte]
+    touch0 = touch[t0_id]
+    touch1 = touch[t1_id]
+
+    return DS4Report(
+        # Left analog stick
+        left_x, left_y,
+
+        # Right analog stick
+        right_x, right_y,
+
+        # L2 and R2 analog
+        l2, r2,
+
+        # DPad up, down, left, right
+        dpad[0], dpad[1], dpad[2], dpad[3],
+
+        # Buttons cross, circle, square, triangle
+        dpad[4], dpad[5], dpad[6], dpad[7],
+
+        # L1, L2 and L3 buttons
+        shoulder[0], shoulder[1], shoulder[2],
+
+        # R1, R2,and R3 buttons
+        shoulder[3], shoulder[4], shoulder[5],
+
+        # Share and option buttons
+        shoulder[6], shoulder[7],
+
+        # Trackpad and PS buttons
+        misc[0], misc[1],
+
+        # Acceleration
+        motion_y, motion_x, motion_z,
+
+        # Orientation
+        -roll, yaw, pitch,
+
+        # Trackpad touch 1: id, active, x, y
+        touch0[0], touch0[1],
+        ((t0_1 & 0x0f) << 8) | t0_0,
+        t0_2 << 4 | ((t0_1 & 0xf0) >> 4),
+
+        # Trackpad touch 2: id, active, x, y
+        touch1[0], touch1[1],
+        ((t1_1 & 0x0f) << 8) | t1_0,
+        t1_2 << 4 | ((t1_1 & 0xf0) >> 4),
+
+        # Timestamp and battery
+        misc[2],
+        state[0],
+
+        # External inputs (usb, audio, mic)
+        state[1], state[2], state[3]
+    )
+
+
+def _touch_expressions(touch, offset):
+    return [
+        ((touch + "_id", touch + "_active"),
+         "TOUCH_TABLE[buf[{0}]]".format(offset)),
+        (touch + "_x",
+         "((buf[{1}] & 0x0f) << 8) | buf[{0}]".format(offset + 1,
+                                                      offset + 2)),
+        (touch + "_y",
+         "buf[{1}] << 4 | ((buf[{0}] & 0xf0) >> 4)".format(offset + 2,
+                                                           offset + 3)),
+    ]
+
+
+# Expressions decoding DS4Report fields from a buffer, an expression
+# may also evaluate to a tuple of values for several fields. They are
+# grouped by fields that are usually used together, a report view
+# decodes a whole group at a time.
+REPORT_FIELD_GROUPS = (
+    # Analog sticks and triggers
+    [
+        ("left_analog_x", "buf[1]"),
+        ("left_analog_y", "buf[2]"),
+        ("right_analog_x", "buf[3]"),
+        ("right_analog_y", "buf[4]"),
+        ("l2_analog", "buf[8]"),
+        ("r2_analog", "buf[9]"),
+    ],
+
+    # Buttons, dpad and timestamp
+    [
+        (("dpad_up", "dpad_down", "dpad_left", "dpad_right",
+          "button_cross", "button_circle", "button_square",
+          "button_triangle"), "DPAD_BUTTONS_TABLE[buf[5]]"),
+        (("button_l1", "button_l2", "button_l3", "button_r1", "button_r2",
+          "button_r3", "button_share", "button_options"),
+         "SHOULDER_BUTTONS_TABLE[buf[6]]"),
+        (("button_trackpad", "button_ps", "timestamp"),
+         "MISC_BUTTONS_TABLE[buf[7]]"),
+    ],
+
+    # Acceleration and orientation
+    [
+        ("motion_y", "S16LE.unpack_from(buf, 13)[0]"),
+        ("motion_x", "S16LE.unpack_from(buf, 15)[0]"),
+        ("motion_z", "S16LE.unpack_from(buf, 17)[0]"),
+        ("orientation_roll", "-(S16LE.unpack_from(buf, 19)[0])"),
+        ("orientation_yaw", "S16LE.unpack_from(buf, 21)[0]"),
+        ("orientation_pitch", "S16LE.unpack_from(buf, 23)[0]"),
+    ],
+
+    # Trackpad touches
+    _touch_expressions("trackpad_touch0", 35) +
+    _touch_expressions("trackpad_touch1", 39),
+
+    # Battery and external inputs
+    [
+        (("battery", "plug_usb", "plug_audio", "plug_mic"),
+         "STATUS_TABLE[buf[30]]"),
+    ],
+)
+
+
+def _group_fields(group):
+    for fields, expression in group:
+        if isinstance(fields, tuple):
+            for field in fields:
+                yield field
+        else:
+            yield fields
+
+
+def _build_lazy_field(name, group):
+    """Generates a descriptor that decodes a field on first access.
+
+    All fields in the same group are decoded and cached in the view's
+    instance dict at once. Since this is a non-data descriptor the cached
+    values then take precedence and the descriptor is not called again
+    for the same view.
+    """
+    source = (
+        "class LazyField(object):\n"
+        "    def __get__(self, view, owner):\n"
+        "        if view is None:\n"
+        "            return self\n"
+        "        buf = view.buf\n"
+        "        values = view.__dict__\n"
+    )
+    for fields, expression in group:
+        if not isinstance(fields, tuple):
+            fields = (fields,)
+
+        targets = ", ".join("values[{0!r}]".format(f) for f in fields)
+        source += "        {0} = {1}\n".format(targets, expression)
+    source += "        return values[{0!r}]\n".format(name)
+
+    namespace = dict(globals())
+    exec(source, namespace)
+
+    return namespace["LazyField"]()
+
+
+class lazy_property(object):
+    """A property that caches its value in the instance dict."""
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+
+        return value
+
+
+class DS4ReportView(object):
+    """A lazily decoded HID report.
+
+    Wraps the buffer a report was read into and decodes fields the first
+    time they are accessed, the values are then cached on the view.
+
+    The buffer is not copied, so a view is only valid until the device
+    has read its next report. Use snapshot() to get a DS4Report that can
+    be kept around for longer.
+    """
+
+    def __init__(self, buf, prev=None):
+        self.buf = buf
+        self.prev = prev
+
+    @lazy_property
+    def changed(self):
+        """A mask of the fields that changed since the previous report.
+
+        Compare against REPORT_FIELD_MASKS to check for specific fields.
+        """
+        if self.prev is None:
+            return REPORT_ALL_FIELDS
+
+        return report_delta(self.buf, self.prev)
+
+    @lazy_property
+    def buttons_changed(self):
+        """True if any button changed since the previous report."""
+        if self.prev is None:
+            return True
+
+        return buttons_changed(self.buf, self.prev)
+
+    @lazy_property
+    def buttons(self):
+        """The state of all buttons as a word, see BUTTON_MASKS."""
+        return report_buttons(self.buf)
+
+    def snapshot(self):
+        """Decodes all fields into a DS4Report."""
+        return decode_report(self.buf)
+
+
+for group in REPORT_FIELD_GROUPS:
+    for name in _group_fields(group):
+        setattr(DS4ReportView, name, _build_lazy_field(name, group))
 
 
 class DS4Device(object):
@@ -77,143 +604,162 @@ class DS4Device(object):
         self.device_addr = device_addr
         self.type = type
 
+        self._rumble = (0, 0)
         self._led = (0, 0, 0)
         self._led_flash = (0, 0)
         self._led_flashing = False
+        self.output = OutputReportWriter(self)
+
+        self.last_report_buf = None
+        self.coalesced_reports = 0
+        self.invalid_reports = 0
 
         self.set_operational()
 
-    def _control(self, **kwargs):
-        self.control(led_red=self._led[0], led_green=self._led[1],
-                     led_blue=self._led[2], flash_led1=self._led_flash[0],
-                     flash_led2=self._led_flash[1], **kwargs)
+    def output_state(self):
+        """Returns the state of the rumble motors and LED."""
+        return self._rumble, self._led, self._led_flash
 
     def rumble(self, small=0, big=0):
         """Sets the intensity of the rumble motors. Valid range is 0-255."""
-        self._control(small_rumble=small, big_rumble=big)
+        self._rumble = (small, big)
+        self.output.request()
 
     def set_led(self, red=0, green=0, blue=0):
         """Sets the LED color. Values are RGB between 0-255."""
         self._led = (red, green, blue)
-        self._control()
+        self.output.request()
 
     def start_led_flash(self, on, off):
         """Starts flashing the LED."""
         if not self._led_flashing:
             self._led_flash = (on, off)
             self._led_flashing = True
-            self._control()
+            self.output.request()
 
     def stop_led_flash(self):
         """Stops flashing the LED."""
         if self._led_flashing:
             self._led_flash = (0, 0)
             self._led_flashing = False
-            # Call twice, once to stop flashing...
-            self._control()
-            # ...and once more to make sure the LED is on.
-            self._control()
+            # Write twice, once to stop flashing and once more to make
+            # sure the LED is on.
+            self.output.request(writes=2)
 
     def control(self, big_rumble=0, small_rumble=0,
                 led_red=0, led_green=0, led_blue=0,
                 flash_led1=0, flash_led2=0):
-        if self.type == "bluetooth":
-            pkt = bytearray(77)
-            pkt[0] = 128
-            pkt[2] = 255
-            offset = 2
-            report_id = 0x11
-
-        elif self.type == "usb":
-            pkt = bytearray(31)
-            pkt[0] = 255
-            offset = 0
-            report_id = 0x05
-
-        # Rumble
-        pkt[offset+3] = min(small_rumble, 255)
-        pkt[offset+4] = min(big_rumble, 255)
-
-        # LED (red, green, blue)
-        pkt[offset+5] = min(led_red, 255)
-        pkt[offset+6] = min(led_green, 255)
-        pkt[offset+7] = min(led_blue, 255)
-
-        # Time to flash bright (255 = 2.5 seconds)
-        pkt[offset+8] = min(flash_led1, 255)
-
-        # Time to flash dark (255 = 2.5 seconds)
-        pkt[offset+9] = min(flash_led2, 255)
-
-        self.write_report(report_id, pkt)
+        """Sets the rumble motors and LED at once."""
+        self._rumble = (small_rumble, big_rumble)
+        self._led = (led_red, led_green, led_blue)
+        self._led_flash = (flash_led1, flash_led2)
+        self.output.request()
+
+    def create_report_buffers(self, size):
+        """Creates the buffers reports are read into.
+
+        Reports are decoded lazily straight from the buffer they were read
+        into and compared against the report before them, so the buffers
+        of the last two delivered reports are kept intact while the next
+        one is being read. One extra buffer allows holding on to a report
+        while reading ahead.
+        """
+        self.report_buffers = deque(bytearray(size)
+                                    for i in range(REPORT_BUFFERS))
+        self.delivered_report_buffers = deque()
+        self.buf = self.report_buffers.popleft()
+
+    def hold_report_buffer(self):
+        """Takes the current buffer out of rotation and returns it.
+
+        A free buffer is used to read the next report into. The held
+        buffer must be passed to either deliver_report_buffer or
+        release_report_buffer.
+        """
+        buf = self.buf
+        self.buf = self.report_buffers.popleft()
+
+        return buf
+
+    def deliver_report_buffer(self, buf):
+        """Marks a held buffer as containing the latest delivered report."""
+        self.delivered_report_buffers.append(buf)
+        if len(self.delivered_report_buffers) > 2:
+            buf = self.delivered_report_buffers.popleft()
+            self.report_buffers.append(buf)
+
+    def release_report_buffer(self, buf):
+        """Returns a held buffer whose report was dropped."""
+        self.report_buffers.appendleft(buf)
+
+    def rotate_report_buffers(self):
+        """Delivers the current buffer and switches to a free one."""
+        self.deliver_report_buffer(self.hold_report_buffer())
 
     def parse_report(self, buf):
         """Parse a buffer containing a HID report."""
-        dpad = buf[5] % 16
-
-        return DS4Report(
-            # Left analog stick
-            buf[1], buf[2],
-
-            # Right analog stick
-            buf[3], buf[4],
-
-            # L2 and R2 analog
-            buf[8], buf[9],
-
-            # DPad up, down, left, right
-            (dpad in (0, 1, 7)), (dpad in (3, 4, 5)),
-            (dpad in (5, 6, 7)), (dpad in (1, 2, 3)),
+        report = DS4ReportView(buf, self.last_report_buf)
+        self.last_report_buf = buf
 
-            # Buttons cross, circle, square, triangle
-            (buf[5] & 32) != 0, (buf[5] & 64) != 0,
-            (buf[5] & 16) != 0, (buf[5] & 128) != 0,
+        return report
 
-            # L1, L2 and L3 buttons
-            (buf[6] & 1) != 0, (buf[6] & 4) != 0, (buf[6] & 64) != 0,
+    def export(self):
+        """Returns the fds and state needed to recreate the device.
 
-            # R1, R2,and R3 buttons
-            (buf[6] & 2) != 0, (buf[6] & 8) != 0, (buf[6] & 128) != 0,
+        Used to hand the device over to another process, where it is
+        recreated with import_device.
+        """
+        state = dict(device_name=self.device_name,
+                     device_addr=self.device_addr,
+                     type=self.type,
+                     led=self._led)
 
-            # Share and option buttons
-            (buf[6] & 16) != 0, (buf[6] & 32) != 0,
+        return self.export_fds(), state
 
-            # Trackpad and PS buttons
-            (buf[7] & 2) != 0, (buf[7] & 1) != 0,
+    @classmethod
+    def import_device(cls, fds, state):
+        """Recreates a device from the fds and state returned by export."""
+        device = cls.__new__(cls)
+        device.device_name = state["device_name"]
+        device.device_addr = state["device_addr"]
+        device.type = state["type"]
 
-            # Acceleration
-            S16LE.unpack_from(buf, 13)[0],
-            S16LE.unpack_from(buf, 15)[0],
-            S16LE.unpack_from(buf, 17)[0],
+        device._rumble = (0, 0)
+        device._led = state["led"]
+        device._led_flash = (0, 0)
+        device._led_flashing = False
+        device.output = OutputReportWriter(device)
 
-            # Orientation
-            -(S16LE.unpack_from(buf, 19)[0]),
-            S16LE.unpack_from(buf, 21)[0],
-            S16LE.unpack_from(buf, 23)[0],
+        device.last_report_buf = None
+        device.coalesced_reports = 0
+        device.invalid_reports = 0
 
-            # Trackpad touch 1: id, active, x, y
-            buf[35] & 0x7f, (buf[35] >> 7) == 0,
-            ((buf[37] & 0x0f) << 8) | buf[36],
-            buf[38] << 4 | ((buf[37] & 0xf0) >> 4),
+        device.import_fds(fds)
 
-            # Trackpad touch 2: id, active, x, y
-            buf[39] & 0x7f, (buf[39] >> 7) == 0,
-            ((buf[41] & 0x0f) << 8) | buf[40],
-            buf[42] << 4 | ((buf[41] & 0xf0) >> 4),
+        return device
 
-            # Timestamp and battery
-            buf[7] >> 2,
-            buf[30] % 16,
+    def export_fds(self):
+        """Returns the fds used by the device."""
+        raise NotImplementedError
 
-            # External inputs (usb, audio, mic)
-            (buf[30] & 16) != 0, (buf[30] & 32) != 0,
-            (buf[30] & 64) != 0
-        )
+    def import_fds(self, fds):
+        """Sets up the device to use fds returned by export_fds."""
+        raise NotImplementedError
 
     def read_report(self):
         """Read and parse a HID report."""
         pass
 
+    def read_reports(self, coalesce=False):
+        """Read and parse all pending HID reports.
+
+        Yields None if the device has been disconnected. Devices that
+        don't support draining simply read a single report.
+        """
+        report = self.read_report()
+        if report is not False:
+            yield report
+
     def write_report(self, report_id, data):
         """Writes a HID report to the control channel."""
         pass
@@ -1,52 +1,186 @@
+import errno
+import fcntl
 import os
 
 from collections import defaultdict, deque
-from functools import wraps
+from heapq import heappop, heappush
+from itertools import count
 from select import epoll, EPOLLIN
+from threading import Event, Lock
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
 
 from .packages import timerfd
 from .utils import iter_except
 
+try:
+    from time import monotonic
+except ImportError:
+    import ctypes
+
+    def monotonic():
+        """Returns the time of CLOCK_MONOTONIC, the clock timers use."""
+        spec = timerfd.timespec()
+        timerfd.libc.clock_gettime(timerfd.CLOCK_MONOTONIC,
+                                   ctypes.pointer(spec))
+        return spec.get_time()
+
+
+# Timers due within this many seconds of each other fire together
+TIMER_SLACK = 0.0005
+
 
 class Timer(object):
-    """Simple interface around a timerfd connected to a event loop."""
+    """A timer scheduled on the timer heap of a event loop."""
 
     def __init__(self, loop, interval, callback):
         self.callback = callback
         self.interval = interval
         self.loop = loop
-        self.timer = timerfd.create(timerfd.CLOCK_MONOTONIC)
+        self.active = False
+        self.entry = None
 
     def start(self, *args, **kwargs):
         """Starts the timer.
 
         If the callback returns True the timer will be restarted.
         """
+        self.args = args
+        self.kwargs = kwargs
+        self.active = True
+        self.loop.schedule_timer(self, self.interval)
+
+    def stop(self):
+        """Stops the timer if it's running."""
+        self.active = False
+        self.loop.cancel_timer(self)
+
+    def fire(self):
+        return self.callback(*self.args, **self.kwargs)
+
+
+class EventLoopNamespace(object):
+    """A part of a event loop with its own set of events.
+
+    This allows several controllers to share a single loop, each
+    controller gets its own namespace so that events fired by one
+    controller only reach its own handlers. Stopping a namespace
+    detaches it from the loop without stopping the loop itself.
+    """
+
+    def __init__(self, loop, name):
+        self.loop = loop
+        self.name = name
+        self.running = True
+        self.fds = set()
+        self.events = set()
+        self.timers = []
 
-        @wraps(self.callback)
-        def callback():
-            os.read(self.timer, 8)
-            repeat = self.callback(*args, **kwargs)
-            if not repeat:
-                self.stop()
+    def create_timer(self, interval, callback):
+        """Creates a timer."""
+
+        timer = self.loop.create_timer(interval, callback)
+        self.timers.append(timer)
+
+        return timer
 
-        spec = timerfd.itimerspec(self.interval, self.interval)
-        timerfd.settime(self.timer, 0, spec)
+    def add_watcher(self, fd, callback, events=EPOLLIN):
+        """Starts watching a non-blocking fd for data."""
+
+        if not isinstance(fd, int):
+            fd = fd.fileno()
 
-        self.loop.remove_watcher(self.timer)
-        self.loop.add_watcher(self.timer, callback)
+        self.loop.add_watcher(fd, callback, events)
+        self.fds.add(fd)
+
+    def remove_watcher(self, fd):
+        """Stops watching a fd."""
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+
+        self.loop.remove_watcher(fd)
+        self.fds.discard(fd)
+
+    def register_event(self, event, callback):
+        """Registers a handler for an event."""
+        self.loop.register_event((self, event), callback)
+        self.events.add(event)
+
+    def unregister_event(self, event, callback):
+        """Unregisters a event handler."""
+        self.loop.unregister_event((self, event), callback)
+
+    def fire_event(self, event, *args, **kwargs):
+        """Fires a event."""
+        self.loop.fire_event((self, event), *args)
+
+    def call_soon(self, callback, *args, **kwargs):
+        """Calls a function from the loop's thread.
+
+        Once the namespace has been stopped the function is cancelled
+        right away.
+        """
+        if not self.running:
+            cancel = kwargs.get("cancel")
+            if cancel:
+                cancel()
+            return
+
+        self.loop.call_soon(callback, *args, **kwargs)
+
+    def call_and_wait(self, callback, *args):
+        """Calls a function from the loop's thread and waits for it."""
+        return self.loop.call_and_wait(callback, *args)
 
     def stop(self):
-        """Stops the timer if it's running."""
-        self.loop.remove_watcher(self.timer)
+        """Detaches the namespace from the loop."""
+        self.running = False
+
+        for timer in self.timers:
+            timer.stop()
+
+        for fd in list(self.fds):
+            self.remove_watcher(fd)
+
+        for event in self.events:
+            self.loop.clear_event((self, event))
+
+        self.events = set()
 
 
 class EventLoop(object):
     """Basic IO, event and timer loop with callbacks."""
 
     def __init__(self):
+        self.timer_fd = timerfd.create(timerfd.CLOCK_MONOTONIC,
+                                       timerfd.NONBLOCK | timerfd.CLOEXEC)
+        self.timer_lock = Lock()
+        self.timer_counter = count()
+
+        # Written to by call_soon to wake up the loop
+        self.wakeup_fd, self.wakeup_write_fd = os.pipe()
+        for fd in (self.wakeup_fd, self.wakeup_write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+        self.pending_calls = deque()
+        self.thread = None
+
         self.stop()
 
+        # Set once the loop has been stopped, it does not run again
+        self.stopped = False
+
+        # Number of wakeups with something to handle and the total time
+        # spent handling them.
+        self.iterations = 0
+        self.busy_time = 0.0
+
         # Timeout value well over the expected controller poll time, but
         # short enough for ds4drv to shut down in a reasonable time.
         self.epoll_timeout = 1
@@ -56,14 +190,182 @@ class EventLoop(object):
 
         return Timer(self, interval, callback)
 
-    def add_watcher(self, fd, callback):
-        """Starts watching a non-blocking fd for data."""
+    def schedule_timer(self, timer, delay):
+        """Schedules a timer to fire after delay seconds."""
+        with self.timer_lock:
+            self._schedule_timer(timer, monotonic() + delay)
+
+    def _schedule_timer(self, timer, deadline):
+        if timer.entry:
+            timer.entry[2] = None
+
+        entry = [deadline, next(self.timer_counter), timer]
+        timer.entry = entry
+        heappush(self.timers, entry)
+
+        if self.timers[0] is entry:
+            self._arm_timer_fd(deadline)
+
+    def cancel_timer(self, timer):
+        """Removes a timer from the timer heap.
+
+        The heap entry is only marked as cancelled and is discarded once
+        it reaches the top of the heap.
+        """
+        entry = timer.entry
+        if entry:
+            entry[2] = None
+            timer.entry = None
+
+    def _arm_timer_fd(self, deadline):
+        if deadline != self.timer_deadline:
+            self.timer_deadline = deadline
+            spec = timerfd.itimerspec(0, deadline)
+            timerfd.settime(self.timer_fd, timerfd.TIMER_ABSTIME, spec)
+
+    def process_timers(self):
+        """Fires all timers that are due.
+
+        Timers due within TIMER_SLACK are fired in the same wakeup.
+        """
+        try:
+            os.read(self.timer_fd, timerfd.bufsize)
+        except OSError:
+            pass
+
+        now = monotonic()
+        limit = now + TIMER_SLACK
+        timers = self.timers
+        due = []
+
+        with self.timer_lock:
+            self.timer_deadline = None
+
+            while timers and timers[0][0] <= limit:
+                deadline, _, timer = heappop(timers)
+                if timer:
+                    timer.entry = None
+                    due.append((deadline, timer))
+
+        for deadline, timer in due:
+            # An earlier callback may have stopped or restarted it
+            if not timer.active or timer.entry:
+                continue
+
+            repeat = timer.fire()
+
+            # Restart periodic timers unless they were stopped or
+            # restarted by the callback.
+            if repeat and timer.active and not timer.entry:
+                deadline += timer.interval
+                if deadline <= now:
+                    deadline = now + timer.interval
+
+                with self.timer_lock:
+                    self._schedule_timer(timer, deadline)
+            elif not repeat and not timer.entry:
+                timer.active = False
+
+        with self.timer_lock:
+            while timers and not timers[0][2]:
+                heappop(timers)
+
+            if timers:
+                self._arm_timer_fd(timers[0][0])
+
+    def call_soon(self, callback, *args, **kwargs):
+        """Calls a function from the loop's thread.
+
+        This is safe to call from any thread, the function is called
+        once the loop wakes up. The cancel keyword argument is a
+        function that is called instead if the loop stops first.
+        """
+        cancel = kwargs.pop("cancel", None)
+        self.pending_calls.append((callback, args, cancel))
+
+        if self.stopped:
+            self.cancel_pending_calls()
+            return
+
+        try:
+            os.write(self.wakeup_write_fd, b"\0")
+        except OSError as err:
+            # The pipe is full, so the loop will wake up anyway
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def process_pending_calls(self):
+        """Calls the functions queued by call_soon."""
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except OSError:
+            pass
+
+        pending_calls = self.pending_calls
+        for callback, args, cancel in iter_except(pending_calls.popleft,
+                                                  IndexError):
+            callback(*args)
+
+    def cancel_pending_calls(self):
+        """Cancels the functions queued by call_soon."""
+        pending_calls = self.pending_calls
+        for callback, args, cancel in iter_except(pending_calls.popleft,
+                                                  IndexError):
+            if cancel:
+                cancel()
+
+    def call_and_wait(self, callback, *args):
+        """Calls a function from the loop's thread and waits for it to
+        return.
+
+        Returns what the function returns and raises what it raises,
+        or returns None if the loop stopped before calling it.
+        """
+        if self.thread == get_ident():
+            return callback(*args)
+
+        done = Event()
+        result = []
+        error = []
+
+        def call():
+            try:
+                result.append(callback(*args))
+            except Exception as err:
+                error.append(err)
+            finally:
+                done.set()
+
+        self.call_soon(call, cancel=done.set)
+
+        # Waiting with a timeout keeps signals working on Python 2
+        while not done.wait(1):
+            pass
+
+        if error:
+            raise error[0]
+
+        if result:
+            return result[0]
+
+    def namespace(self, name):
+        """Creates a namespace with its own events on this loop."""
+
+        return EventLoopNamespace(self, name)
+
+    def add_watcher(self, fd, callback, events=EPOLLIN):
+        """Starts watching a non-blocking fd.
+
+        By default the callback is called when there is data to read,
+        events is a mask of the epoll events to watch for instead.
+        """
 
         if not isinstance(fd, int):
             fd = fd.fileno()
 
         self.callbacks[fd] = callback
-        self.epoll.register(fd, EPOLLIN)
+        self.epoll.register(fd, events)
 
     def remove_watcher(self, fd):
         """Stops watching a fd."""
@@ -77,32 +379,87 @@ class EventLoop(object):
         self.epoll.unregister(fd)
 
     def register_event(self, event, callback):
-        """Registers a handler for an event."""
-        self.event_callbacks[event].add(callback)
+        """Registers a handler for an event.
+
+        Handlers are called in the order they were registered.
+        """
+        callbacks = self.event_callbacks[event]
+        if callback not in callbacks:
+            callbacks.append(callback)
+            self.event_handlers[event] = tuple(callbacks)
 
     def unregister_event(self, event, callback):
         """Unregisters a event handler."""
-        self.event_callbacks[event].remove(callback)
+        callbacks = self.event_callbacks[event]
+        callbacks.remove(callback)
+        self.event_handlers[event] = tuple(callbacks)
+
+    def clear_event(self, event):
+        """Unregisters all handlers of an event."""
+        self.event_callbacks.pop(event, None)
+        self.event_handlers.pop(event, None)
 
     def fire_event(self, event, *args, **kwargs):
-        """Fires a event."""
-        self.event_queue.append((event, args))
-        self.process_events()
+        """Fires a event.
+
+        The handlers are called directly, unless the event is fired by
+        a handler of another event. It is then queued and handled once
+        the current event has been handled.
+
+        Events may only be fired from the thread running the loop, or
+        from any single thread before the loop has been started. Other
+        threads should use call_soon.
+        """
+        thread = self.thread
+        if thread is not None and thread != get_ident():
+            raise RuntimeError("Events must be fired from the thread "
+                               "running the loop")
+
+        if self.dispatching:
+            self.event_queue.append((event, args))
+            return
+
+        self.dispatching = True
+        try:
+            for callback in self.event_handlers.get(event, ()):
+                callback(*args)
+
+            if self.event_queue:
+                self.process_events()
+        finally:
+            self.dispatching = False
 
     def process_events(self):
         """Processes any events in the queue."""
+        handlers = self.event_handlers
         for event, args in iter_except(self.event_queue.popleft, IndexError):
-            for callback in self.event_callbacks[event]:
+            for callback in handlers.get(event, ()):
                 callback(*args)
 
     def run(self):
         """Starts the loop."""
         self.running = True
-        while self.running:
-            for fd, event in self.epoll.poll(self.epoll_timeout):
-                callback = self.callbacks.get(fd)
-                if callback:
-                    callback()
+        self.thread = get_ident()
+
+        try:
+            while self.running:
+                events = self.epoll.poll(self.epoll_timeout)
+                if not events:
+                    continue
+
+                start = monotonic()
+                for fd, event in events:
+                    callback = self.callbacks.get(fd)
+                    if callback:
+                        callback()
+
+                self.iterations += 1
+                self.busy_time += monotonic() - start
+        finally:
+            # Nothing queued now will ever be called
+            self.thread = None
+            self.stopped = True
+            self.cancel_pending_calls()
 
     def stop(self):
         """Stops the loop."""
@@ -110,6 +467,18 @@ class EventLoop(object):
         self.callbacks = {}
         self.epoll = epoll()
 
+        with self.timer_lock:
+            self.timers = []
+            self.timer_deadline = None
+
+        self.add_watcher(self.timer_fd, self.process_timers)
+        self.add_watcher(self.wakeup_fd, self.process_pending_calls)
+
+        self.stopped = True
+        self.cancel_pending_calls()
+
         self.event_queue = deque()
-        self.event_callbacks = defaultdict(set)
+        self.event_callbacks = defaultdict(list)
+        self.event_handlers = {}
+        self.dispatching = False
 
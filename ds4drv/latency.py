@@ -0,0 +1,174 @@
+"""Latency measurements of the report processing pipeline.
+
+Durations are recorded in nanoseconds into histograms with a fixed
+number of log-linear buckets, like a HDR histogram. Recording a value
+is a few integer operations and never allocates, so the measurements
+can stay on the hot path, while percentiles are accurate to about 3%.
+"""
+
+try:
+    from time import perf_counter_ns as clock_ns
+except ImportError:
+    try:
+        from time import perf_counter
+    except ImportError:
+        from time import time as perf_counter
+
+    def clock_ns():
+        return int(perf_counter() * 1e9)
+
+
+# Each power of two is split into 2 ** HISTOGRAM_PRECISION buckets.
+HISTOGRAM_PRECISION = 5
+
+# Values above 2 ** HISTOGRAM_MAX_BITS ns (about 18 minutes) are
+# counted as the largest value.
+HISTOGRAM_MAX_BITS = 40
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram(object):
+    """Counts durations in log-linear buckets."""
+
+    def __init__(self, precision=HISTOGRAM_PRECISION,
+                 max_bits=HISTOGRAM_MAX_BITS):
+        self.precision = precision
+        self.linear_limit = 1 << (precision + 1)
+        self.highest = (1 << max_bits) - 1
+        self.counts = [0] * (self.bucket_index(self.highest) + 1)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def bucket_index(self, value):
+        if value < self.linear_limit:
+            return value
+
+        exponent = value.bit_length() - self.precision - 1
+        return (exponent << self.precision) + (value >> exponent)
+
+    def bucket_value(self, index):
+        """Returns the highest value counted in a bucket."""
+        if index < self.linear_limit:
+            return index
+
+        exponent = (index >> self.precision) - 1
+        mantissa = index - (exponent << self.precision)
+        return ((mantissa + 1) << exponent) - 1
+
+    def record(self, value):
+        """Adds a duration in nanoseconds."""
+        if value < 0:
+            value = 0
+        elif value > self.highest:
+            value = self.highest
+
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, percent):
+        """Returns the value below which percent of the values are."""
+        if not self.count:
+            return 0
+
+        target = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_value(index), self.max)
+
+        return self.max
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0
+
+        return self.total / float(self.count)
+
+    def summary(self, percentiles=PERCENTILES):
+        """Returns the count, min, mean, max and percentiles in
+        microseconds."""
+        summary = {
+            "count": self.count,
+            "min": (self.min or 0) / 1e3,
+            "mean": self.mean / 1e3,
+            "max": self.max / 1e3,
+        }
+
+        for percent in percentiles:
+            name = "p{0:g}".format(percent)
+            summary[name] = self.percentile(percent) / 1e3
+
+        return summary
+
+
+class LatencyTracker(object):
+    """Keeps a latency histogram for each stage of the pipeline."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+
+        return histogram
+
+    def record(self, stage, value):
+        """Adds a duration in nanoseconds to a stage."""
+        self.histogram(stage).record(value)
+
+    def wrap(self, stage, func):
+        """Returns a function that records the duration of each call to
+        func as a stage."""
+        record = self.histogram(stage).record
+
+        def wrapper(*args, **kwargs):
+            start = clock_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(clock_ns() - start)
+
+        return wrapper
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def summary(self):
+        """Returns the summary of each stage with any values."""
+        return dict((stage, histogram.summary())
+                    for stage, histogram in self.histograms.items()
+                    if histogram.count)
+
+    def format_summary(self):
+        """Returns a line for each stage, sorted by stage name."""
+        lines = []
+        names = ["min", "mean"] + ["p{0:g}".format(p) for p in PERCENTILES]
+        names.append("max")
+
+        for stage, summary in sorted(self.summary().items()):
+            values = " ".join("{0}={1:.1f}".format(name, summary[name])
+                              for name in names)
+            lines.append("{0}: n={1} {2} (us)".format(stage, summary["count"],
+                                                      values))
+
+        return lines
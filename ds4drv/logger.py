@@ -1,17 +1,33 @@
+import atexit
 import sys
+import time
 
-from threading import Lock
+from collections import deque
+from threading import Lock, Thread
 
 
 LEVELS = ["none", "error", "warning", "info"]
 FORMAT = "[{level}][{module}] {msg}\n"
 
+# Maximum number of messages waiting to be written in async mode and
+# how often they are written.
+LOG_QUEUE_SIZE = 4096
+LOG_FLUSH_INTERVAL = 0.1
+
+
+def format_line(module, level, msg, args, kwargs):
+    msg = str(msg).format(*args, **kwargs)
+    return FORMAT.format(module=module, level=LEVELS[level], msg=msg)
+
 
 class Logger(object):
     def __init__(self):
         self.output = sys.stdout
         self.level = 0
         self.lock = Lock()
+        self.queue = None
+        self.dropped = 0
+        self.reported_drops = 0
 
     def new_module(self, module):
         return LoggerModule(self, module)
@@ -27,16 +43,93 @@ class Logger(object):
     def set_output(self, output):
         self.output = output
 
+    def start_async(self, size=LOG_QUEUE_SIZE, interval=LOG_FLUSH_INTERVAL):
+        """Writes messages from a background thread.
+
+        Messages are put in a queue and formatted and written in batches
+        by the thread, so logging never waits for the output. If the queue is full new messages
+        are dropped and the number of dropped messages is logged.
+        """
+        if self.queue is not None:
+            return
+
+        self.queue = deque()
+        self.queue_size = size
+        self.flush_interval = interval
+        self.start_writer()
+
+        atexit.register(self.flush)
+
+    def start_writer(self):
+        thread = Thread(target=self.write_loop)
+        thread.daemon = True
+        thread.start()
+
+    def after_fork(self):
+        """Restarts the writer thread in a forked process.
+
+        Messages queued before the fork are left to the parent.
+        """
+        if self.queue is not None:
+            self.queue.clear()
+            self.start_writer()
+
+    def write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Writes any queued messages."""
+        queue = self.queue
+        if queue is None:
+            return
+
+        with self.lock:
+            lines = []
+            while queue:
+                module, level, msg, args, kwargs = queue.popleft()
+                try:
+                    lines.append(format_line(module, level, msg, args,
+                                             kwargs))
+                except Exception as err:
+                    lines.append(format_line(
+                        "logger", 1, "Unable to format message {0!r}: {1}",
+                        (msg, err), {}))
+
+            dropped = self.dropped - self.reported_drops
+            if dropped:
+                self.reported_drops += dropped
+                lines.append(format_line(
+                    "logger", 2, "Dropped {0} messages, the queue was full",
+                    (dropped,), {}))
+
+            if not lines:
+                return
+
+            try:
+                self.output.write("".join(lines))
+                if hasattr(self.output, "flush"):
+                    self.output.flush()
+            except (OSError, IOError):
+                pass
+
     def msg(self, module, level, msg, *args, **kwargs):
         if self.level < level or level > len(LEVELS):
             return
 
-        msg = str(msg).format(*args, **kwargs)
+        queue = self.queue
+        if queue is not None:
+            if len(queue) < self.queue_size:
+                queue.append((module, level, msg, args, kwargs))
+            else:
+                self.dropped += 1
+            return
+
+        line = format_line(module, level, msg, args, kwargs)
 
         with self.lock:
-            self.output.write(FORMAT.format(module=module,
-                                            level=LEVELS[level],
-                                            msg=msg))
+            self.output.write(line)
             if hasattr(self.output, "flush"):
                 self.output.flush()
 
@@ -0,0 +1,188 @@
+"""Metrics about the controllers in the Prometheus text format.
+
+Counters are plain attributes updated where things happen and are only
+formatted when they are scraped, so keeping them up to date costs
+about as much as incrementing an attribute. The metrics are served
+over a UNIX socket to anyone who connects, either as a HTTP response
+or as plain text if the request is not HTTP, e.g.:
+
+    $ curl --unix-socket /run/ds4drv.metrics http://localhost/metrics
+"""
+
+from .server import UnixServer
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Requests larger than this are answered without reading the rest.
+MAX_REQUEST_SIZE = 8192
+
+METRICS = (
+    ("connected", "gauge",
+     "Whether a device is connected to the controller"),
+    ("reports_total", "counter",
+     "Reports read from the device"),
+    ("invalid_reports_total", "counter",
+     "Reports ignored because of an invalid size or report id"),
+    ("coalesced_reports_total", "counter",
+     "Reports dropped by --coalesce-reports"),
+    ("report_rate", "gauge",
+     "Reports per second received during the last second"),
+    ("battery_percent", "gauge",
+     "Battery level in percent"),
+    ("usb_connected", "gauge",
+     "Whether a USB cable is connected to the device"),
+    ("uinput_events_total", "counter",
+     "Events written to the uinput devices"),
+    ("binding_invocations_total", "counter",
+     "Button bindings that have been triggered"),
+    ("loop_iterations_total", "counter",
+     "Wakeups of the event loop running the controller"),
+    ("loop_busy_seconds_total", "counter",
+     "Time the event loop running the controller spent handling "
+     "events and timers"),
+)
+
+
+class ControllerMetrics(object):
+    """Counters and gauges of a controller."""
+
+    def __init__(self, index, loop=None):
+        self.index = index
+        self.loop = loop
+        self.device = None
+        self.remote = None
+
+        self.reports = 0
+        self.invalid_reports = 0
+        self.coalesced_reports = 0
+        self.report_rate = None
+        self.battery = None
+        self.usb_connected = None
+        self.uinput_events = 0
+        self.binding_invocations = 0
+
+    def attach_device(self, device):
+        self.device = device
+
+    def detach_device(self):
+        """Keeps the counts of the device once it is gone."""
+        device = self.device
+        if device:
+            self.invalid_reports += device.invalid_reports
+            self.coalesced_reports += device.coalesced_reports
+            self.device = None
+
+        self.report_rate = None
+        self.battery = None
+        self.usb_connected = None
+
+    def update(self, values):
+        """Replaces the metrics with a snapshot from another process."""
+        self.remote = values
+
+    def snapshot(self):
+        """Returns the current value of each metric by name.
+
+        Metrics without a value are None.
+        """
+        if self.remote is not None:
+            return self.remote
+
+        device = self.device
+        invalid_reports = self.invalid_reports
+        coalesced_reports = self.coalesced_reports
+        if device:
+            invalid_reports += device.invalid_reports
+            coalesced_reports += device.coalesced_reports
+
+        values = {
+            "connected": int(device is not None),
+            "reports_total": self.reports,
+            "invalid_reports_total": invalid_reports,
+            "coalesced_reports_total": coalesced_reports,
+            "report_rate": self.report_rate,
+            "battery_percent": self.battery,
+            "usb_connected": self.usb_connected,
+            "uinput_events_total": self.uinput_events,
+            "binding_invocations_total": self.binding_invocations,
+            "loop_iterations_total": None,
+            "loop_busy_seconds_total": None,
+        }
+
+        loop = self.loop
+        if loop:
+            values["loop_iterations_total"] = loop.iterations
+            values["loop_busy_seconds_total"] = loop.busy_time
+
+        return values
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(int(value))
+
+
+def render_metrics(sources, prefix="ds4drv_"):
+    """Formats the metrics of controllers in the Prometheus text
+    format."""
+    snapshots = [(source.index, source.snapshot()) for source in sources]
+    lines = []
+
+    for name, type, help in METRICS:
+        full_name = prefix + name
+        lines.append("# HELP {0} {1}".format(full_name, help))
+        lines.append("# TYPE {0} {1}".format(full_name, type))
+
+        for index, values in snapshots:
+            value = values.get(name)
+            if value is not None:
+                lines.append('{0}{{controller="{1}"}} {2}'.format(
+                             full_name, index, format_value(value)))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(UnixServer):
+    """Serves metrics on a UNIX socket watched by a event loop.
+
+    collect is called for each request and should return the
+    ControllerMetrics to serve.
+    """
+
+    def __init__(self, loop, path, collect):
+        super(MetricsServer, self).__init__(loop, path)
+        self.collect = collect
+
+    def handle_data(self, connection, data):
+        request = connection.buffer
+        request += data
+
+        # HTTP requests end with a empty line, anything else with the
+        # first line.
+        line, sep, rest = bytes(request).partition(b"\n")
+        if not sep and len(request) < MAX_REQUEST_SIZE:
+            return
+
+        http = b"HTTP/" in line
+        if (http and b"\n\r\n" not in request and b"\n\n" not in request and
+            len(request) < MAX_REQUEST_SIZE):
+            return
+
+        self.respond(connection, http)
+        self.close_connection(connection)
+
+    def respond(self, connection, http):
+        body = render_metrics(self.collect()).encode("utf8")
+
+        if http:
+            header = ("HTTP/1.0 200 OK\r\n"
+                      "Content-Type: {0}\r\n"
+                      "Content-Length: {1}\r\n"
+                      "Connection: close\r\n\r\n").format(CONTENT_TYPE,
+                                                          len(body))
+            body = header.encode("utf8") + body
+
+        connection.send(body)
@@ -0,0 +1,108 @@
+"""Writing of output reports, which set the rumble motors and LED."""
+
+
+class OutputReportWriter(object):
+    """Writes the output state of a device as output reports.
+
+    The report is built in a buffer that is reused for every write, and
+    nothing is written if the state is the same as in the last report.
+    Once attached to a timer, at most one report is written per
+    interval of the timer. Changes made in between are merged and written together
+    once the interval has passed.
+    """
+
+    def __init__(self, device):
+        self.device = device
+
+        if device.type == "bluetooth":
+            self.buf = bytearray(77)
+            self.buf[0] = 128
+            self.buf[2] = 255
+            self.offset = 2
+            self.report_id = 0x11
+        else:
+            self.buf = bytearray(31)
+            self.buf[0] = 255
+            self.offset = 0
+            self.report_id = 0x05
+
+        self.timer = None
+        self.pending = 0
+        self.written = None
+
+    def attach(self, timer):
+        """Starts limiting the rate of writes.
+
+        The timer must call interval_passed when it fires.
+        """
+        self.timer = timer
+
+    def detach(self):
+        """Stops limiting the rate, writing any pending state."""
+        timer = self.timer
+        if timer:
+            self.timer = None
+            timer.stop()
+
+            if self.pending:
+                self.flush()
+
+    def request(self, writes=1):
+        """Requests the current state to be written.
+
+        writes is the number of reports to write, a state that needs
+        more than one report is written even if it has not changed.
+        """
+        if (writes == 1 and not self.pending and
+            self.device.output_state() == self.written):
+            return
+
+        self.pending = max(self.pending, writes)
+
+        timer = self.timer
+        if not (timer and timer.active):
+            self.flush()
+
+    def flush(self):
+        """Writes the current state and waits for the interval to pass
+        if there are more writes pending."""
+        state = self.device.output_state()
+        (small_rumble, big_rumble), led, led_flash = state
+
+        buf = self.buf
+        offset = self.offset
+
+        # Rumble
+        buf[offset+3] = min(small_rumble, 255)
+        buf[offset+4] = min(big_rumble, 255)
+
+        # LED (red, green, blue)
+        buf[offset+5] = min(led[0], 255)
+        buf[offset+6] = min(led[1], 255)
+        buf[offset+7] = min(led[2], 255)
+
+        # Time to flash bright (255 = 2.5 seconds)
+        buf[offset+8] = min(led_flash[0], 255)
+
+        # Time to flash dark (255 = 2.5 seconds)
+        buf[offset+9] = min(led_flash[1], 255)
+
+        self.pending -= 1
+        self.written = state
+
+        timer = self.timer
+        if timer and timer.interval > 0:
+            timer.start()
+
+        self.device.write_report(self.report_id, buf)
+
+        # Without a timer there is nothing to wait for
+        if self.pending and not (timer and timer.active):
+            self.flush()
+
+    def interval_passed(self):
+        if self.pending:
+            try:
+                self.flush()
+            except (IOError, OSError):
+                self.pending = 0
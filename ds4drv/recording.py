@@ -0,0 +1,213 @@
+"""Reading and writing recordings of raw HID reports.
+
+A recording starts with a header identifying the format and the type
+of device the reports were read from, followed by a record for each
+report. Each record contains a monotonic timestamp in nanoseconds, the
+length of the report and the report itself. Reports are stored the
+way they are parsed, with any Bluetooth header already cut off.
+
+Later sessions are appended to the same recording, each starting with
+an empty record. Timestamps are only comparable within a session, so
+when reading, the timestamps of each session are moved so that its
+first report follows the last report of the previous one.
+"""
+
+from collections import deque
+from struct import Struct
+from threading import Condition, Thread
+
+from .eventloop import monotonic
+
+
+RECORDING_MAGIC = b"DS4R"
+RECORDING_VERSION = 1
+RECORDING_DEVICE_TYPES = ("usb", "bluetooth")
+
+HEADER_STRUCT = Struct("<4sBB")
+RECORD_STRUCT = Struct("<QH")
+
+# Size of the buffer reports are collected in before being written.
+RECORDER_BUFFER_SIZE = 64 * 1024
+
+
+class RecordingError(Exception):
+    """Recording related errors."""
+
+
+class ReportRecorder(object):
+    """Appends reports to a recording.
+
+    Records are collected in a buffer, which is handed to a writer
+    thread once it is full or flush is called, so recording never waits
+    for the file. Recording to an existing file appends to it, as long
+    as it was recorded from the same type of device.
+    """
+
+    def __init__(self, filename, device_type):
+        try:
+            type_index = RECORDING_DEVICE_TYPES.index(device_type)
+        except ValueError:
+            raise RecordingError("Unknown device type: {0}".format(device_type))
+
+        try:
+            self.fd = open(filename, "ab")
+            self.fd.seek(0, 2)
+            size = self.fd.tell()
+
+            if size:
+                with open(filename, "rb") as fd:
+                    header = fd.read(HEADER_STRUCT.size)
+        except (OSError, IOError) as err:
+            raise RecordingError(err)
+
+        if size:
+            try:
+                recorded_type = parse_header(header, filename)
+            except RecordingError:
+                self.fd.close()
+                raise
+
+            if recorded_type != device_type:
+                self.fd.close()
+                raise RecordingError("{0} is a recording of a {1} "
+                                     "device".format(filename, recorded_type))
+
+            # Marks the start of a new session
+            self.buffer = bytearray(RECORD_STRUCT.pack(
+                int(monotonic() * 1e9), 0))
+        else:
+            self.buffer = bytearray(HEADER_STRUCT.pack(RECORDING_MAGIC,
+                                                       RECORDING_VERSION,
+                                                       type_index))
+        self.records = 0
+
+        # Buffers waiting to be written and the first write error
+        self.pending = deque()
+        self.condition = Condition()
+        self.closed = False
+        self.error = None
+
+        self.thread = Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, buf, timestamp=None, pack=RECORD_STRUCT.pack):
+        """Adds a report to the recording."""
+        if timestamp is None:
+            timestamp = monotonic()
+
+        buffer = self.buffer
+        buffer += pack(int(timestamp * 1e9), len(buf))
+        buffer += buf
+        self.records += 1
+
+        if len(buffer) >= RECORDER_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Hands any buffered records to the writer thread."""
+        if self.buffer:
+            with self.condition:
+                self.pending.append(self.buffer)
+                self.condition.notify()
+
+            self.buffer = bytearray()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not (self.pending or self.closed):
+                    self.condition.wait()
+
+                if not self.pending:
+                    return
+
+                buffer = self.pending.popleft()
+
+            if self.error:
+                continue
+
+            try:
+                self.fd.write(buffer)
+                self.fd.flush()
+            except (OSError, IOError) as err:
+                self.error = err
+
+    def close(self):
+        """Writes the remaining records and closes the file.
+
+        Raises RecordingError if any of the writes failed.
+        """
+        self.flush()
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        self.thread.join()
+        self.fd.close()
+
+        if self.error:
+            raise RecordingError(self.error)
+
+
+def parse_header(data, filename):
+    """Returns the device type of a recording starting with data."""
+    if len(data) < HEADER_STRUCT.size:
+        raise RecordingError("Not a report recording: {0}".format(filename))
+
+    magic, version, type_index = HEADER_STRUCT.unpack_from(data)
+    if magic != RECORDING_MAGIC:
+        raise RecordingError("Not a report recording: {0}".format(filename))
+
+    if version != RECORDING_VERSION:
+        raise RecordingError("Unsupported recording version: {0}".format(
+                             version))
+
+    if type_index >= len(RECORDING_DEVICE_TYPES):
+        raise RecordingError("Unknown device type in recording")
+
+    return RECORDING_DEVICE_TYPES[type_index]
+
+
+def read_recording(filename):
+    """Reads a recording.
+
+    Returns the device type and a list of (timestamp, report) tuples,
+    with timestamps in seconds.
+    """
+    try:
+        with open(filename, "rb") as fd:
+            data = fd.read()
+    except (OSError, IOError) as err:
+        raise RecordingError(err)
+
+    device_type = parse_header(data, filename)
+
+    reports = []
+    shift = 0
+    new_session = False
+    offset = HEADER_STRUCT.size
+    while offset + RECORD_STRUCT.size <= len(data):
+        timestamp, length = RECORD_STRUCT.unpack_from(data, offset)
+        offset += RECORD_STRUCT.size
+        timestamp /= 1e9
+
+        if not length:
+            new_session = bool(reports)
+            continue
+
+        report = bytearray(data[offset:offset + length])
+        offset += length
+
+        # Recording was cut off in the middle of a report
+        if len(report) < length:
+            break
+
+        if new_session:
+            new_session = False
+            shift = reports[-1][0] - timestamp
+
+        reports.append((timestamp + shift, report))
+
+    return device_type, reports
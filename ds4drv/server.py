@@ -0,0 +1,114 @@
+"""UNIX socket servers handled by a event loop."""
+
+import errno
+import os
+import socket
+import stat
+
+from functools import partial
+
+
+class Connection(object):
+    """A client connected to a server."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def send(self, data):
+        """Sends data to the client.
+
+        Responses are small enough to fit in the socket buffer, so a
+        client that is not reading them is simply disconnected.
+        """
+        if self.closed:
+            return False
+
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            return False
+
+        return True
+
+
+class UnixServer(object):
+    """Accepts connections on a UNIX socket watched by a event loop.
+
+    Subclasses handle the data read from each connection.
+    """
+
+    connection_class = Connection
+
+    def __init__(self, loop, path):
+        self.loop = loop
+        self.path = path
+        self.connections = {}
+
+        # Remove the socket left behind by a previous run
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+
+        loop.add_watcher(self.sock, self.accept)
+
+    def accept(self):
+        try:
+            sock, addr = self.sock.accept()
+        except socket.error:
+            return
+
+        sock.setblocking(False)
+        connection = self.connection_class(sock)
+        self.connections[connection.fd] = connection
+        self.loop.add_watcher(connection.fd, partial(self.read, connection))
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(4096)
+        except socket.error as err:
+            if err.errno == errno.EAGAIN:
+                return
+
+            data = None
+
+        if data:
+            self.handle_data(connection, data)
+        else:
+            self.handle_eof(connection)
+
+    def handle_data(self, connection, data):
+        raise NotImplementedError
+
+    def handle_eof(self, connection):
+        self.close_connection(connection)
+
+    def close_connection(self, connection):
+        if connection.closed:
+            return
+
+        connection.closed = True
+        self.connections.pop(connection.fd, None)
+        self.loop.remove_watcher(connection.fd)
+        connection.sock.close()
+
+    def close(self):
+        for connection in list(self.connections.values()):
+            self.close_connection(connection)
+
+        self.loop.remove_watcher(self.sock)
+        self.sock.close()
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -1,12 +1,27 @@
+import ctypes
+import errno
+import fcntl
+import os
 import os.path
 import time
 
 from collections import namedtuple
+from operator import attrgetter
+from struct import Struct
 
 from evdev import UInput, UInputError, ecodes
 from evdev import util
 
+try:
+    from evdev import ff
+except ImportError:
+    # Force feedback needs python-evdev >= 1.0
+    ff = None
+
+from .device import REPORT_ALL_FIELDS, REPORT_FIELD_MASKS
+from .eventloop import monotonic
 from .exceptions import DeviceError
+from .utils import zero_copy_slice
 
 # Check for the existence of a "resolve_ecodes_dict" function.
 # Need to know if axis options tuples should be altered.
@@ -27,6 +42,38 @@ UInputMapping = namedtuple("UInputMapping",
                            "axes axes_options buttons hats keys mouse "
                            "mouse_options")
 
+EmitPlan = namedtuple("EmitPlan", "axes buttons hats mouse")
+
+# Kinds of mouse plan entries
+MOUSE_BUTTON = 0
+MOUSE_TOUCH = 1
+MOUSE_ANALOG = 2
+
+# struct input_event, the timestamp is left blank since the kernel
+# fills it in for events written to uinput.
+INPUT_EVENT = Struct("llHHi")
+
+# Number of events to read from a uinput device at a time
+READ_EVENTS = 16
+
+# Rumble effect uploaded to a uinput device, magnitudes are 0-0xffff and
+# times are in milliseconds.
+RumbleEffect = namedtuple("RumbleEffect", "strong weak length delay")
+
+
+def _uinput_ioc(direction, nr, struct):
+    return ((direction << 30) | (ctypes.sizeof(struct) << 16) |
+            (ord("U") << 8) | nr)
+
+
+# The upload and erase helpers of python-evdev do not pass on the
+# request id, so the ioctls are made here instead.
+if ff:
+    UI_BEGIN_FF_UPLOAD = _uinput_ioc(3, 200, ff.UInputUpload)
+    UI_END_FF_UPLOAD = _uinput_ioc(1, 201, ff.UInputUpload)
+    UI_BEGIN_FF_ERASE = _uinput_ioc(3, 202, ff.UInputErase)
+    UI_END_FF_ERASE = _uinput_ioc(1, 203, ff.UInputErase)
+
 _mappings = {}
 
 # Add our simulated mousewheel codes
@@ -232,11 +279,77 @@ create_mapping(
 )
 
 
+def compile_emit_plan(layout):
+    """Compiles a mapping into a plan used to emit reports.
+
+    The plan contains flat tuples of getters, field masks and pre-resolved
+    modifiers and thresholds, so that emitting a report does not need to
+    do any string handling.
+
+    - axes: (code, getter, mask)
+    - buttons: (code, getter, mask, modifier, threshold), where modifier
+      is 1 if the value must be above threshold, -1 if it must be below
+      it and 0 to use the value as is.
+    - hats: (code, negative getter, positive getter, mask)
+    - mouse: (code, getter, kind, active getter, sign, wheel value)
+    """
+    axes = []
+    for name, attr in layout.axes.items():
+        axes.append((name, attrgetter(attr), REPORT_FIELD_MASKS[attr]))
+
+    buttons = []
+    for name, (attr, modifier) in layout.buttons.items():
+        if modifier and "analog" in attr:
+            if modifier == "+":
+                modifier, threshold = 1, 128 + DEFAULT_A2D_DEADZONE
+            else:
+                modifier, threshold = -1, 128 - DEFAULT_A2D_DEADZONE
+        else:
+            modifier, threshold = 0, 0
+
+        buttons.append((name, attrgetter(attr), REPORT_FIELD_MASKS[attr],
+                        modifier, threshold))
+
+    hats = []
+    for name, (negative, positive) in layout.hats.items():
+        hats.append((name, attrgetter(negative), attrgetter(positive),
+                     REPORT_FIELD_MASKS[negative] |
+                     REPORT_FIELD_MASKS[positive]))
+
+    mouse = []
+    for name, (attr, modifier) in layout.mouse.items():
+        active = None
+        if attr.startswith("trackpad_touch"):
+            kind = MOUSE_TOUCH
+            active = attrgetter(attr[:16] + "active")
+        elif "analog" in attr:
+            kind = MOUSE_ANALOG
+        else:
+            kind = MOUSE_BUTTON
+
+        # If a minus modifier has been given then minus the acceleration
+        # to invert the direction.
+        sign = -1 if modifier == "-" else 1
+
+        if name == ecodes.REL_WHEELUP:
+            wheel = 1
+        elif name == ecodes.REL_WHEELDOWN:
+            wheel = -1
+        else:
+            wheel = 0
+
+        mouse.append((name, attrgetter(attr), kind, active, sign, wheel))
+
+    return EmitPlan(tuple(axes), tuple(buttons), tuple(hats), tuple(mouse))
+
+
 class UInputDevice(object):
     def __init__(self, layout):
         self.joystick_dev = None
         self.evdev_dev = None
         self.ignored_buttons = set()
+        self.ignored_mask = 0
+        self.emit_all = True
         self.create_device(layout)
 
         self._write_cache = {}
@@ -267,9 +380,18 @@ class UInputDevice(object):
         for name in layout.buttons:
             events[ecodes.EV_KEY].append(name)
 
+        # Let applications rumble the joystick, unless UInput is not
+        # able to handle force feedback.
+        if self.joystick_dev and hasattr(UInput, "begin_upload"):
+            events[ecodes.EV_FF] = [ecodes.FF_RUMBLE, ecodes.FF_GAIN]
+            self.effects = {}
+        else:
+            self.effects = None
+
+        self.mouse_pos = {}
+        self.mouse_rel = {}
+
         if layout.mouse:
-            self.mouse_pos = {}
-            self.mouse_rel = {}
             self.mouse_analog_sensitivity = float(
                 layout.mouse_options.get("MOUSE_SENSITIVITY",
                                          DEFAULT_MOUSE_SENSITIVTY)
@@ -300,48 +422,186 @@ class UInputDevice(object):
                              bustype=layout.bustype, vendor=layout.vendor,
                              product=layout.product, version=layout.version)
         self.layout = layout
+        self.plan = compile_emit_plan(layout)
+
+        # Enough room for every event a single report can generate
+        # plus the SYN_REPORT.
+        capacity = (len(layout.axes) + len(layout.buttons) +
+                    len(layout.hats) + len(layout.mouse) + 1)
+        self._events = bytearray(INPUT_EVENT.size * capacity)
+        self._events_len = 0
+
+        # ControllerMetrics to count the written events in, if any
+        self.metrics = None
+
+    def queue_event(self, etype, code, value):
+        """Queues a event to be written to the device on the next syn()."""
+        if self._events_len == len(self._events):
+            self.flush()
+
+        INPUT_EVENT.pack_into(self._events, self._events_len,
+                              0, 0, etype, code, value)
+        self._events_len += INPUT_EVENT.size
 
     def write_event(self, etype, code, value):
-        """Writes a event to the device, if it has changed."""
+        """Queues a event to the device, if it has changed."""
         last_value = self._write_cache.get(code)
         if last_value != value:
-            self.device.write(etype, code, value)
+            self.queue_event(etype, code, value)
             self._write_cache[code] = value
 
+    def flush(self):
+        """Writes all queued events to the device with a single write."""
+        if self._events_len:
+            # The events are dropped if the write fails, so that the
+            # buffer never overflows.
+            try:
+                os.write(self.device.fd,
+                         zero_copy_slice(self._events, 0, self._events_len))
+
+                if self.metrics:
+                    self.metrics.uinput_events += (self._events_len //
+                                                   INPUT_EVENT.size)
+            finally:
+                self._events_len = 0
+
+    def syn(self):
+        """Queues a SYN_REPORT and writes all queued events."""
+        self.queue_event(ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+        self.flush()
+
+    def read_ff_events(self):
+        """Reads the force feedback requests made to the device.
+
+        Effects are uploaded and erased right away, while requests to
+        play them and to change the gain are returned as a list of
+        (code, value) tuples.
+        """
+        try:
+            data = os.read(self.device.fd, INPUT_EVENT.size * READ_EVENTS)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        for offset in range(0, len(data), INPUT_EVENT.size):
+            sec, usec, etype, code, value = INPUT_EVENT.unpack_from(data,
+                                                                    offset)
+            if etype == ecodes.EV_FF:
+                events.append((code, value))
+            elif etype == ecodes.EV_UINPUT:
+                if code == ecodes.UI_FF_UPLOAD:
+                    self.upload_effect(value)
+                elif code == ecodes.UI_FF_ERASE:
+                    self.erase_effect(value)
+
+        return events
+
+    def upload_effect(self, request_id):
+        upload = ff.UInputUpload()
+        upload.request_id = request_id
+        fcntl.ioctl(self.device.fd, UI_BEGIN_FF_UPLOAD, upload)
+
+        effect = upload.effect
+        if effect.type == ecodes.FF_RUMBLE:
+            rumble = effect.u.ff_rumble_effect
+            replay = effect.ff_replay
+            self.effects[effect.id] = RumbleEffect(rumble.strong_magnitude,
+                                                   rumble.weak_magnitude,
+                                                   replay.length,
+                                                   replay.delay)
+            upload.retval = 0
+        else:
+            upload.retval = -errno.EINVAL
+
+        fcntl.ioctl(self.device.fd, UI_END_FF_UPLOAD, upload)
+
+    def erase_effect(self, request_id):
+        erase = ff.UInputErase()
+        erase.request_id = request_id
+        fcntl.ioctl(self.device.fd, UI_BEGIN_FF_ERASE, erase)
+
+        self.effects.pop(erase.effect_id, None)
+        erase.retval = 0
+
+        fcntl.ioctl(self.device.fd, UI_END_FF_ERASE, erase)
+
+    def set_ignored_buttons(self, buttons):
+        """Sets buttons that should never be sent as pressed."""
+        self.ignored_buttons = set(buttons)
+        self.ignored_mask = 0
+        for button in self.ignored_buttons:
+            self.ignored_mask |= REPORT_FIELD_MASKS.get(button, 0)
+
+        # Buttons that are held down must be released
+        self.emit_all = True
+
     def emit(self, report):
         """Writes axes, buttons and hats with values from the report to
         the device."""
-        for name, attr in self.layout.axes.items():
-            value = getattr(report, attr)
-            self.write_event(ecodes.EV_ABS, name, value)
-
-        for name, attr in self.layout.buttons.items():
-            attr, modifier = attr
-
-            if attr in self.ignored_buttons:
+        if self.emit_all:
+            changed = REPORT_ALL_FIELDS
+            self.emit_all = False
+        else:
+            changed = report.changed
+
+        plan = self.plan
+        ignored = self.ignored_mask
+        cache = self._write_cache
+
+        # This is the same as calling write_event for each value, but
+        # inlined since it's called for every report. The event buffer
+        # has room for every axis, button and hat in the layout.
+        events = self._events
+        pos = self._events_len
+        pack_into = INPUT_EVENT.pack_into
+        size = INPUT_EVENT.size
+
+        for name, getter, mask in plan.axes:
+            if changed & mask:
+                value = getter(report)
+                if cache.get(name) != value:
+                    cache[name] = value
+                    pack_into(events, pos, 0, 0, ecodes.EV_ABS, name, value)
+                    pos += size
+
+        for name, getter, mask, modifier, threshold in plan.buttons:
+            if not changed & mask:
+                continue
+
+            if ignored & mask:
                 value = False
+            elif modifier > 0:
+                value = getter(report) > threshold
+            elif modifier < 0:
+                value = getter(report) < threshold
             else:
-                value = getattr(report, attr)
+                value = getter(report)
 
-            if modifier and "analog" in attr:
-                if modifier == "+":
-                    value = value > (128 + DEFAULT_A2D_DEADZONE)
-                elif modifier == "-":
-                    value = value < (128 - DEFAULT_A2D_DEADZONE)
+            if cache.get(name) != value:
+                cache[name] = value
+                pack_into(events, pos, 0, 0, ecodes.EV_KEY, name, value)
+                pos += size
 
-            self.write_event(ecodes.EV_KEY, name, value)
+        for name, negative, positive, mask in plan.hats:
+            if not changed & mask:
+                continue
 
-        for name, attr in self.layout.hats.items():
-            if getattr(report, attr[0]):
+            if negative(report):
                 value = -1
-            elif getattr(report, attr[1]):
+            elif positive(report):
                 value = 1
             else:
                 value = 0
 
-            self.write_event(ecodes.EV_ABS, name, value)
+            if cache.get(name) != value:
+                cache[name] = value
+                pack_into(events, pos, 0, 0, ecodes.EV_ABS, name, value)
+                pos += size
 
-        self.device.syn()
+        self._events_len = pos
+        self.syn()
 
     def emit_reset(self):
         """Resets the device to a blank state."""
@@ -355,50 +615,52 @@ class UInputDevice(object):
         for name in self.layout.hats:
             self.write_event(ecodes.EV_ABS, name, 0)
 
-        self.device.syn()
+        self.syn()
+
+        # The next report must be written in full, since the values
+        # written here are not what the previous report contained.
+        self.emit_all = True
 
     def emit_mouse(self, report):
         """Calculates relative mouse values from a report and writes them."""
-        for name, attr in self.layout.mouse.items():
-            # If the attr is a tuple like (left_analog_y, "-")
-            # then set the attr to just be the first item
-            attr, modifier = attr
-
-            if attr.startswith("trackpad_touch"):
-                active_attr = attr[:16] + "active"
-                if not getattr(report, active_attr):
-                    self.mouse_pos.pop(name, None)
+        if not self.plan.mouse:
+            return
+
+        mouse_pos = self.mouse_pos
+        mouse_rel = self.mouse_rel
+
+        for name, getter, kind, active, sign, wheel in self.plan.mouse:
+            if kind == MOUSE_TOUCH:
+                if not active(report):
+                    mouse_pos.pop(name, None)
                     continue
 
-                pos = getattr(report, attr)
-                if name not in self.mouse_pos:
-                    self.mouse_pos[name] = pos
+                pos = getter(report)
+                if name not in mouse_pos:
+                    mouse_pos[name] = pos
 
                 sensitivity = 0.5
-                self.mouse_rel[name] += (pos - self.mouse_pos[name]) * sensitivity
-                self.mouse_pos[name] = pos
+                mouse_rel[name] += (pos - mouse_pos[name]) * sensitivity
+                mouse_pos[name] = pos
 
-            elif "analog" in attr:
-                pos = getattr(report, attr)
+            elif kind == MOUSE_ANALOG:
+                pos = getter(report)
                 if (pos > (128 + self.mouse_analog_deadzone)
                     or pos < (128 - self.mouse_analog_deadzone)):
                     accel = (pos - 128) / 10
                 else:
                     continue
 
-                # If a minus modifier has been given then minus the acceleration
-                # to invert the direction.
-                if (modifier and modifier == "-"):
-                    accel = -accel
+                accel = sign * accel
 
                 sensitivity = self.mouse_analog_sensitivity
-                self.mouse_rel[name] += accel * sensitivity
+                mouse_rel[name] += accel * sensitivity
 
             # Emulate mouse wheel (needs special handling)
-            if name in (ecodes.REL_WHEELUP, ecodes.REL_WHEELDOWN):
+            if wheel:
                 ecode = ecodes.REL_WHEEL # The real event we need to emit
                 write = False
-                if getattr(report, attr):
+                if getter(report):
                     self._scroll_details['direction'] = name
                     now = time.time()
                     last_write = self._scroll_details.get('last_write')
@@ -406,10 +668,6 @@ class UInputDevice(object):
                         # No delay for the first button press for fast feedback
                         write = True
                         self._scroll_details['count'] = 0
-                    if name == ecodes.REL_WHEELUP:
-                        value = 1
-                    elif name == ecodes.REL_WHEELDOWN:
-                        value = -1
                     if last_write:
                         # Delay at least one cycle before continual scrolling
                         if self._scroll_details['count'] > 1:
@@ -418,7 +676,7 @@ class UInputDevice(object):
                         elif now - last_write > self.scroll_repeat_delay:
                             write = True
                     if write:
-                        self.device.write(ecodes.EV_REL, ecode, value)
+                        self.queue_event(ecodes.EV_REL, ecode, wheel)
                         self._scroll_details['last_write'] = now
                         self._scroll_details['count'] += 1
                         continue # No need to proceed further
@@ -428,11 +686,111 @@ class UInputDevice(object):
                         self._scroll_details['last_write'] = 0
                         self._scroll_details['count'] = 0
 
-            rel = int(self.mouse_rel[name])
-            self.mouse_rel[name] = self.mouse_rel[name] - rel
-            self.device.write(ecodes.EV_REL, name, rel)
+            rel = int(mouse_rel[name])
+            mouse_rel[name] = mouse_rel[name] - rel
+            self.queue_event(ecodes.EV_REL, name, rel)
+
+        self.syn()
+
+
+class ForceFeedback(object):
+    """Plays the rumble effects of a uinput device on the motors.
+
+    Effects playing at the same time are added together. rumble is
+    called with the intensity of the small and big motor (0-255)
+    whenever it changes.
+    """
+
+    def __init__(self, loop, rumble):
+        self.loop = loop
+        self.rumble = rumble
+        self.timer = loop.create_timer(0, self.update)
+        self.device = None
+        self.gain = 0xffff
+        self.motors = (0, 0)
+
+        # Effect id -> (start time, end time or None)
+        self.playing = {}
+
+    def attach(self, device):
+        """Starts handling the requests made to a UInputDevice."""
+        self.device = device
+        self.gain = 0xffff
+        self.loop.add_watcher(device.device.fd, self.read)
+
+    def detach(self):
+        """Stops all effects and the handling of requests."""
+        if self.device:
+            self.loop.remove_watcher(self.device.device.fd)
+            self.device = None
+
+        self.stop()
 
-        self.device.syn()
+    def stop(self):
+        """Stops all effects, requests are still handled."""
+        self.playing.clear()
+        self.update()
+
+    def read(self):
+        now = monotonic()
+
+        for code, value in self.device.read_ff_events():
+            if code == ecodes.FF_GAIN:
+                self.gain = value
+                continue
+
+            effect = self.device.effects.get(code)
+            if not (effect and value):
+                self.playing.pop(code, None)
+                continue
+
+            # The effect is repeated value times
+            start = now + effect.delay / 1000.0
+            if effect.length:
+                end = start + effect.length * value / 1000.0
+            else:
+                end = None
+
+            self.playing[code] = (start, end)
+
+        self.update()
+
+    def update(self):
+        """Sets the motors to the effects playing right now."""
+        now = monotonic()
+        effects = self.device and self.device.effects or {}
+        strong = weak = 0
+        next_change = None
+
+        for effect_id, (start, end) in list(self.playing.items()):
+            effect = effects.get(effect_id)
+            if not effect or (end is not None and end <= now):
+                del self.playing[effect_id]
+                continue
+
+            if start > now:
+                change = start
+            else:
+                strong += effect.strong
+                weak += effect.weak
+                change = end
+
+            if change is not None and (next_change is None or
+                                       change < next_change):
+                next_change = change
+
+        strong = min(strong, 0xffff) * self.gain // 0xffff
+        weak = min(weak, 0xffff) * self.gain // 0xffff
+        motors = (weak >> 8, strong >> 8)
+
+        if motors != self.motors:
+            self.motors = motors
+            self.rumble(*motors)
+
+        self.timer.stop()
+        if next_change is not None:
+            self.timer.interval = max(next_change - now, 0)
+            self.timer.start()
 
 
 def create_uinput_device(mapping):
@@ -0,0 +1,514 @@
+"""Runs controllers in worker processes.
+
+The main process keeps doing device discovery and hands each device
+over to a worker process by passing its fds over a UNIX socket. A
+supervisor thread in the main process watches the workers and restarts
+any worker that crashes or stops responding, handing it the device
+again.
+"""
+
+import errno
+import os
+import pickle
+import signal
+import socket
+
+from array import array
+from collections import deque
+from functools import partial
+from itertools import count
+from threading import Thread
+from time import sleep, time
+
+from .control import error_response, run_command
+from .eventloop import EventLoop
+from .metrics import ControllerMetrics
+
+
+WORKER_HEARTBEAT = 1
+WORKER_TIMEOUT = 5
+WORKER_POLL_INTERVAL = 0.05
+WORKER_MAX_FDS = 4
+
+# Delay before restarting a worker that exited unexpectedly, doubled for
+# each restart within the window, and the number of restarts allowed
+# within the window before giving up.
+WORKER_RESTART_DELAY = 0.1
+WORKER_MAX_RESTART_DELAY = 5
+WORKER_MAX_RESTARTS = 5
+WORKER_RESTART_WINDOW = 60
+
+# Highest fd closed in workers when the open fds can not be listed
+try:
+    MAXFD = os.sysconf("SC_OPEN_MAX")
+except (AttributeError, ValueError):
+    MAXFD = 256
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_CRASHED = 2
+
+
+def send_message(sock, message, fds=None):
+    """Sends a message and optionally fds over a UNIX socket."""
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", fds))]
+        sock.sendmsg([data], ancdata)
+    else:
+        sock.send(data)
+
+
+def recv_message(sock):
+    """Receives a message and any fds sent with it.
+
+    Returns (None, []) if the other end has been closed.
+    """
+    fds = array("i")
+    data, ancdata, flags, addr = sock.recvmsg(
+        65536, socket.CMSG_LEN(WORKER_MAX_FDS * fds.itemsize)
+    )
+
+    for level, type, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+
+    if not data:
+        return None, list(fds)
+
+    return pickle.loads(data), list(fds)
+
+
+class Worker(object):
+    """Runs a controller in the worker process."""
+
+    def __init__(self, sock, controller):
+        self.sock = sock
+        self.controller = controller
+        self.stop_requested = False
+
+        loop = controller.loop
+        loop.add_watcher(sock, self.read_message)
+        loop.register_event("device-cleanup", self.device_cleanup)
+        self.heartbeat = loop.create_timer(WORKER_HEARTBEAT,
+                                           self.send_heartbeat)
+
+    def read_message(self):
+        try:
+            message, fds = recv_message(self.sock)
+        except socket.error as err:
+            if err.errno == errno.EAGAIN:
+                return
+            message, fds = None, []
+
+        # The main process is gone
+        if message is None:
+            self.stop()
+            return
+
+        command = message[0]
+        if command == "setup":
+            cls, state = message[1:]
+            device = cls.import_device(fds, state)
+            self.controller.setup_device(device)
+        elif command == "control":
+            request_id, request = message[1:]
+            self.send("control", request_id,
+                      run_command(self.controller, request))
+
+    def device_cleanup(self):
+        self.send("cleanup")
+
+    def send_heartbeat(self):
+        if self.controller.error:
+            self.controller.loop.stop()
+            return
+
+        if self.stop_requested:
+            self.stop()
+            return
+
+        self.send("heartbeat", self.controller.metrics.snapshot())
+
+        return True
+
+    def send(self, *message):
+        try:
+            send_message(self.sock, message)
+        except socket.error:
+            pass
+
+    def stop(self):
+        self.controller.exit("Cleaning up...", error=False)
+        self.controller.loop.stop()
+
+    def request_stop(self, signum, frame):
+        # Stopping right away could interrupt a handler half way
+        # through, so leave it to the next heartbeat.
+        self.stop_requested = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+
+        self.heartbeat.start()
+        self.controller.run()
+
+        if self.controller.error:
+            return EXIT_ERROR
+
+        return EXIT_OK
+
+
+class ControllerProcess(object):
+    """Manages a worker process from the main process.
+
+    Provides the same interface as ControllerThread.
+    """
+
+    def __init__(self, supervisor, index, create, dynamic=False):
+        self.supervisor = supervisor
+        self.create = create
+        self.dynamic = dynamic
+        self.controller = WorkerController(self, index)
+        self.exited = False
+        self.stopping = False
+        self.pid = None
+        self.sock = None
+
+        # Replies waiting for the response to a control command
+        self.control_replies = {}
+        self.control_ids = count()
+
+        # Times of the recent restarts
+        self.restarts = deque()
+        self.restart_timer = supervisor.loop.create_timer(0, self.restart)
+
+    def start(self):
+        sock, worker_sock = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_SEQPACKET)
+
+        # Make sure no other thread holds the logger lock while forking
+        with self.supervisor.logger.manager.lock:
+            pid = os.fork()
+
+        if pid == 0:
+            logger = self.supervisor.logger.manager
+            logger.after_fork()
+
+            sock.close()
+            self.supervisor.close_inherited_fds(worker_sock)
+            status = self.run_worker(worker_sock)
+
+            logger.flush()
+            os._exit(status)
+
+        worker_sock.close()
+        sock.setblocking(False)
+
+        self.pid = pid
+        self.sock = sock
+        self.last_seen = time()
+        self.supervisor.loop.add_watcher(sock, self.read_message)
+
+        if self.controller.device:
+            self.send_device(self.controller.device)
+
+    def run_worker(self, sock):
+        # Interrupts are handled by the main process, which stops the
+        # workers with SIGTERM.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        try:
+            sock.setblocking(False)
+            worker = Worker(sock, self.create())
+
+            if worker.controller.error:
+                return EXIT_ERROR
+
+            return worker.run()
+        except Exception as err:
+            self.supervisor.logger.error("Worker process crashed: {0}", err)
+            return EXIT_CRASHED
+
+    def send_device(self, device):
+        # A worker that is being restarted is sent the device once it
+        # has started.
+        if not self.sock:
+            return
+
+        fds, state = device.export()
+        send_message(self.sock, ("setup", type(device), state), fds)
+
+    def read_message(self):
+        try:
+            message, fds = recv_message(self.sock)
+        except socket.error as err:
+            if err.errno == errno.EAGAIN:
+                return
+            message, fds = None, []
+
+        if message is None:
+            self.worker_exited()
+            return
+
+        self.last_seen = time()
+
+        command = message[0]
+        if command == "cleanup":
+            self.close_device()
+        elif command == "heartbeat":
+            self.controller.metrics.update(message[1])
+        elif command == "control":
+            request_id, response = message[1:]
+            reply = self.control_replies.pop(request_id, None)
+            if reply:
+                reply(response)
+
+    def send_control(self, request, reply):
+        if self.exited or self.stopping or not self.sock:
+            reply(error_response("Controller has exited"))
+            return
+
+        request_id = next(self.control_ids)
+        self.control_replies[request_id] = reply
+
+        try:
+            send_message(self.sock, ("control", request_id, request))
+        except socket.error as err:
+            self.control_replies.pop(request_id)
+            reply(error_response("Unable to reach worker: {0}", err))
+
+    def fail_control_replies(self):
+        replies = list(self.control_replies.values())
+        self.control_replies.clear()
+
+        for reply in replies:
+            reply(error_response("Worker process exited"))
+
+    def close_device(self):
+        device = self.controller.device
+        if device:
+            self.controller.device = None
+            device.close()
+
+    def wait(self, timeout=None):
+        """Waits for the worker to exit and returns its exit status.
+
+        Returns None if it is still running after timeout seconds.
+        """
+        flags = 0
+        if timeout is not None:
+            flags = os.WNOHANG
+            deadline = time() + timeout
+
+        while True:
+            try:
+                pid, status = os.waitpid(self.pid, flags)
+            except OSError:
+                self.pid = None
+                return EXIT_OK
+
+            if pid:
+                break
+
+            if time() >= deadline:
+                return None
+
+            sleep(WORKER_POLL_INTERVAL)
+
+        self.pid = None
+
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+
+        return EXIT_CRASHED
+
+    def worker_exited(self):
+        self.supervisor.loop.remove_watcher(self.sock)
+        self.sock.close()
+        self.sock = None
+        self.fail_control_replies()
+
+        if self.stopping:
+            return
+
+        pid = self.pid
+        status = self.wait()
+        if status == EXIT_ERROR:
+            self.controller.error = True
+            self.exited = True
+        elif status == EXIT_OK and self.dynamic:
+            self.close_device()
+            self.exited = True
+        else:
+            self.schedule_restart(pid)
+
+    def schedule_restart(self, pid):
+        """Restarts the worker after a delay that grows with the number
+        of recent restarts, or gives up if there were too many."""
+        now = time()
+        restarts = self.restarts
+        while restarts and now - restarts[0] > WORKER_RESTART_WINDOW:
+            restarts.popleft()
+
+        if len(restarts) >= WORKER_MAX_RESTARTS:
+            self.supervisor.logger.error("Worker process {0} exited "
+                                         "unexpectedly {1} times within {2} "
+                                         "seconds, giving up", pid,
+                                         len(restarts) + 1,
+                                         WORKER_RESTART_WINDOW)
+            self.controller.error = True
+            self.exited = True
+            self.close_device()
+            return
+
+        delay = min(WORKER_RESTART_DELAY * 2 ** len(restarts),
+                    WORKER_MAX_RESTART_DELAY)
+        restarts.append(now)
+
+        self.supervisor.logger.warning("Worker process {0} exited "
+                                       "unexpectedly, restarting in "
+                                       "{1:.1f} seconds", pid, delay)
+        self.restart_timer.interval = delay
+        self.restart_timer.start()
+
+    def restart(self):
+        if not (self.stopping or self.exited):
+            self.start()
+
+    def check_heartbeat(self, now):
+        if self.exited or self.stopping or not self.pid:
+            return
+
+        if now - self.last_seen > WORKER_TIMEOUT:
+            self.supervisor.logger.warning("Worker process {0} is not "
+                                           "responding, killing it",
+                                           self.pid)
+            self.last_seen = now
+            os.kill(self.pid, signal.SIGKILL)
+
+    def is_alive(self):
+        return not self.exited
+
+    def setup_device(self, device):
+        self.controller.setup_device(device)
+
+    def stop(self):
+        self.stopping = True
+
+        # The worker may be waiting to be restarted
+        pid = self.pid
+        if not self.exited and pid:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+            # A worker that does not respond is killed
+            if self.wait(WORKER_TIMEOUT) is None:
+                self.supervisor.logger.warning("Worker process {0} did not "
+                                               "stop, killing it", pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+                self.wait()
+
+        self.exited = True
+
+        self.close_device()
+
+
+class WorkerController(object):
+    """Stands in for a controller running in a worker process."""
+
+    def __init__(self, process, index):
+        self.process = process
+        self.index = index
+        self.error = None
+        self.device = None
+
+        # Updated with the metrics sent along with each heartbeat
+        self.metrics = ControllerMetrics(index)
+
+    def setup_device(self, device):
+        self.device = device
+        self.process.send_device(device)
+
+    def control(self, request, reply):
+        # The worker's socket belongs to the supervisor's loop
+        cancel = partial(reply, error_response("Controller has exited"))
+        self.process.supervisor.loop.call_soon(self.process.send_control,
+                                               request, reply, cancel=cancel)
+
+
+class WorkerSupervisor(Thread):
+    """Watches the worker processes and restarts them when needed."""
+
+    supported = hasattr(socket.socket, "sendmsg")
+
+    def __init__(self, logger):
+        Thread.__init__(self)
+        self.logger = logger.new_module("supervisor")
+        self.loop = EventLoop()
+        self.processes = []
+
+    def create_process(self, index, create, dynamic=False):
+        self.processes = [p for p in self.processes if p.is_alive()]
+
+        process = ControllerProcess(self, index, create, dynamic=dynamic)
+        process.start()
+        self.processes.append(process)
+
+        return process
+
+    def close_inherited_fds(self, worker_sock):
+        """Closes every fd a worker does not need after forking.
+
+        The workers are forked from a process running several threads,
+        so the worker inherits their sockets, loops and devices too.
+        Only stdio, the log file and the worker's socket are kept, the
+        worker is sent its device over the socket.
+        """
+        for process in self.processes:
+            if process.sock:
+                process.sock.close()
+
+        keep = set((0, 1, 2, worker_sock.fileno()))
+
+        try:
+            keep.add(self.logger.manager.output.fileno())
+        except (AttributeError, IOError, ValueError):
+            pass
+
+        try:
+            fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+        except OSError:
+            fds = range(3, MAXFD)
+
+        for fd in fds:
+            if fd not in keep:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+    def check_heartbeats(self):
+        now = time()
+        for process in self.processes:
+            process.check_heartbeat(now)
+
+        return True
+
+    def run(self):
+        timer = self.loop.create_timer(WORKER_HEARTBEAT, self.check_heartbeats)
+        timer.start()
+
+        self.loop.run()
+
+    def stop(self):
+        self.loop.stop()
+        self.join()
@@ -0,0 +1,139 @@
+import time
+import unittest
+
+from threading import Event
+
+from ds4drv.actions.binding import (ActionPool, ReportActionBinding,
+                                    action_pool)
+from ds4drv.eventloop import EventLoop
+
+
+release = Event()
+started = []
+
+
+@ReportActionBinding.action("test-wait", pooled=True)
+def wait_action(controller, name):
+    started.append(name)
+    release.wait(5)
+
+
+class StubLogger(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg, *args):
+        self.warnings.append(msg.format(*args))
+
+    def info(self, msg, *args):
+        pass
+
+    error = info
+
+
+class StubOptions(object):
+    bindings = None
+    action_concurrency = 1
+
+
+class StubController(object):
+    def __init__(self, bindings, options):
+        self.loop = EventLoop()
+        self.logger = StubLogger()
+        self.latency = None
+        self.bindings = {"global": bindings}
+        self.profiles = None
+        self.default_profile = options
+        self.options = options
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+
+    return condition()
+
+
+class PooledBindingTest(unittest.TestCase):
+    def setUp(self):
+        release.clear()
+        del started[:]
+
+    def tearDown(self):
+        release.set()
+        wait_until(lambda: not action_pool.running)
+
+    def create_binding(self, bindings, concurrency):
+        options = StubOptions()
+        options.action_concurrency = concurrency
+
+        controller = StubController(bindings, options)
+        action = ReportActionBinding(controller)
+        action.load_options(options)
+
+        return controller, action
+
+    def press(self, binding):
+        binding.callback(None, *binding.args)
+
+    def test_burst_is_capped(self):
+        controller, action = self.create_binding(
+            {("button_cross",): "test-wait cross"}, concurrency=2)
+        binding = action.bindings[0]
+
+        for i in range(5):
+            self.press(binding)
+
+        self.assertTrue(wait_until(lambda: len(started) == 2))
+        self.assertEqual(len(controller.logger.warnings), 3)
+        self.assertIn("test-wait cross", controller.logger.warnings[0])
+
+        # Presses are accepted again once the actions are done
+        release.set()
+        self.assertTrue(wait_until(lambda: not action_pool.running))
+        self.press(binding)
+        self.assertTrue(wait_until(lambda: len(started) == 3))
+
+    def test_limit_is_per_binding(self):
+        controller, action = self.create_binding(
+            {("button_cross",): "test-wait same",
+             ("button_circle",): "test-wait same"}, concurrency=1)
+
+        for binding in action.bindings:
+            self.press(binding)
+
+        self.assertTrue(wait_until(lambda: len(started) == 2))
+        self.assertEqual(controller.logger.warnings, [])
+
+
+class ActionPoolTest(unittest.TestCase):
+    def test_full_queue(self):
+        pool = ActionPool(workers=1, size=1)
+        done = Event()
+        running = Event()
+
+        def block():
+            running.set()
+            done.wait(5)
+
+        try:
+            self.assertTrue(pool.submit("a", 1, block))
+            self.assertTrue(running.wait(2))
+
+            # One waits in the queue, the next does not fit
+            self.assertTrue(pool.submit("b", 1, block))
+            self.assertFalse(pool.submit("c", 1, block))
+        finally:
+            done.set()
+
+    def test_configure(self):
+        pool = ActionPool(workers=1, size=1)
+        pool.configure(2, 8)
+
+        self.assertEqual(pool.workers, 2)
+        self.assertEqual(pool.queue.maxsize, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+import errno
+import os
+import socket
+import unittest
+
+from ds4drv.backends.bluetooth import (DeviceConnector, L2CAP_PSM_HIDP_CTRL,
+                                       L2CAP_PSM_HIDP_INTR)
+from ds4drv.eventloop import EventLoop
+from ds4drv.exceptions import DeviceError
+
+
+class StubSocket(object):
+    """Stands in for a L2CAP socket.
+
+    One end of a socket pair is used as the fd, which is always ready
+    for writing. connect_ex returns result and SO_ERROR is error.
+    """
+
+    def __init__(self, result, error):
+        self.sock, self.peer = socket.socketpair()
+        self.result = result
+        self.error = error
+        self.addr = None
+        self.blocking = True
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, blocking):
+        self.blocking = blocking
+
+    def connect_ex(self, addr):
+        self.addr = addr
+        return self.result
+
+    def getsockopt(self, level, option):
+        return self.error
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        self.peer.close()
+
+
+class DeviceConnectorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.sockets = []
+        self.results = {}
+        self.pending = 0
+
+    def tearDown(self):
+        for sock in self.sockets:
+            if not sock.closed:
+                sock.close()
+
+    def socket_factory(self, *channels):
+        """Returns a socket factory creating sockets that connect with
+        the (result, error) of each channel in turn."""
+        channels = list(channels)
+
+        def create_socket():
+            sock = StubSocket(*channels.pop(0))
+            self.sockets.append(sock)
+            return sock
+
+        return create_socket
+
+    def connected(self, addr, ctl_sock, int_sock, error):
+        self.results[addr] = (ctl_sock, int_sock, error)
+        self.pending -= 1
+        if not self.pending:
+            self.loop.stop()
+
+    def connect(self, addr, create_socket, timeout=1):
+        connector = DeviceConnector(self.loop, addr, self.connected,
+                                    timeout, create_socket)
+        self.pending += 1
+        self.loop.call_soon(connector.start)
+
+    def run_loop(self):
+        self.loop.create_timer(2, self.loop.stop).start()
+        self.loop.run()
+
+    def test_connect(self):
+        self.connect("00:11:22:33:44:55",
+                     self.socket_factory((errno.EINPROGRESS, 0),
+                                         (errno.EINPROGRESS, 0)))
+        self.run_loop()
+
+        ctl_sock, int_sock, error = self.results["00:11:22:33:44:55"]
+        self.assertIsNone(error)
+        self.assertEqual(ctl_sock.addr,
+                         ("00:11:22:33:44:55", L2CAP_PSM_HIDP_CTRL))
+        self.assertEqual(int_sock.addr,
+                         ("00:11:22:33:44:55", L2CAP_PSM_HIDP_INTR))
+        self.assertTrue(ctl_sock.blocking)
+        self.assertFalse(int_sock.blocking)
+        self.assertFalse(ctl_sock.closed or int_sock.closed)
+
+    def test_connect_refused(self):
+        self.connect("00:11:22:33:44:55",
+                     self.socket_factory((errno.EINPROGRESS, 0),
+                                         (errno.EINPROGRESS,
+                                          errno.ECONNREFUSED)))
+        self.run_loop()
+
+        ctl_sock, int_sock, error = self.results["00:11:22:33:44:55"]
+        self.assertIsNone(ctl_sock)
+        self.assertIsInstance(error, DeviceError)
+        self.assertIn(os.strerror(errno.ECONNREFUSED), str(error))
+        self.assertTrue(all(sock.closed for sock in self.sockets))
+
+    def test_connect_error(self):
+        self.connect("00:11:22:33:44:55",
+                     self.socket_factory((errno.EHOSTDOWN, 0)))
+        self.run_loop()
+
+        ctl_sock, int_sock, error = self.results["00:11:22:33:44:55"]
+        self.assertIsInstance(error, DeviceError)
+        self.assertTrue(all(sock.closed for sock in self.sockets))
+
+    def test_timeout(self):
+        # The socket never becomes writable without a peer to fill
+        def create_socket():
+            sock = StubSocket(errno.EINPROGRESS, 0)
+            sock.sock.setblocking(False)
+            try:
+                while True:
+                    sock.sock.send(b"\0" * 65536)
+            except socket.error:
+                pass
+
+            self.sockets.append(sock)
+            return sock
+
+        self.connect("00:11:22:33:44:55", create_socket, timeout=0.05)
+        self.run_loop()
+
+        ctl_sock, int_sock, error = self.results["00:11:22:33:44:55"]
+        self.assertIsInstance(error, DeviceError)
+        self.assertEqual(str(error), "Timed out after 0.05 seconds")
+        self.assertTrue(all(sock.closed for sock in self.sockets))
+
+    def test_concurrent_connects(self):
+        addrs = ["00:11:22:33:44:{0:02X}".format(i) for i in range(4)]
+        for i, addr in enumerate(addrs):
+            error = i == 2 and errno.ECONNREFUSED or 0
+            self.connect(addr, self.socket_factory((errno.EINPROGRESS, 0),
+                                                   (errno.EINPROGRESS, error)))
+        self.run_loop()
+
+        self.assertEqual(sorted(self.results), addrs)
+        for i, addr in enumerate(addrs):
+            ctl_sock, int_sock, error = self.results[addr]
+            if i == 2:
+                self.assertIsInstance(error, DeviceError)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual(ctl_sock.addr[0], addr)
+                self.assertEqual(int_sock.addr[0], addr)
+
+
+if __name__ == "__main__":
+    unittest.main()
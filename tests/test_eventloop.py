@@ -0,0 +1,66 @@
+import unittest
+
+from ds4drv.eventloop import EventLoop
+
+
+class TimerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.fired = []
+
+        # Keeps a broken test from running forever
+        self.timeout = self.loop.create_timer(1, self.loop.stop)
+        self.timeout.start()
+
+    def run_loop(self, duration):
+        self.loop.create_timer(duration, self.loop.stop).start()
+        self.loop.run()
+
+    def test_stop_from_another_timer(self):
+        def first():
+            self.fired.append("a")
+            second.stop()
+
+        def second():
+            self.fired.append("b")
+
+        # Both are due in the same wakeup
+        self.loop.create_timer(0.01, first).start()
+        second = self.loop.create_timer(0.01, second)
+        second.start()
+
+        self.run_loop(0.05)
+
+        self.assertEqual(self.fired, ["a"])
+        self.assertFalse(second.active)
+
+    def test_restart_from_another_timer(self):
+        def first():
+            self.fired.append("a")
+            second.start()
+
+        def second():
+            self.fired.append("b")
+
+        self.loop.create_timer(0.01, first).start()
+        second = self.loop.create_timer(0.01, second)
+        second.start()
+
+        self.run_loop(0.05)
+
+        # Fires once, after the interval of the restart
+        self.assertEqual(self.fired, ["a", "b"])
+
+    def test_repeat(self):
+        def tick():
+            self.fired.append("tick")
+            return len(self.fired) < 3
+
+        self.loop.create_timer(0.005, tick).start()
+        self.run_loop(0.05)
+
+        self.assertEqual(self.fired, ["tick"] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,230 @@
+import errno
+import socket
+import unittest
+
+from evdev import ecodes
+
+from ds4drv import uinput
+from ds4drv.device import DS4Device
+from ds4drv.eventloop import EventLoop, monotonic
+from ds4drv.uinput import INPUT_EVENT, ForceFeedback, create_uinput_device
+
+
+class StubUInput(object):
+    """Stands in for evdev's UInput, using one end of a socket pair as
+    the uinput fd."""
+
+    fd = None
+
+    def __init__(self, events=None, **kwargs):
+        self.events = events
+        self.device = None
+
+    def begin_upload(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubFcntl(object):
+    """Answers the force feedback ioctls with the effects in uploads
+    and records the replies."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.erases = {}
+        self.replies = []
+
+    def ioctl(self, fd, request, arg):
+        if request == uinput.UI_BEGIN_FF_UPLOAD:
+            (effect_type, effect_id, strong, weak, length,
+             delay) = self.uploads[arg.request_id]
+            effect = arg.effect
+            effect.type = effect_type
+            effect.id = effect_id
+            effect.u.ff_rumble_effect.strong_magnitude = strong
+            effect.u.ff_rumble_effect.weak_magnitude = weak
+            effect.ff_replay.length = length
+            effect.ff_replay.delay = delay
+        elif request == uinput.UI_END_FF_UPLOAD:
+            self.replies.append(("upload", arg.request_id, arg.retval))
+        elif request == uinput.UI_BEGIN_FF_ERASE:
+            arg.effect_id = self.erases[arg.request_id]
+        elif request == uinput.UI_END_FF_ERASE:
+            self.replies.append(("erase", arg.request_id, arg.retval))
+
+
+class StubDevice(DS4Device):
+    def __init__(self):
+        self.writes = []
+        super(StubDevice, self).__init__("Stub", "00:00:00:00:00:00", "usb")
+
+    def set_operational(self):
+        pass
+
+    def write_report(self, report_id, data):
+        # Small and big motor
+        self.writes.append((monotonic(), data[3], data[4]))
+
+
+class ForceFeedbackTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.kernel = socket.socketpair()
+        self.sock.setblocking(False)
+        StubUInput.fd = self.sock.fileno()
+
+        self.fcntl = StubFcntl()
+        self.patched = dict((name, getattr(uinput, name))
+                            for name in ("UInput", "fcntl",
+                                         "next_joystick_device"))
+        uinput.UInput = StubUInput
+        uinput.fcntl = self.fcntl
+        uinput.next_joystick_device = lambda: "/dev/input/js99"
+
+        self.joystick = create_uinput_device("ds4")
+        self.device = StubDevice()
+        self.loop = EventLoop()
+
+        timer = self.loop.create_timer(0.01, self.device.output.interval_passed)
+        self.device.output.attach(timer)
+
+        self.ff = ForceFeedback(self.loop, self.device.rumble)
+        self.ff.attach(self.joystick)
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(uinput, name, value)
+
+        self.sock.close()
+        self.kernel.close()
+
+    def send(self, etype, code, value):
+        self.kernel.send(INPUT_EVENT.pack(0, 0, etype, code, value))
+
+    def upload(self, request_id, effect_id, strong, weak, length=0, delay=0,
+               effect_type=ecodes.FF_RUMBLE):
+        self.fcntl.uploads[request_id] = (effect_type, effect_id, strong,
+                                          weak, length, delay)
+        self.send(ecodes.EV_UINPUT, ecodes.UI_FF_UPLOAD, request_id)
+
+    def erase(self, request_id, effect_id):
+        self.fcntl.erases[request_id] = effect_id
+        self.send(ecodes.EV_UINPUT, ecodes.UI_FF_ERASE, request_id)
+
+    def play(self, effect_id, count=1):
+        self.send(ecodes.EV_FF, effect_id, count)
+
+    def run_loop(self, duration):
+        self.loop.create_timer(duration, self.loop.stop).start()
+        self.loop.run()
+
+    def test_upload_and_erase(self):
+        self.upload(0, 3, 0xffff, 0x8000)
+        self.upload(1, 4, 0, 0, effect_type=ecodes.FF_PERIODIC)
+        self.ff.read()
+
+        self.assertEqual(list(self.joystick.effects), [3])
+        self.assertEqual(self.joystick.effects[3],
+                         uinput.RumbleEffect(0xffff, 0x8000, 0, 0))
+
+        self.erase(2, 3)
+        self.ff.read()
+
+        self.assertEqual(self.joystick.effects, {})
+        self.assertEqual(self.fcntl.replies,
+                         [("upload", 0, 0), ("upload", 1, -errno.EINVAL),
+                          ("erase", 2, 0)])
+
+    def test_play(self):
+        self.upload(0, 3, 0xffff, 0x8000)
+        self.upload(1, 4, 0x4000, 0x4000)
+        self.play(3)
+        self.ff.read()
+
+        self.assertEqual(self.ff.motors, (0x80, 0xff))
+        self.assertEqual(self.device.writes[-1][1:], (0x80, 0xff))
+
+        # Effects playing at the same time are added together
+        self.play(4)
+        self.ff.read()
+        self.assertEqual(self.ff.motors, (0xc0, 0xff))
+
+        self.send(ecodes.EV_FF, ecodes.FF_GAIN, 0x8000)
+        self.ff.read()
+        self.assertEqual(self.ff.motors, (0x60, 0x80))
+
+        self.play(3, 0)
+        self.ff.read()
+        self.assertEqual(self.ff.motors, (0x20, 0x20))
+
+        # Erasing a playing effect stops it
+        self.erase(2, 4)
+        self.ff.read()
+        self.assertEqual(self.ff.motors, (0, 0))
+
+        # The last change is written once the interval has passed
+        self.run_loop(0.02)
+        self.assertEqual(self.device.writes[-1][1:], (0, 0))
+
+    def test_length_and_delay(self):
+        self.upload(0, 3, 0xffff, 0xffff, length=40, delay=20)
+        self.play(3)
+        self.ff.read()
+        self.assertEqual(self.ff.motors, (0, 0))
+
+        motors = []
+        sample = lambda: motors.append(self.ff.motors)
+        self.loop.create_timer(0.04, sample).start()
+        self.loop.create_timer(0.08, sample).start()
+        self.run_loop(0.09)
+
+        self.assertEqual(motors, [(0xff, 0xff), (0, 0)])
+        self.assertEqual(self.ff.playing, {})
+
+    def test_latency(self):
+        self.upload(0, 3, 0xffff, 0xffff)
+        self.ff.read()
+
+        def write_report(report_id, data):
+            written.append(monotonic())
+            self.loop.stop()
+
+        written = []
+        self.device.write_report = write_report
+        self.loop.create_timer(1, self.loop.stop).start()
+
+        start = monotonic()
+        self.play(3)
+        self.loop.run()
+
+        self.assertEqual(len(written), 1)
+        self.assertLess(written[0] - start, 0.01)
+
+    def test_stop(self):
+        self.upload(0, 3, 0xffff, 0xffff)
+        self.play(3)
+        self.ff.read()
+        self.assertEqual(self.ff.motors, (0xff, 0xff))
+
+        self.ff.stop()
+        self.assertEqual(self.ff.motors, (0, 0))
+        self.assertEqual(self.device.output_state()[0], (0, 0))
+
+        # Requests are still answered
+        self.upload(1, 4, 0, 0)
+        self.ff.read()
+        self.assertEqual(self.fcntl.replies[-1], ("upload", 1, 0))
+
+    def test_detach(self):
+        self.upload(0, 3, 0xffff, 0xffff)
+        self.play(3)
+        self.ff.read()
+
+        self.ff.detach()
+        self.assertEqual(self.ff.motors, (0, 0))
+        self.assertIsNone(self.ff.device)
+
+
+if __name__ == "__main__":
+    unittest.main()
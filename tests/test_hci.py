@@ -0,0 +1,142 @@
+import socket
+import unittest
+
+from ds4drv.backends import hci
+
+
+class StubLoop(object):
+    def __init__(self):
+        self.watchers = {}
+
+    def add_watcher(self, fd, callback):
+        self.watchers[fd] = callback
+
+    def remove_watcher(self, fd):
+        del self.watchers[fd]
+
+
+def event(code, params):
+    params = bytes(bytearray(params))
+    return bytes(bytearray((hci.HCI_EVENT_PKT, code, len(params)))) + params
+
+
+def inquiry_result(addr):
+    return event(hci.EVT_INQUIRY_RESULT,
+                 bytearray((1,)) +
+                 hci.INQUIRY_RESULT.pack(hci.parse_address(addr), 1, 0, 0,
+                                         b"\0\0\0", 0x1234))
+
+
+def extended_result(addr, name, rssi=-40):
+    eir = bytearray((len(name) + 1, hci.EIR_NAME_COMPLETE))
+    eir += name.encode("utf8")
+    return event(hci.EVT_EXTENDED_INQUIRY_RESULT,
+                 hci.EXTENDED_INQUIRY_RESULT.pack(1, hci.parse_address(addr),
+                                                  1, 0, b"\0\0\0", 0, rssi) +
+                 bytes(eir))
+
+
+def remote_name(addr, name, status=0):
+    return event(hci.EVT_REMOTE_NAME_REQUEST_COMPLETE,
+                 hci.REMOTE_NAME_REQUEST_COMPLETE.pack(
+                     status, hci.parse_address(addr)) +
+                 name.encode("utf8").ljust(248, b"\0"))
+
+
+def inquiry_complete(status=0):
+    return event(hci.EVT_INQUIRY_COMPLETE, (status,))
+
+
+class HCIScannerTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.adapter = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_SEQPACKET)
+        self.adapter.settimeout(1)
+        self.loop = StubLoop()
+        self.found = []
+        self.errors = []
+        self.scanner = hci.HCIScanner(self.loop, self.sock,
+                                      self.callback, self.errors.append)
+        self.scanner.start()
+
+        self.assertEqual(self.read_command()[0], hci.OP_WRITE_INQUIRY_MODE)
+        self.assertEqual(self.read_command()[0], hci.OP_INQUIRY)
+
+    def tearDown(self):
+        self.sock.close()
+        self.adapter.close()
+
+    def callback(self, addr, name, rssi):
+        self.found.append((addr, name, rssi))
+
+    def read_command(self):
+        data = self.adapter.recv(hci.HCI_MAX_EVENT_SIZE)
+        packet_type, opcode, length = hci.COMMAND_HEADER.unpack_from(data)
+        self.assertEqual(packet_type, hci.HCI_COMMAND_PKT)
+        return opcode, bytearray(data[hci.COMMAND_HEADER.size:])
+
+    def feed(self, *events):
+        for data in events:
+            self.adapter.send(data)
+
+        self.loop.watchers[self.sock]()
+
+    def test_extended_result(self):
+        self.feed(extended_result("00:11:22:33:44:55", hci.DS4_NAME),
+                  extended_result("00:11:22:33:44:66", "Keyboard"),
+                  # Devices are reported once per inquiry
+                  extended_result("00:11:22:33:44:55", hci.DS4_NAME))
+
+        self.assertEqual(self.found,
+                         [("00:11:22:33:44:55", hci.DS4_NAME, -40)])
+
+    def test_name_requested_after_inquiry(self):
+        self.feed(inquiry_result("00:11:22:33:44:55"),
+                  inquiry_result("00:11:22:33:44:66"))
+        self.assertEqual(self.found, [])
+
+        self.feed(inquiry_complete())
+        opcode, params = self.read_command()
+        self.assertEqual(opcode, hci.OP_REMOTE_NAME_REQUEST)
+        addr, page_scan_mode, reserved, clock_offset = \
+            hci.REMOTE_NAME_REQUEST.unpack_from(params)
+        self.assertEqual(hci.format_address(addr), "00:11:22:33:44:55")
+        self.assertEqual(clock_offset, 0x1234 | 0x8000)
+
+        self.feed(remote_name("00:11:22:33:44:55", hci.DS4_NAME))
+        self.assertEqual(self.found,
+                         [("00:11:22:33:44:55", hci.DS4_NAME, None)])
+        self.assertEqual(self.read_command()[0], hci.OP_REMOTE_NAME_REQUEST)
+
+        # The next inquiry starts once all names are known
+        self.feed(remote_name("00:11:22:33:44:66", "Keyboard"))
+        self.assertEqual(self.read_command()[0], hci.OP_INQUIRY)
+        self.assertEqual(len(self.found), 1)
+
+        # Known names are not requested again
+        self.feed(inquiry_result("00:11:22:33:44:55"))
+        self.assertEqual(len(self.found), 2)
+
+    def test_inquiry_failed(self):
+        self.feed(inquiry_complete(0x0c))
+
+        self.assertEqual(self.errors, ["Inquiry failed with status 0x0c"])
+        self.assertNotIn(self.sock, self.loop.watchers)
+
+    def test_adapter_closed(self):
+        self.adapter.close()
+        self.loop.watchers[self.sock]()
+
+        self.assertEqual(self.errors, ["The adapter was closed"])
+        self.assertFalse(self.scanner.running)
+
+    def test_ignores_malformed_events(self):
+        self.feed(b"\x01\x02", event(hci.EVT_EXTENDED_INQUIRY_RESULT, (1,)),
+                  event(hci.EVT_INQUIRY_RESULT, (2,)))
+
+        self.assertEqual(self.found, [])
+        self.assertEqual(self.errors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from collections import deque
+
+from ds4drv.logger import Logger
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class LoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.output = StringIO()
+        self.logger = Logger()
+        self.logger.set_level("info")
+        self.logger.set_output(self.output)
+        self.module = self.logger.new_module("test")
+
+    def test_escaped_braces(self):
+        self.module.info("{{escaped}}")
+        self.module.info("{0} {{escaped}}", "arg")
+
+        self.assertEqual(self.output.getvalue(),
+                         "[info][test] {escaped}\n"
+                         "[info][test] arg {escaped}\n")
+
+    def test_async_formats_on_flush(self):
+        # Not started, so nothing is written until flush is called
+        self.logger.queue = deque()
+        self.logger.queue_size = 2
+
+        class Value(object):
+            formatted = 0
+
+            def __format__(self, spec):
+                Value.formatted += 1
+                return "value"
+
+        self.module.info("{0}", Value())
+        self.module.info("{0} {1}", "missing")
+        self.module.info("dropped")
+
+        self.assertEqual(Value.formatted, 0)
+        self.assertEqual(self.output.getvalue(), "")
+
+        self.logger.flush()
+        lines = self.output.getvalue().splitlines()
+
+        self.assertEqual(Value.formatted, 1)
+        self.assertEqual(lines[0], "[info][test] value")
+        self.assertTrue(lines[1].startswith("[error][logger] Unable to "
+                                            "format message"))
+        self.assertEqual(lines[2], "[warning][logger] Dropped 1 messages, "
+                                   "the queue was full")
+
+
+if __name__ == "__main__":
+    unittest.main()
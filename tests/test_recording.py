@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ds4drv.recording import ReportRecorder, RecordingError, read_recording
+
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "reports.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, timestamps, device_type="usb"):
+        recorder = ReportRecorder(self.filename, device_type)
+        for timestamp in timestamps:
+            recorder.record(bytearray([timestamp]), timestamp)
+        recorder.close()
+
+    def test_read(self):
+        self.record([10, 11, 12])
+
+        device_type, reports = read_recording(self.filename)
+        self.assertEqual(device_type, "usb")
+        self.assertEqual(reports, [(10.0, bytearray([10])),
+                                   (11.0, bytearray([11])),
+                                   (12.0, bytearray([12]))])
+
+    def test_appended_sessions_continue(self):
+        self.record([100, 101])
+        # The clock of a later session may be behind or far ahead
+        self.record([5, 6])
+        self.record([250, 252])
+
+        device_type, reports = read_recording(self.filename)
+        timestamps = [timestamp for timestamp, report in reports]
+        self.assertEqual([report[0] for timestamp, report in reports],
+                         [100, 101, 5, 6, 250, 252])
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertLess(timestamps[-1] - timestamps[0], 10)
+        self.assertEqual(timestamps[3] - timestamps[2], 1)
+        self.assertEqual(timestamps[5] - timestamps[4], 2)
+
+    def test_append_other_device_type(self):
+        self.record([1])
+        self.assertRaises(RecordingError, self.record, [2], "bluetooth")
+
+
+if __name__ == "__main__":
+    unittest.main()